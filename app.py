@@ -1,39 +1,1494 @@
-from flask import Flask, request, jsonify, redirect, url_for, session, render_template_string
+from flask import Flask, Response, g, request, jsonify, redirect, url_for, session, render_template
+from flask.sessions import SecureCookieSessionInterface
 from flask_cors import CORS
+from common import (PREDEFINED_TOKENS, MAX_BATCH_RECORDS, RATE_LIMIT_LABELS, parse_otp_batch, posted_fields,
+                    posted_token, render_caps_partial)
 from datetime import datetime
-import zoneinfo, time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+from urllib.parse import quote
+import atexit, gzip, hashlib, heapq, hmac, itertools, json, math, os, pickle, sqlite3, struct, sys, zlib, zoneinfo, time, threading
 
 app = Flask(__name__)
 app.secret_key = "SUPERSECRETKEY"   # change this in production
 CORS(app)
 
+# Pages are Jinja templates under templates/, compiled once and cached by Flask. CSS/JS live under
+# static/ and are served with a year-long max-age; asset_url() adds a content hash so a changed
+# file gets a new URL.
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 365 * 24 * 3600
+asset_versions = {}
+
+@app.template_global()
+def asset_url(filename):
+    if filename not in asset_versions:
+        with open(os.path.join(app.static_folder, filename), "rb") as f:
+            asset_versions[filename] = hashlib.md5(f.read()).hexdigest()[:12]
+    return url_for("static", filename=filename, v=asset_versions[filename])
+
 IST = zoneinfo.ZoneInfo("Asia/Kolkata")
 
+# =========================
+# Clock
+# =========================
+# Timestamps, stale/group expiry and history age all read time through `clock`, so tests and
+# bench.py --virtual can install a VirtualClock and run hours of polling in seconds. Long-poll
+# holds, SSE keepalives and journal flushing are transport timing and run on time.monotonic().
+class SystemClock:
+    """Wall time that never goes backwards: between reads it advances with time.monotonic() and
+    only follows the wall clock forward, so an NTP step back cannot reorder queued browsers
+    or make an OTP look older than the session waiting for it."""
+    background_reaper = True  # due expiries are run by the reaper thread
+
+    def __init__(self):
+        self._offset = time.time() - time.monotonic()
+
+    def time(self):
+        t = time.monotonic() + self._offset
+        wall = time.time()
+        if wall > t:
+            self._offset += wall - t
+            return wall
+        return t
+
+class VirtualClock:
+    """Clock that only moves on advance(). Expiries coming due are reaped inside advance(),
+    one by one at their own due time, so a run is deterministic."""
+    background_reaper = False
+
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else start
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        self.advance_to(self._now + seconds)
+
+    def advance_to(self, ts):
+        while True:
+            due = next_expiry_due()
+            if due is None or due > ts:
+                break
+            self._now = max(self._now, due)
+            run_due_expiries()
+        self._now = max(self._now, ts)
+
+clock = SystemClock()
+
+def set_clock(new_clock):
+    """Install the clock the relay reads (SystemClock() to go back to wall time)."""
+    global clock
+    clock = new_clock
+    with reaper_cond:
+        reaper_cond.notify()
+    return new_clock
+
 # =========================
 # Predefined Tokens & Passwords
 # =========================
-PREDEFINED_TOKENS = ["km8686", "kmk8686", "km5630"]
 token_passwords = {t: "12345678" for t in PREDEFINED_TOKENS}
 
 # Admin password
 ADMIN_PASSWORD = "12345678"
 
+# Tokens whose state lives in this process: all of them, or one shard's subset under shards.py
+if "OTP_SHARD_TOKENS" in os.environ:
+    OWNED_TOKENS = [t for t in os.environ["OTP_SHARD_TOKENS"].split(",") if t in PREDEFINED_TOKENS]
+else:
+    OWNED_TOKENS = PREDEFINED_TOKENS
+
 # Mobile caps per token (None = unlimited)
 token_mobile_caps = {t: None for t in PREDEFINED_TOKENS}
 token_processed_mobiles = {t: set() for t in PREDEFINED_TOKENS}
 
+# Rate limits per token: limit -> (rate, burst) or None (see Rate limits)
+def rate_limit_env(name, default):
+    value = os.environ.get(name, default).strip()
+    if not value or value == "0":
+        return None
+    rate, _, burst = value.partition("/")
+    return (float(rate), float(burst or rate))
+
+DEFAULT_RATE_LIMITS = {
+    "receive": rate_limit_env("OTP_RATE_RECEIVE", "100/200"),
+    # Batches are charged per record on their own bucket, whose burst takes two full batches
+    "receive_batch": rate_limit_env("OTP_RATE_RECEIVE_BATCH", f"{MAX_BATCH_RECORDS}/{2 * MAX_BATCH_RECORDS}"),
+    "poll": rate_limit_env("OTP_RATE_POLL", "500/1000"),
+    "poll_browser": rate_limit_env("OTP_RATE_POLL_BROWSER", "10/20"),
+    "login": rate_limit_env("OTP_RATE_LOGIN", "50/100"),
+}
+token_rate_limits = {t: dict(DEFAULT_RATE_LIMITS) for t in PREDEFINED_TOKENS}
+
+# =========================
+# Records
+# =========================
+# Pending OTPs, history rows, client sessions and login detections are slotted objects with
+# epoch-microsecond timestamps instead of dicts holding tz-aware datetimes. The token is implied
+# by the per-token structure a record lives in, and identifiers are interned.
+def now_us():
+    return int(clock.time() * 1_000_000)
+
+def us_datetime(us):
+    return datetime.fromtimestamp(us / 1_000_000, IST)
+
+def datetime_us(dt):
+    return round(dt.timestamp() * 1_000_000)
+
+class TimestampFormatter:
+    """"%Y-%m-%d %H:%M:%S" in one timezone without zoneinfo/strftime per call: the "date hour:"
+    prefix is cached per 15-minute UTC block (UTC offsets are whole quarter hours, so a block
+    never straddles a local hour) and the last formatted second is reused as is."""
+    MINUTE_SECOND = tuple(f"{m:02d}:{s:02d}" for m in range(60) for s in range(60))
+
+    def __init__(self, tz, max_blocks=10000):
+        self.tz = tz
+        self.max_blocks = max_blocks
+        self._blocks = {}  # block -> ("YYYY-MM-DD HH:", seconds into the local hour at block start)
+        self._last = (None, "")
+
+    def __call__(self, us):
+        sec = us // 1_000_000
+        last_sec, text = self._last
+        if sec == last_sec:
+            return text
+        block, into_block = divmod(sec, 900)
+        cached = self._blocks.get(block)
+        if cached is None:
+            if len(self._blocks) >= self.max_blocks:
+                self._blocks.clear()
+            dt = datetime.fromtimestamp(block * 900, self.tz)
+            cached = self._blocks[block] = (dt.strftime("%Y-%m-%d %H:"), dt.minute * 60 + dt.second)
+        prefix, into_hour = cached
+        text = prefix + self.MINUTE_SECOND[into_hour + into_block]
+        self._last = (sec, text)
+        return text
+
+format_ts = TimestampFormatter(IST)  # epoch us -> IST "%Y-%m-%d %H:%M:%S" for responses and rows
+
+def intern_id(value):
+    return sys.intern(value) if value else value
+
+def restore_record(cls, values):
+    record = cls.__new__(cls)
+    for name, value in zip(cls.__slots__, values):
+        setattr(record, name, value)
+    return record
+
+class Record:
+    """Base of the slotted records: compact pickles and the dict form used by JSON views and spill files."""
+    __slots__ = ()
+    TIME_FIELDS = ()
+
+    def __reduce__(self):
+        return restore_record, (type(self), tuple(getattr(self, n) for n in self.__slots__))
+
+    def as_dict(self):
+        out = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                out[name] = us_datetime(value).isoformat() if name in self.TIME_FIELDS else value
+        return out
+
+    @classmethod
+    def from_dict(cls, data):
+        values = []
+        for name in cls.__slots__:
+            value = data.get(name)
+            if name in cls.TIME_FIELDS and isinstance(value, str):
+                value = datetime_us(datetime.fromisoformat(value))
+            values.append(value)
+        return restore_record(cls, values)
+
+class OtpRecord(Record):
+    """One OTP from arrival to history: the pending store and otp_data hold the same object."""
+    __slots__ = ("otp", "sim_number", "vehicle", "timestamp", "seq", "browser_id", "removed_at", "removed_reason")
+    TIME_FIELDS = ("timestamp", "removed_at")
+
+    def __init__(self, otp, sim_number=None, vehicle=None, timestamp=None, removed_reason=None):
+        self.otp = otp
+        self.sim_number = intern_id(sim_number)
+        self.vehicle = intern_id(vehicle)
+        self.timestamp = now_us() if timestamp is None else timestamp
+        self.seq = None
+        self.browser_id = None
+        self.removed_at = None
+        self.removed_reason = removed_reason
+
+class LoginRecord(Record):
+    __slots__ = ("mobile_number", "source", "timestamp", "seq")
+    TIME_FIELDS = ("timestamp",)
+
+    def __init__(self, mobile_number, source, timestamp=None):
+        self.mobile_number = intern_id(mobile_number)
+        self.source = intern_id(source)
+        self.timestamp = now_us() if timestamp is None else timestamp
+        self.seq = None
+
+class ClientSession(Record):
+    """A browser polling one identifier: first_request in epoch us (compared with OTP timestamps),
+    last_request in clock.time() seconds (stale checks)."""
+    __slots__ = ("first_request", "last_request")
+
+    def __init__(self, first_request, last_request):
+        self.first_request = first_request
+        self.last_request = last_request
+
+# =========================
+# Pending OTP store
+# =========================
+class PendingOtpStore:
+    """Pending OTPs of one token, indexed by identifier and kept in arrival order."""
+
+    def __init__(self, field):
+        self.field = field  # "sim_number" or "vehicle"
+        self._by_identifier = {}
+
+    @staticmethod
+    def _key(identifier):
+        return (identifier or "").strip().upper()
+
+    def add(self, entry):
+        self._by_identifier.setdefault(self._key(getattr(entry, self.field)), []).append(entry)
+
+    def for_identifier(self, identifier):
+        return self._by_identifier.get(self._key(identifier), [])
+
+    def after(self, identifier, ts):
+        # Entries are appended as they arrive, so each list is sorted by timestamp
+        entries = self.for_identifier(identifier)
+        return entries[bisect_right(entries, ts, key=lambda e: e.timestamp):]
+
+    def find(self, identifier, otp):
+        for e in self.for_identifier(identifier):
+            if e.otp == otp:
+                return e
+        return None
+
+    def remove(self, entry):
+        key = self._key(getattr(entry, self.field))
+        entries = self._by_identifier.get(key)
+        if not entries:
+            return False
+        for i, e in enumerate(entries):
+            if e is entry:
+                del entries[i]
+                if not entries:
+                    del self._by_identifier[key]
+                return True
+        return False
+
+    def pop_after(self, identifier, ts):
+        key = self._key(identifier)
+        entries = self._by_identifier.get(key)
+        if not entries:
+            return []
+        i = bisect_right(entries, ts, key=lambda e: e.timestamp)
+        removed = entries[i:]
+        del entries[i:]
+        if not entries:
+            del self._by_identifier[key]
+        return removed
+
+    def replace(self, identifier, entries):
+        # All entries of one identifier at once (state loaded from a backend)
+        key = self._key(identifier)
+        if entries:
+            self._by_identifier[key] = list(entries)
+        else:
+            self._by_identifier.pop(key, None)
+
+    def by_identifier(self):
+        return self._by_identifier.items()
+
+    def clear(self):
+        self._by_identifier.clear()
+
+    def __len__(self):
+        return sum(len(v) for v in self._by_identifier.values())
+
+    def __iter__(self):
+        for entries in self._by_identifier.values():
+            yield from entries
+
+# =========================
+# Browser queue
+# =========================
+class BrowserQueue:
+    """Browsers polling one identifier, in arrival order, with O(1) add/peek/pop/remove/membership."""
+
+    def __init__(self):
+        self._browsers = OrderedDict()  # browser_id -> first_request (epoch us)
+        self._group = None  # cached leading group, rebuilt only when the head changes
+        self._group_window = None
+
+    def add(self, browser_id, first_request):
+        if browser_id in self._browsers:
+            return False
+        self._browsers[browser_id] = first_request
+        # A newcomer can only extend the cached group (first_request grows with arrival order)
+        if self._group is not None and len(self._group) == len(self._browsers) - 1:
+            head_time = self._browsers[self._group[0]]
+            if first_request - head_time <= self._group_window * 1_000_000:
+                self._group.append(browser_id)
+        return True
+
+    def insert(self, browser_id, first_request):
+        """add() for a browser that may have joined before the tail (loaded from another process)."""
+        if not self._browsers or first_request >= next(reversed(self._browsers.values())):
+            return self.add(browser_id, first_request)
+        if browser_id in self._browsers:
+            return False
+        self._browsers[browser_id] = first_request
+        self._browsers = OrderedDict(sorted(self._browsers.items(), key=lambda item: item[1]))
+        self._group = None
+        return True
+
+    def head(self):
+        return next(iter(self._browsers), None)
+
+    def first_request(self, browser_id):
+        return self._browsers[browser_id]
+
+    def pop_head(self):
+        if self._browsers:
+            self._browsers.popitem(last=False)
+            self._group = None
+
+    def remove(self, browser_id):
+        if browser_id not in self._browsers:
+            return False
+        if self._group is not None:
+            if self._group[0] == browser_id:
+                self._group = None
+            elif browser_id in self._group:
+                self._group.remove(browser_id)
+        del self._browsers[browser_id]
+        return True
+
+    def position(self, browser_id, limit):
+        """Browsers ahead of browser_id, counting no further than limit."""
+        for i, b in enumerate(itertools.islice(self._browsers, limit)):
+            if b == browser_id:
+                return i
+        return limit
+
+    def leading_group(self, window):
+        """Browsers that joined within `window` seconds of the head."""
+        if self._group is None or self._group_window != window:
+            group = []
+            head_time = None
+            for b, first_request in self._browsers.items():
+                if head_time is None:
+                    head_time = first_request
+                elif first_request - head_time > window * 1_000_000:
+                    break
+                group.append(b)
+            self._group, self._group_window = group, window
+        return list(self._group)
+
+    def __contains__(self, browser_id):
+        return browser_id in self._browsers
+
+    def __len__(self):
+        return len(self._browsers)
+
+    def __iter__(self):
+        return iter(self._browsers)
+
+# =========================
+# History log (bounded, spills to disk)
+# =========================
+# otp_data and login_sessions keep only recent records in memory. Records past the retention
+# limits are written to gzip-compressed, append-only segment files and can still be paged back.
+# Each segment of an indexed log gets a small "<first>-<last>.idx.json" (index value -> seqs) next
+# to it, so lookups by mobile number still find records that left memory.
+HISTORY_MAX_RECORDS = int(os.environ.get("OTP_HISTORY_MAX_RECORDS", 5000))
+HISTORY_MAX_AGE_SECONDS = float(os.environ.get("OTP_HISTORY_MAX_AGE_HOURS", 72)) * 3600
+HISTORY_DIR = os.environ.get("OTP_HISTORY_DIR", "otp_history")
+HISTORY_PAGE_SIZE = 200  # rows per page in the admin history views
+SEGMENT_INDEX_CACHE = 1024  # segment indexes kept parsed in memory, least recently used dropped first
+segment_indexes = OrderedDict()  # (segment path, mtime) -> {index value: seqs}; segments never change once written
+segment_indexes_lock = threading.Lock()
+
+class HistoryLog:
+    """Append-only history of one token, numbered by seq, with an optional per-field index."""
+
+    def __init__(self, directory, record_type, index_field=None, max_records=None, max_age=None):
+        self.directory = directory
+        self.record_type = record_type  # Record subclass, to read spilled records back
+        self.index_field = index_field
+        self.max_records = HISTORY_MAX_RECORDS if max_records is None else max_records
+        self.max_age = HISTORY_MAX_AGE_SECONDS if max_age is None else max_age
+        self.records = []  # in memory, oldest first
+        self.index = {}    # index_field value -> in-memory records
+        self.revision = 0  # bumped whenever records leave memory (deletes, clears, spills)
+        self.lock = threading.RLock()  # appends can come from any identifier's poll or receive
+        segments = self.segments()
+        self.next_seq = (segments[-1][1] + 1) if segments else 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    # ---- in-memory part ----
+    def append(self, record):
+        with self.lock:
+            record.seq = self.next_seq
+            self.next_seq += 1
+            self._add(record)
+            self.enforce_retention()
+        return record
+
+    def load(self, record):
+        # Record that already has a seq (restored from another store)
+        with self.lock:
+            self.next_seq = max(self.next_seq, record.seq + 1)
+            self._add(record)
+
+    def _add(self, record):
+        self.records.append(record)
+        if self.index_field:
+            key = getattr(record, self.index_field)
+            if key is not None:
+                self.index.setdefault(key, []).append(record)
+
+    def by_key(self, key):
+        # In-memory records only; by_keys() also finds the spilled ones
+        return self.index.get(key, [])
+
+    def by_keys(self, keys):
+        """{key: records} for each key, oldest first, including records spilled to the segments."""
+        with self.lock:
+            spilled = {key: [] for key in keys}
+            for _, _, path in self.segments():
+                index = self._segment_index(path)
+                for key in keys:
+                    spilled[key].extend(index.get(key, ()))
+            found = {r.seq: r for r in self.get_seqs([seq for seqs in spilled.values() for seq in seqs])}
+            return {key: [found[seq] for seq in spilled[key] if seq in found] + list(self.by_key(key)) for key in keys}
+
+    def retain(self, keep):
+        with self.lock:
+            kept = [r for r in self.records if keep(r)]
+            if len(kept) != len(self.records):
+                self._replace(kept)
+
+    def get_seqs(self, seqs):
+        """Records with the given seqs, in the order asked, from memory or the spilled segments."""
+        with self.lock:
+            found = {}
+            missing = set()
+            for seq in seqs:
+                i = bisect_left(self.records, seq, key=lambda r: r.seq)
+                if i < len(self.records) and self.records[i].seq == seq:
+                    found[seq] = self.records[i]
+                else:
+                    missing.add(seq)
+            for first, last, path in self.segments() if missing else ():
+                if not any(first <= seq <= last for seq in missing):
+                    continue
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        data = json.loads(line)
+                        if data["seq"] in missing:
+                            found[data["seq"]] = self.record_type.from_dict(data)
+        return [found[seq] for seq in seqs if seq in found]
+
+    def delete_seqs(self, seqs):
+        seqs = set(seqs)
+        with self.lock:
+            removed = [r for r in self.records if r.seq in seqs]
+            if removed:
+                self._replace([r for r in self.records if r.seq not in seqs])
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self._replace([])
+            for path in self._segment_paths():
+                os.remove(path)
+                if os.path.exists(segment_index_path(path)):
+                    os.remove(segment_index_path(path))
+
+    def _replace(self, records):
+        self.records = []
+        self.index = {}
+        for r in records:
+            self._add(r)
+        self.revision += 1
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    # ---- retention / spill ----
+    def enforce_retention(self):
+        spill = 0
+        if len(self.records) > self.max_records:
+            # Spill in batches (down to 90% of the cap) so segments are not one record each
+            spill = len(self.records) - int(self.max_records * 0.9)
+        if self.max_age and self.records:
+            cutoff = now_us() - self.max_age * 1_000_000
+            while spill < len(self.records) and self.records[spill].timestamp < cutoff:
+                spill += 1
+        if spill:
+            self._spill(self.records[:spill])
+            self._replace(self.records[spill:])
+
+    def _spill(self, records):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{records[0].seq:012d}-{records[-1].seq:012d}.jsonl.gz")
+        if self.index_field:
+            # Written first: a segment is only listed once its index is in place
+            index = {}
+            for r in records:
+                key = getattr(r, self.index_field)
+                if key is not None:
+                    index.setdefault(key, []).append(r.seq)
+            self._write_segment_index(path, index)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            for r in records:
+                f.write(history_record_json(r) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def _write_segment_index(self, path, index):
+        with open(segment_index_path(path) + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(segment_index_path(path) + ".tmp", segment_index_path(path))
+
+    def _segment_index(self, path):
+        """index value -> seqs of one segment (rebuilt from the segment if its index file is missing)."""
+        try:
+            # A cleared log can write a segment of the same name again: the mtime tells them apart
+            cache_key = (path, os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            return {}
+        with segment_indexes_lock:
+            index = segment_indexes.get(cache_key)
+            if index is not None:
+                segment_indexes.move_to_end(cache_key)
+                return index
+        try:
+            with open(segment_index_path(path), encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {}
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    data = json.loads(line)
+                    key = data.get(self.index_field)
+                    if key is not None:
+                        index.setdefault(key, []).append(data["seq"])
+            self._write_segment_index(path, index)
+        cache_segment_index(cache_key, index)
+        return index
+
+    def _segment_paths(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith(".jsonl.gz"))
+
+    def segments(self):
+        """(first_seq, last_seq, path) of every spilled segment, oldest first."""
+        out = []
+        for path in self._segment_paths():
+            first, last = os.path.basename(path)[:-len(".jsonl.gz")].split("-")
+            out.append((int(first), int(last), path))
+        return out
+
+    def page(self, before_seq=None, limit=HISTORY_PAGE_SIZE):
+        """Records with seq < before_seq (all when None), newest first, continuing from memory into
+        the spilled segments; returns (records, before_seq of the next page or None)."""
+        with self.lock:
+            return self._page(before_seq, limit)
+
+    def _page(self, before_seq, limit):
+        end = len(self.records) if before_seq is None else bisect_left(self.records, before_seq, key=lambda r: r.seq)
+        page = self.records[max(0, end - limit):end][::-1]
+        if len(page) == limit:
+            last = page[-1].seq
+            more = end > limit or any(first < last for first, _, _ in self.segments())
+            return page, (last if more else None)
+        spilled_before = self.records[0].seq if self.records else self.next_seq
+        if before_seq is not None:
+            spilled_before = min(spilled_before, before_seq)
+        older, cursor = self.spilled_page(spilled_before, limit - len(page))
+        return page + older, cursor
+
+    def spilled_page(self, before_seq, limit):
+        """Spilled records with seq < before_seq, newest first; returns (records, next_before_seq or None)."""
+        page = []
+        for first, last, path in reversed(self.segments()):
+            if first >= before_seq:
+                continue
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            for data in reversed(records):
+                if data["seq"] >= before_seq:
+                    continue
+                r = self.record_type.from_dict(data)
+                page.append(r)
+                if len(page) == limit:
+                    more = r.seq > 1 and any(s[0] < r.seq for s in self.segments())
+                    return page, (r.seq if more else None)
+        return page, None
+
+def history_record_json(record):
+    return json.dumps(record.as_dict())
+
+def segment_index_path(path):
+    return path[:-len(".jsonl.gz")] + ".idx.json"
+
+def cache_segment_index(cache_key, index):
+    with segment_indexes_lock:
+        segment_indexes[cache_key] = index
+        segment_indexes.move_to_end(cache_key)
+        while len(segment_indexes) > SEGMENT_INDEX_CACHE:
+            segment_indexes.popitem(last=False)
+
+HISTORY_RECORD_TYPES = {"otp_data": OtpRecord, "login_sessions": LoginRecord}
+
+def new_history_log(token, name, index_field=None):
+    return HistoryLog(os.path.join(HISTORY_DIR, token, name), HISTORY_RECORD_TYPES[name], index_field=index_field)
+
 # =========================
 # Storage per token (in-memory)
 # =========================
-mobile_otps = {t: [] for t in PREDEFINED_TOKENS}
-vehicle_otps = {t: [] for t in PREDEFINED_TOKENS}
-otp_data = {t: [] for t in PREDEFINED_TOKENS}
+mobile_otps = {t: PendingOtpStore("sim_number") for t in PREDEFINED_TOKENS}
+vehicle_otps = {t: PendingOtpStore("vehicle") for t in PREDEFINED_TOKENS}
+otp_data = {t: new_history_log(t, "otp_data", index_field="sim_number") for t in PREDEFINED_TOKENS}
 client_sessions = {t: {} for t in PREDEFINED_TOKENS}
 browser_queues = {t: {} for t in PREDEFINED_TOKENS}
 group_assignments = {t: {} for t in PREDEFINED_TOKENS}  # New: for mobile group OTP sharing
-login_sessions = {t: {} for t in PREDEFINED_TOKENS}
+login_sessions = {t: new_history_log(t, "login_sessions", index_field="mobile_number") for t in PREDEFINED_TOKENS}
+blocked_sims = {t: {} for t in PREDEFINED_TOKENS}  # sim_number -> seqs of its limit_exceeded records in otp_data
 
 BROWSER_STALE_SECONDS = float(10)
+GROUP_WINDOW_SECONDS = float(2)  # browsers joining within this of the queue head share one OTP
+MAX_POLL_WAIT_SECONDS = float(30)  # upper bound for get-latest-otp ?wait=
+SSE_KEEPALIVE_SECONDS = BROWSER_STALE_SECONDS / 2  # must stay below the stale limit
+
+# Long-poll waiters: (token, identifier) -> set of threading.Event
+otp_waiters = {}
+otp_waiters_lock = threading.Lock()
+
+# =========================
+# Keyed entries
+# =========================
+# Backends that persist state write these structures entry by entry, keyed (identifier, sub), so a
+# poll or receive only writes what it changed. Pending OTPs and group assignments are compared for
+# the identifiers a block was entered with; sessions, blocked SIMs and processed mobiles are
+# reported by the code that changes them (state_changed / clear_entries). browser_queues is not
+# stored: it is rebuilt from the client sessions, which carry each browser's first_request.
+class PendingEntries:
+    def __init__(self, stores):
+        self.stores = stores
+
+    def get(self, token, identifier, sub):
+        return self.stores[token].for_identifier(identifier) or None
+
+    def put(self, token, identifier, sub, value):
+        self.stores[token].replace(identifier, value)
+
+    def delete(self, token, identifier, sub):
+        self.stores[token].replace(identifier, ())
+
+    def drop(self, token, identifier):
+        self.stores[token].replace(identifier, ())
+
+    def clear(self, token):
+        self.stores[token].clear()
+
+    def items(self, token):
+        return (((identifier, ""), entries) for identifier, entries in self.stores[token].by_identifier())
+
+class DictEntries:
+    def __init__(self, stores):
+        self.stores = stores
+
+    def get(self, token, identifier, sub):
+        return self.stores[token].get(identifier)
+
+    def put(self, token, identifier, sub, value):
+        self.stores[token][identifier] = value
+
+    def delete(self, token, identifier, sub):
+        self.stores[token].pop(identifier, None)
+
+    def drop(self, token, identifier):
+        self.stores[token].pop(identifier, None)
+
+    def clear(self, token):
+        self.stores[token].clear()
+
+    def items(self, token):
+        return (((identifier, ""), value) for identifier, value in self.stores[token].items())
+
+class SetEntries:
+    def __init__(self, stores):
+        self.stores = stores
+
+    def get(self, token, identifier, sub):
+        return True if identifier in self.stores[token] else None
+
+    def put(self, token, identifier, sub, value):
+        self.stores[token].add(identifier)
+
+    def delete(self, token, identifier, sub):
+        self.stores[token].discard(identifier)
+
+    def drop(self, token, identifier):
+        self.stores[token].discard(identifier)
+
+    def clear(self, token):
+        self.stores[token].clear()
+
+    def items(self, token):
+        return (((identifier, ""), True) for identifier in self.stores[token])
+
+class SessionEntries:
+    """client_sessions keyed (identifier, browser_id); keeps browser_queues in step."""
+
+    def get(self, token, identifier, sub):
+        return client_sessions[token].get((identifier, sub))
+
+    def put(self, token, identifier, sub, value):
+        client_sessions[token][(identifier, sub)] = value
+        queues = browser_queues[token]
+        if identifier not in queues:
+            queues[identifier] = BrowserQueue()
+        queues[identifier].insert(sub, value.first_request)
+
+    def delete(self, token, identifier, sub):
+        client_sessions[token].pop((identifier, sub), None)
+        queue = browser_queues[token].get(identifier)
+        if queue is not None:
+            queue.remove(sub)
+            if not queue:
+                del browser_queues[token][identifier]
+
+    def drop(self, token, identifier):
+        for browser_id in list(browser_queues[token].get(identifier, ())):
+            self.delete(token, identifier, browser_id)
+
+    def clear(self, token):
+        client_sessions[token].clear()
+        browser_queues[token].clear()
+
+    def items(self, token):
+        return client_sessions[token].items()
+
+ENTRY_STATE = {
+    "mobile_otps": PendingEntries(mobile_otps),
+    "vehicle_otps": PendingEntries(vehicle_otps),
+    "group_assignments": DictEntries(group_assignments),
+    "blocked_sims": DictEntries(blocked_sims),
+    "token_processed_mobiles": SetEntries(token_processed_mobiles),
+    "client_sessions": SessionEntries(),
+}
+IDENTIFIER_ENTRIES = ("mobile_otps", "vehicle_otps", "group_assignments")  # compared per block identifier
+TOKEN_ENTRIES = ("token_processed_mobiles",)  # loaded whole by a block that names them (counted against the cap)
+DERIVED_STATE = ("browser_queues",)  # rebuilt from client_sessions, never stored on its own
+
+class StateChanges:
+    """Entries reported changed in one token since they were last written: (name, identifier, sub)
+    in the order first reported, applied after the names that were cleared."""
+
+    def __init__(self):
+        self.cleared = []
+        self.keys = {}
+
+    def add(self, name, identifier, sub):
+        self.keys[(name, identifier, sub)] = None
+
+    def clear(self, name):
+        self.keys = {key: None for key in self.keys if key[0] != name}
+        if name not in self.cleared:
+            self.cleared.append(name)
+
+    def entries(self, token, names, identifiers):
+        """(name, identifier, sub, value or None) of every reported entry, plus the per-identifier
+        entries of the block's identifiers."""
+        keys = dict(self.keys)
+        if identifiers is not None:
+            for name in IDENTIFIER_ENTRIES:
+                if name in names:
+                    for identifier in identifiers:
+                        keys[(name, identifier, "")] = None
+        for name, identifier, sub in keys:
+            yield name, identifier, sub, ENTRY_STATE[name].get(token, identifier, sub)
+
+class TrackedStateBackend:
+    """Collects state_changed() / clear_entries() reports per token until the block writes them."""
+
+    def __init__(self):
+        self._changes = {}  # token -> StateChanges; only the holder of the token's write lock adds to it
+
+    def changed(self, token, name, identifier, sub):
+        self._changes.setdefault(token, StateChanges()).add(name, identifier, sub)
+
+    def cleared(self, token, name):
+        self._changes.setdefault(token, StateChanges()).clear(name)
+
+    def _take_changes(self, token):
+        return self._changes.pop(token, None) or StateChanges()
+
+# =========================
+# State backend
+# =========================
+# Handlers run their token work inside state_backend.token_state(token, names[, identifiers]). The module-level
+# dicts above stay the working copy: the in-process backend leaves them alone, the SQLite backend
+# refreshes them from a shared database at the start of the block and writes changes back at the
+# end, holding a per-token write lock in between so several gunicorn workers (-w N) can share state.
+TOKEN_STATE = {
+    "mobile_otps": mobile_otps,
+    "vehicle_otps": vehicle_otps,
+    "otp_data": otp_data,
+    "client_sessions": client_sessions,
+    "browser_queues": browser_queues,
+    "group_assignments": group_assignments,
+    "login_sessions": login_sessions,
+    "blocked_sims": blocked_sims,
+    "token_processed_mobiles": token_processed_mobiles,
+    "token_mobile_caps": token_mobile_caps,
+    "token_passwords": token_passwords,
+    "token_rate_limits": token_rate_limits,
+}
+# HistoryLog structures, stored as rows instead of one blob (name -> index field)
+HISTORY_STATE = {"otp_data": "sim_number", "login_sessions": "mobile_number"}
+GLOBAL_STATE = ("ADMIN_PASSWORD",)
+
+# Name groups used by the hot paths so they don't load/save unrelated structures
+# (token_rate_limits rides along so admission checks see an admin's change from every worker)
+POLL_STATE = ("mobile_otps", "vehicle_otps", "otp_data", "client_sessions", "browser_queues", "group_assignments",
+              "blocked_sims", "token_rate_limits")
+RECEIVE_STATE = POLL_STATE + ("token_processed_mobiles", "token_mobile_caps")
+LOGIN_STATE = ("login_sessions", "token_rate_limits")
+
+# Per-identifier state: a poll, receive or reaper run for one SIM/vehicle only needs that identifier's stripe
+STRIPED_STATE = ("mobile_otps", "vehicle_otps", "client_sessions", "browser_queues", "group_assignments", "blocked_sims")
+CAP_STATE = ("token_processed_mobiles", "token_mobile_caps")
+LOCK_STRIPES = 64
+
+class TokenLocks:
+    """Locks of one token. Acquired in this order: stripes (by index), caps, history logs."""
+
+    def __init__(self, token, stripes=LOCK_STRIPES):
+        self.token = token
+        self.stripes = [threading.RLock() for _ in range(stripes)]
+        self.caps = threading.RLock()  # processed-mobile set and cap, shared by every SIM of the token
+
+    def stripe_indexes(self, identifiers):
+        return sorted({hash(i) % len(self.stripes) for i in identifiers})
+
+    @contextmanager
+    def hold(self, names, identifiers=None):
+        """identifiers=None means the whole token (admin views, resets, snapshots)."""
+        with ExitStack() as stack:
+            if any(n in STRIPED_STATE for n in names):
+                indexes = range(len(self.stripes)) if identifiers is None else self.stripe_indexes(identifiers)
+                for i in indexes:
+                    stack.enter_context(self.stripes[i])
+            if identifiers is None:
+                if any(n in CAP_STATE for n in names):
+                    stack.enter_context(self.caps)
+                for n in HISTORY_STATE:
+                    if n in names:
+                        stack.enter_context(TOKEN_STATE[n][self.token].lock)
+            yield
+
+token_locks = {t: TokenLocks(t) for t in PREDEFINED_TOKENS}
+
+class InProcessStateBackend:
+    """State lives only in this process, guarded by striped per-token / per-identifier locks."""
+    poll_interval = None  # waiters are woken directly, no need to re-check the store
+
+    def token_state(self, token, names=None, identifiers=None):
+        return token_locks[token].hold(TOKEN_STATE if names is None else names, identifiers)
+
+    @contextmanager
+    def global_state(self):
+        yield
+
+    def changed(self, token, name, identifier, sub):
+        pass
+
+    def cleared(self, token, name):
+        pass
+
+class SqliteStateBackend(TrackedStateBackend):
+    """State shared between processes through one SQLite database (WAL mode) per token.
+
+    Small structures are one pickled blob each and histories one row per record. Keyed entries
+    (ENTRY_STATE) are one row per (name, identifier, sub) stamped with the token's change version:
+    a block loads only the rows of its identifiers (and of the TOKEN_ENTRIES it names) that changed
+    since this process last read them, and writes only the entries it changed. A deleted entry stays behind as a NULL row (tombstone)
+    so other processes see the delete, until it is TOMBSTONE_VERSIONS versions old.
+    """
+    poll_interval = 0.5  # waiters in other processes are not woken directly
+    TOMBSTONE_VERSIONS = 10000
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._seen = {}  # (scope, name) -> what this process last loaded/saved
+        self._entry_versions = {}  # token -> {identifier or (name,): entry version loaded up to, None: the whole token}
+        self._entry_blobs = {}  # (token, name, identifier) -> last loaded/saved IDENTIFIER_ENTRIES row
+
+    def _connect(self, scope):
+        conns = self._local.__dict__.setdefault("conns", {})
+        conn = conns.get(scope)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.directory, f"{scope}.sqlite3"),
+                                   timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, version INTEGER NOT NULL, blob BLOB)")
+            conn.execute("CREATE TABLE IF NOT EXISTS history (name TEXT NOT NULL, seq INTEGER NOT NULL, blob BLOB NOT NULL, PRIMARY KEY (name, seq))")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (name TEXT NOT NULL, identifier TEXT NOT NULL, sub TEXT NOT NULL, "
+                         "version INTEGER NOT NULL, blob BLOB, PRIMARY KEY (name, identifier, sub))")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_by_identifier ON entries (identifier, version)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_by_version ON entries (version)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_by_name ON entries (name, version)")
+            conns[scope] = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self, scope, load, save):
+        conn = self._connect(scope)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            load(conn)
+            yield
+            save(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            # In-memory copies may hold uncommitted changes: force a reload next time
+            for key in [k for k in self._seen if k[0] == scope]:
+                del self._seen[key]
+            if scope in self._entry_versions:
+                self._drop_entries(scope)
+            self._changes.pop(scope, None)
+            raise
+
+    def _version(self, conn, name):
+        row = conn.execute("SELECT version FROM state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _load_blob(self, conn, scope, name, install):
+        row = conn.execute("SELECT version, blob FROM state WHERE name = ?", (name,)).fetchone()
+        seen = self._seen.get((scope, name))
+        if row is None:
+            return
+        if seen is None or seen[0] != row[0]:
+            install(pickle.loads(row[1]))
+            self._seen[(scope, name)] = (row[0], row[1])
+
+    def _save_blob(self, conn, scope, name, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        seen = self._seen.get((scope, name))
+        if seen is not None and seen[1] == blob:
+            return
+        version = self._version(conn, name) + 1
+        conn.execute("INSERT OR REPLACE INTO state (name, version, blob) VALUES (?, ?, ?)", (name, version, blob))
+        self._seen[(scope, name)] = (version, blob)
+
+    def _load_history(self, conn, scope, name, store, token):
+        # Version of a history is bumped whenever it is rewritten (deletes, spills), appends only add rows
+        version = self._version(conn, name)
+        seen = self._seen.get((scope, name))
+        if seen is None or seen[0] != version or seen[2] is not store[token]:
+            store[token] = log = new_history_log(token, name, HISTORY_STATE[name])
+            last_seq = 0
+        else:
+            log, last_seq = seen[2], seen[1]
+        for seq, blob in conn.execute("SELECT seq, blob FROM history WHERE name = ? AND seq > ? ORDER BY seq", (name, last_seq)):
+            log.load(pickle.loads(blob))
+            last_seq = seq
+        self._seen[(scope, name)] = (version, last_seq, log, log.revision)
+
+    def _save_history(self, conn, scope, name, log):
+        version, last_seq, seen_log, seen_revision = self._seen.get((scope, name), (0, 0, None, None))
+        if log is seen_log and log.revision == seen_revision:
+            new = []
+            for record in reversed(log.records):
+                if record.seq <= last_seq:
+                    break
+                new.append(record)
+            new.reverse()
+        else:
+            version += 1
+            conn.execute("INSERT OR REPLACE INTO state (name, version, blob) VALUES (?, ?, NULL)", (name, version))
+            conn.execute("DELETE FROM history WHERE name = ?", (name,))
+            new, last_seq = log.records, 0
+        for record in new:
+            conn.execute("INSERT INTO history (name, seq, blob) VALUES (?, ?, ?)",
+                         (name, record.seq, pickle.dumps(record, pickle.HIGHEST_PROTOCOL)))
+            last_seq = max(last_seq, record.seq)
+        self._seen[(scope, name)] = (version, last_seq, log, log.revision)
+
+    # ---- keyed entries ----
+    def _drop_entries(self, token):
+        for entries in ENTRY_STATE.values():
+            entries.clear(token)
+        self._entry_versions[token] = {}
+        for key in [k for k in self._entry_blobs if k[0] == token]:
+            del self._entry_blobs[key]
+
+    def _apply_entry(self, token, name, identifier, sub, blob):
+        entries = ENTRY_STATE[name]
+        if blob is None:
+            entries.delete(token, identifier, sub)
+        else:
+            # Expiries are run by the reaper of whichever process holds the entry, so one written by
+            # another worker (maybe gone since) gets its hints here
+            value = pickle.loads(blob)
+            previous = entries.get(token, identifier, sub)
+            entries.put(token, identifier, sub, value)
+            reschedule_entry(token, name, identifier, sub, value, previous)
+        if name in IDENTIFIER_ENTRIES:
+            if blob is None:
+                self._entry_blobs.pop((token, name, identifier), None)
+            else:
+                self._entry_blobs[(token, name, identifier)] = blob
+
+    def _load_entries(self, conn, token, names, identifiers):
+        """Bring this process's entries up to date (all of them, or those of `identifiers` plus the
+        TOKEN_ENTRIES in `names`); returns the token's current entry version."""
+        current = self._version(conn, "_entries")
+        purged = self._version(conn, "_entries_purged")
+        versions = self._entry_versions.setdefault(token, {})
+        whole = versions.get(None, 0)
+        if identifiers is None:
+            if whole < current:
+                if whole < purged:
+                    # Deletes older than the purged tombstones would be missed: start over
+                    self._drop_entries(token)
+                    whole = 0
+                for name, identifier, sub, blob in conn.execute(
+                        "SELECT name, identifier, sub, blob FROM entries WHERE version > ? ORDER BY version", (whole,)):
+                    self._apply_entry(token, name, identifier, sub, blob)
+            self._entry_versions[token] = {None: current}
+            return current
+        for identifier in identifiers:
+            since = max(versions.get(identifier, 0), whole)
+            if since >= current:
+                continue
+            if since < purged:
+                for entries in ENTRY_STATE.values():
+                    entries.drop(token, identifier)
+                for name in IDENTIFIER_ENTRIES:
+                    self._entry_blobs.pop((token, name, identifier), None)
+                since = 0
+            for name, sub, blob in conn.execute(
+                    "SELECT name, sub, blob FROM entries WHERE identifier = ? AND version > ? ORDER BY version", (identifier, since)):
+                self._apply_entry(token, name, identifier, sub, blob)
+            versions[identifier] = current
+        for name in TOKEN_ENTRIES:
+            since = max(versions.get((name,), 0), whole)
+            if name not in names or since >= current:
+                continue
+            if since < purged:
+                ENTRY_STATE[name].clear(token)
+                since = 0
+            for identifier, sub, blob in conn.execute(
+                    "SELECT identifier, sub, blob FROM entries WHERE name = ? AND version > ? ORDER BY version", (name, since)):
+                self._apply_entry(token, name, identifier, sub, blob)
+            versions[(name,)] = current
+        return current
+
+    def _save_entries(self, conn, token, names, identifiers, current):
+        changes = self._take_changes(token)
+        for name in changes.cleared:
+            for key in [k for k in self._entry_blobs if k[0] == token and k[1] == name]:
+                del self._entry_blobs[key]
+        rows = []
+        for name, identifier, sub, value in changes.entries(token, names, identifiers):
+            blob = None if value is None else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if name in IDENTIFIER_ENTRIES:
+                key = (token, name, identifier)
+                if self._entry_blobs.get(key) == blob:
+                    continue
+                if blob is None:
+                    del self._entry_blobs[key]
+                else:
+                    self._entry_blobs[key] = blob
+            rows.append((name, identifier, sub, blob))
+        if not rows and not changes.cleared:
+            return
+        version = current + 1
+        conn.execute("INSERT OR REPLACE INTO state (name, version, blob) VALUES ('_entries', ?, NULL)", (version,))
+        for name in changes.cleared:
+            conn.execute("UPDATE entries SET version = ?, blob = NULL WHERE name = ? AND blob IS NOT NULL", (version, name))
+        conn.executemany("INSERT OR REPLACE INTO entries (name, identifier, sub, version, blob) VALUES (?, ?, ?, ?, ?)",
+                         [(name, identifier, sub, version, blob) for name, identifier, sub, blob in rows])
+        # What this block loaded was current, so it is now current as of `version`
+        versions = self._entry_versions[token]
+        if identifiers is None:
+            self._entry_versions[token] = {None: version}
+        else:
+            for identifier in identifiers:
+                versions[identifier] = version
+            for name in TOKEN_ENTRIES:
+                if name in names:
+                    versions[(name,)] = version
+        if version % 1000 == 0 and version > self.TOMBSTONE_VERSIONS:
+            cutoff = version - self.TOMBSTONE_VERSIONS
+            conn.execute("DELETE FROM entries WHERE blob IS NULL AND version <= ?", (cutoff,))
+            conn.execute("INSERT OR REPLACE INTO state (name, version, blob) VALUES ('_entries_purged', ?, NULL)", (cutoff,))
+
+    def token_state(self, token, names=None, identifiers=None):
+        # The database write lock covers the whole token, identifiers only narrow what is loaded
+        names = TOKEN_STATE if names is None else names
+        keyed = any(name in ENTRY_STATE or name in DERIVED_STATE for name in names)
+        current = 0
+
+        def load(conn):
+            nonlocal current
+            if keyed:
+                current = self._load_entries(conn, token, names, identifiers)
+            for name in names:
+                store = TOKEN_STATE[name]
+                if name in HISTORY_STATE:
+                    self._load_history(conn, token, name, store, token)
+                elif name not in ENTRY_STATE and name not in DERIVED_STATE:
+                    self._load_blob(conn, token, name, lambda value: store.__setitem__(token, value))
+
+        def save(conn):
+            for name in names:
+                if name in HISTORY_STATE:
+                    self._save_history(conn, token, name, TOKEN_STATE[name][token])
+                elif name not in ENTRY_STATE and name not in DERIVED_STATE:
+                    self._save_blob(conn, token, name, TOKEN_STATE[name][token])
+            if keyed:
+                self._save_entries(conn, token, names, identifiers, current)
+
+        return self._transaction(token, load, save)
+
+    def global_state(self):
+        module = globals()
+
+        def load(conn):
+            for name in GLOBAL_STATE:
+                self._load_blob(conn, "_global", name, lambda value: module.__setitem__(name, value))
+
+        def save(conn):
+            for name in GLOBAL_STATE:
+                self._save_blob(conn, "_global", name, module[name])
+
+        return self._transaction("_global", load, save)
+
+class JournaledStateBackend(TrackedStateBackend):
+    """State lives in this process; every change is also appended to a journal on disk.
+
+    A block that changed something adds one frame to an in-memory buffer, and a background
+    thread writes and fsyncs the buffer every fsync_interval (group commit), so requests never
+    wait on the disk. Keyed entries (ENTRY_STATE) are journaled as put/del/clear operations on
+    the entries the block changed, histories as appended records and only the small structures
+    as whole values. Now and then the whole state is written as a snapshot and older journal
+    files are dropped: startup loads the latest snapshot and replays only the journal after it.
+    """
+    poll_interval = None  # single process, waiters are woken directly
+
+    def __init__(self, directory, fsync_interval=0.05, snapshot_interval=300, snapshot_bytes=64 << 20):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_bytes = snapshot_bytes
+        # Scopes are always locked in this order (tokens, then _global)
+        self._scope_locks = {scope: threading.RLock() for scope in PREDEFINED_TOKENS + ["_global"]}
+        self._seen = {}  # (scope, name) -> what was last journaled
+        self._entry_blobs = {}  # (token, name, identifier) -> last journaled IDENTIFIER_ENTRIES value
+        self._lock = threading.Lock()     # buffer and current journal file
+        self._io_lock = threading.Lock()  # flush / snapshot
+        self._buffer = bytearray()
+        self._generation = 0
+        self._file = None
+        self._journal_bytes = 0
+        self._last_snapshot = time.monotonic()
+        self._thread = None
+
+    def _path(self, kind, generation):
+        return os.path.join(self.directory, f"{kind}-{generation:012d}.{'pkl' if kind == 'snapshot' else 'log'}")
+
+    def _generations(self, kind):
+        return sorted(int(n[len(kind) + 1:-4]) for n in os.listdir(self.directory)
+                      if n.startswith(kind + "-") and n.endswith(".pkl" if kind == "snapshot" else ".log"))
+
+    # ---- recording ----
+    def _blob_change(self, scope, name, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self._seen.get((scope, name)) == blob:
+            return None
+        self._seen[(scope, name)] = blob
+        return (name, "set", blob)
+
+    def _history_change(self, scope, name, log):
+        seen_log, seen_revision, last_seq = self._seen.get((scope, name), (None, None, 0))
+        if log is seen_log and log.revision == seen_revision:
+            new = []
+            for record in reversed(log.records):
+                if record.seq <= last_seq:
+                    break
+                new.append(record)
+            new.reverse()
+            change = (name, "append", new) if new else None
+        else:
+            change = (name, "reset", list(log.records))
+        self._seen[(scope, name)] = (log, log.revision, log.records[-1].seq if log.records else last_seq)
+        return change
+
+    def _entry_changes(self, token, names, identifiers):
+        changes = self._take_changes(token)
+        for name in changes.cleared:
+            for key in [k for k in self._entry_blobs if k[0] == token and k[1] == name]:
+                del self._entry_blobs[key]
+            yield (name, "clear", None)
+        for name, identifier, sub, value in changes.entries(token, names, identifiers):
+            if name in IDENTIFIER_ENTRIES:
+                key = (token, name, identifier)
+                blob = None if value is None else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                if self._entry_blobs.get(key) == blob:
+                    continue
+                if blob is None:
+                    del self._entry_blobs[key]
+                else:
+                    self._entry_blobs[key] = blob
+            if value is None:
+                yield (name, "del", (identifier, sub))
+            else:
+                yield (name, "put", (identifier, sub, value))
+
+    @contextmanager
+    def _transaction(self, scope, changes):
+        with self._scope_locks[scope]:
+            try:
+                yield
+            finally:
+                # No rollback in memory: whatever the block left behind is what gets journaled
+                frame = [c for c in changes() if c]
+                if frame:
+                    self._append(scope, frame)
+
+    def _append(self, scope, frame):
+        payload = pickle.dumps((scope, frame), pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._buffer += struct.pack("<II", len(payload), zlib.crc32(payload)) + payload
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="otp-journal", daemon=True)
+                self._thread.start()
+
+    def token_state(self, token, names=None, identifiers=None):
+        # Frames of one token must follow the order its changes were made in, so the block holds the token lock
+        names = TOKEN_STATE if names is None else names
+
+        def changes():
+            for name in names:
+                value = TOKEN_STATE[name][token]
+                if name in HISTORY_STATE:
+                    yield self._history_change(token, name, value)
+                elif name not in ENTRY_STATE and name not in DERIVED_STATE:
+                    yield self._blob_change(token, name, value)
+            yield from self._entry_changes(token, names, identifiers)
+
+        return self._transaction(token, changes)
+
+    def global_state(self):
+        module = globals()
+        return self._transaction("_global", lambda: [self._blob_change("_global", n, module[n]) for n in GLOBAL_STATE])
+
+    # ---- disk ----
+    def _run(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.flush()
+                if self._journal_bytes >= self.snapshot_bytes or (
+                        self._journal_bytes and time.monotonic() - self._last_snapshot >= self.snapshot_interval):
+                    self.snapshot()
+            except Exception:
+                app.logger.exception("journal write failed")
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                data, self._buffer = bytes(self._buffer), bytearray()
+                f = self._file
+            if data:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                self._journal_bytes += len(data)
+
+    def snapshot(self):
+        with self._io_lock:
+            # Capture under every scope lock so the snapshot is exactly the state the new journal starts from
+            with ExitStack() as stack:
+                for lock in self._scope_locks.values():
+                    stack.enter_context(lock)
+                state = pickle.dumps({
+                    "tokens": {t: {name: TOKEN_STATE[name][t] for name in TOKEN_STATE} for t in OWNED_TOKENS},
+                    "globals": {name: globals()[name] for name in GLOBAL_STATE},
+                }, pickle.HIGHEST_PROTOCOL)
+                with self._lock:
+                    tail, self._buffer = bytes(self._buffer), bytearray()
+                    old_file = self._file
+                    self._generation += 1
+                    generation = self._generation
+                    self._file = open(self._path("journal", generation), "ab")
+            old_file.write(tail)
+            old_file.flush()
+            os.fsync(old_file.fileno())
+            old_file.close()
+            path = self._path("snapshot", generation)
+            with open(path + ".tmp", "wb") as f:
+                f.write(state)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            # Older files are only dropped once the new snapshot is safely on disk
+            for kind in ("snapshot", "journal"):
+                for old in self._generations(kind):
+                    if old < generation:
+                        os.remove(self._path(kind, old))
+            self._journal_bytes = 0
+            self._last_snapshot = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+
+    # ---- startup ----
+    def _read_frames(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + 8 <= len(data):
+            size, crc = struct.unpack_from("<II", data, pos)
+            payload = data[pos + 8:pos + 8 + size]
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                # Torn write from a crash: everything before it is intact
+                app.logger.warning("journal %s: ignoring %d trailing bytes", path, len(data) - pos)
+                break
+            yield pickle.loads(payload)
+            pos += 8 + size
+        self._journal_bytes += pos
+
+    def _apply(self, scope, frame):
+        for name, kind, value in frame:
+            if scope == "_global":
+                globals()[name] = pickle.loads(value)
+            elif scope not in OWNED_TOKENS:
+                continue
+            elif kind == "set":
+                TOKEN_STATE[name][scope] = pickle.loads(value)
+            elif kind == "put":
+                ENTRY_STATE[name].put(scope, *value)
+            elif kind == "del":
+                ENTRY_STATE[name].delete(scope, *value)
+            elif kind == "clear":
+                ENTRY_STATE[name].clear(scope)
+            else:
+                if kind == "reset":
+                    TOKEN_STATE[name][scope] = new_history_log(scope, name, HISTORY_STATE[name])
+                for record in value:
+                    TOKEN_STATE[name][scope].load(record)
+
+    def recover(self):
+        """Rebuild state from the latest snapshot plus the journal written after it."""
+        snapshots = self._generations("snapshot")
+        base = snapshots[-1] if snapshots else 0
+        if base:
+            with open(self._path("snapshot", base), "rb") as f:
+                state = pickle.load(f)
+            for token, values in state["tokens"].items():
+                if token in OWNED_TOKENS:
+                    for name, value in values.items():
+                        TOKEN_STATE[name][token] = value
+            globals().update(state["globals"])
+        journals = [n for n in self._generations("journal") if n >= base]
+        for generation in journals:
+            path = self._path("journal", generation)
+            if not os.path.getsize(path):
+                os.remove(path)  # restart that never wrote anything
+                continue
+            for scope, frame in self._read_frames(path):
+                self._apply(scope, frame)
+        # Journal only what changes from here on
+        for t in OWNED_TOKENS:
+            for name, store in TOKEN_STATE.items():
+                if name in HISTORY_STATE:
+                    self._history_change(t, name, store[t])
+                elif name in IDENTIFIER_ENTRIES:
+                    for (identifier, _), value in ENTRY_STATE[name].items(t):
+                        self._entry_blobs[(t, name, identifier)] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                elif name not in ENTRY_STATE and name not in DERIVED_STATE:
+                    self._blob_change(t, name, store[t])
+        for name in GLOBAL_STATE:
+            self._blob_change("_global", name, globals()[name])
+        # Always continue in a fresh file, never after a possibly torn tail
+        self._generation = max([base] + journals) + 1
+        self._file = open(self._path("journal", self._generation), "ab")
+        atexit.register(self.close)
+
+@contextmanager
+def all_tokens_state(names=None):
+    # Tokens are always entered in the same order, so concurrent callers cannot deadlock
+    with ExitStack() as stack:
+        for t in OWNED_TOKENS:
+            stack.enter_context(state_backend.token_state(t, names))
+        yield
+
+def with_token_state(names=None):
+    """Run a /<token> view inside state_backend.token_state (unknown tokens are left to the view)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(token, *args, **kwargs):
+            if not valid_token(token):
+                return view(token, *args, **kwargs)
+            with state_backend.token_state(token, names):
+                return view(token, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# OTP_STATE_BACKEND=sqlite (with OTP_STATE_DIR) lets several worker processes share state;
+# OTP_STATE_BACKEND=journal keeps one process but survives restarts
+STATE_BACKEND = os.environ.get("OTP_STATE_BACKEND", "memory").lower()
+if STATE_BACKEND == "sqlite":
+    state_backend = SqliteStateBackend(os.environ.get("OTP_STATE_DIR", "otp_state"))
+    # Admission checks run before a request's block: start from the limits other workers saved
+    with all_tokens_state(("token_rate_limits",)):
+        pass
+elif STATE_BACKEND == "journal":
+    journal_dir = os.environ.get("OTP_STATE_DIR", "otp_state")
+    if "OTP_SHARD_TOKENS" in os.environ:
+        # Each shard process journals only the tokens it owns
+        journal_dir = os.path.join(journal_dir, "shard-" + "-".join(OWNED_TOKENS))
+    state_backend = JournaledStateBackend(
+        journal_dir,
+        fsync_interval=float(os.environ.get("OTP_JOURNAL_FSYNC_MS", 50)) / 1000,
+        snapshot_interval=float(os.environ.get("OTP_JOURNAL_SNAPSHOT_SECONDS", 300)),
+        snapshot_bytes=int(os.environ.get("OTP_JOURNAL_SNAPSHOT_MB", 64)) << 20,
+    )
+    state_backend.recover()
+else:
+    state_backend = InProcessStateBackend()
 
 # =========================
 # Helpers
@@ -41,328 +1496,933 @@ BROWSER_STALE_SECONDS = float(10)
 def valid_token(token: str) -> bool:
     return token in PREDEFINED_TOKENS
 
+def state_changed(token, name, identifier, sub=""):
+    # Report a changed (or removed) keyed entry to the state backend, see ENTRY_STATE
+    state_backend.changed(token, name, identifier, sub)
+
+def clear_entries(token, name):
+    ENTRY_STATE[name].clear(token)
+    state_backend.cleared(token, name)
+
+def add_otp_waiter(token, identifier, waiter=None):
+    # One waiter may be registered under several identifiers (multi-identifier polls)
+    if waiter is None:
+        waiter = threading.Event()
+    with otp_waiters_lock:
+        otp_waiters.setdefault((token, identifier), set()).add(waiter)
+    return waiter
+
+def remove_otp_waiter(token, identifier, waiter):
+    with otp_waiters_lock:
+        waiters = otp_waiters.get((token, identifier))
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del otp_waiters[(token, identifier)]
+
+def wake_otp_waiters(token, identifier):
+    # Only requests held for this identifier are woken
+    with otp_waiters_lock:
+        waiters = list(otp_waiters.get((token, identifier), ()))
+    for waiter in waiters:
+        waiter.set()
+
 def add_browser_to_queue(token, identifier, browser_id):
     queues = browser_queues[token]
     sessions = client_sessions[token]
     if identifier not in queues:
-        queues[identifier] = []
+        queues[identifier] = BrowserQueue()
     if browser_id not in queues[identifier]:
-        queues[identifier].append(browser_id)
-        sessions[(identifier, browser_id)] = {
-            "first_request": datetime.now(IST),
-            "last_request": time.time()
-        }
+        first_request = now_us()
+        queues[identifier].add(browser_id, first_request)
+        sessions[(identifier, browser_id)] = ClientSession(first_request, clock.time())
+        schedule_expiry(clock.time() + BROWSER_STALE_SECONDS, "session", token, identifier, (browser_id, first_request))
     else:
-        sessions[(identifier, browser_id)]["last_request"] = time.time()
+        sessions[(identifier, browser_id)].last_request = clock.time()
+    state_changed(token, "client_sessions", identifier, browser_id)
 
 def get_next_browser(token, identifier):
     queues = browser_queues[token]
-    if identifier in queues and queues[identifier]:
-        return queues[identifier][0]
+    if identifier in queues:
+        return queues[identifier].head()
     return None
 
 def pop_browser_from_queue(token, identifier):
     queues = browser_queues[token]
     if identifier in queues and queues[identifier]:
-        queues[identifier].pop(0)
+        queues[identifier].pop_head()
+        if not queues[identifier]:
+            del queues[identifier]
 
 def mark_otp_removed_to_data(token, entry, reason="stale_browser", browser_id=None):
-    record = entry.copy()
-    record["removed_at"] = datetime.now(IST)
-    record["removed_reason"] = reason
+    # entry has left its pending store: the same object becomes the history record
+    entry.removed_at = now_us()
+    entry.removed_reason = reason
+    count_removed(token, reason)
     if browser_id:
-        record["browser_id"] = browser_id
-    otp_data[token].append(record)
-
-def cleanup_stale_browsers_and_handle_pending(token, identifier):
-    now_ts = time.time()
+        entry.browser_id = browser_id
+    otp_data[token].append(entry)
+
+def block_sim(token, record):
+    # Indexed by seq, not by object: a reloaded or recovered otp_data holds different objects
+    blocked_sims[token].setdefault(record.sim_number or "", set()).add(record.seq)
+    state_changed(token, "blocked_sims", record.sim_number or "")
+
+def unblock_seqs(token, seqs):
+    # Keep the blocked-SIM index in step with limit_exceeded records deleted from otp_data
+    index = blocked_sims[token]
+    for sim in [m for m, blocked in index.items() if not blocked.isdisjoint(seqs)]:
+        index[sim] -= seqs
+        if not index[sim]:
+            del index[sim]
+        state_changed(token, "blocked_sims", sim)
+
+def expire_stale_browser(token, identifier, b):
+    """Drop browser b from the identifier's queue and retire the OTPs that arrived for it."""
     queues = browser_queues[token]
-    sessions = client_sessions[token]
-    if identifier not in queues:
+    if identifier in queues:
+        queues[identifier].remove(b)
+        if not queues[identifier]:
+            del queues[identifier]
+    sess = client_sessions[token].pop((identifier, b), None)
+    if not sess:
         return
-    queue_snapshot = list(queues[identifier])
-    for b in queue_snapshot:
-        sess = sessions.get((identifier, b))
-        if not sess:
-            try:
-                queues[identifier].remove(b)
-            except ValueError:
-                pass
-            sessions.pop((identifier, b), None)
-            continue
-        last = sess.get("last_request", 0)
-        first_req_dt = sess.get("first_request", datetime.now(IST))
-        if now_ts - last > BROWSER_STALE_SECONDS:
-            try:
-                queues[identifier].remove(b)
-            except ValueError:
-                pass
-            sessions.pop((identifier, b), None)
-
-            # If in group assignment, remove from it
-            if identifier in group_assignments[token]:
-                ass = group_assignments[token][identifier]
-                ass['browsers'].discard(b)
-                ass['received'].discard(b)
-                if not ass['browsers']:
-                    # Clean up assignment and remove OTP if still pending
-                    for o in list(mobile_otps[token]):
-                        if o.get("sim_number", "").upper() == identifier.upper() and o["otp"] == ass["otp"]:
-                            mobile_otps[token].remove(o)
-                            break
-                    group_assignments[token].pop(identifier, None)
-
-            for p in list(mobile_otps[token]):
-                if (p.get("sim_number") or "").upper() == identifier.upper() and p["timestamp"] > first_req_dt:
-                    try:
-                        mobile_otps[token].remove(p)
-                    except ValueError:
-                        pass
-                    mark_otp_removed_to_data(token, p, reason="stale_browser", browser_id=b)
-            for p in list(vehicle_otps[token]):
-                if (p.get("vehicle") or "").upper() == identifier.upper() and p["timestamp"] > first_req_dt:
-                    try:
-                        vehicle_otps[token].remove(p)
-                    except ValueError:
-                        pass
-                    mark_otp_removed_to_data(token, p, reason="stale_browser", browser_id=b)
+    state_changed(token, "client_sessions", identifier, b)
+    first_req_us = sess.first_request
+
+    # If in group assignment, remove from it
+    if identifier in group_assignments[token]:
+        ass = group_assignments[token][identifier]
+        ass['browsers'].discard(b)
+        ass['received'].discard(b)
+        if not ass['browsers']:
+            # Clean up assignment and remove OTP if still pending
+            o = mobile_otps[token].find(identifier, ass["otp"])
+            if o is not None:
+                mobile_otps[token].remove(o)
+            group_assignments[token].pop(identifier, None)
+
+    for p in mobile_otps[token].pop_after(identifier, first_req_us):
+        mark_otp_removed_to_data(token, p, reason="stale_browser", browser_id=b)
+    for p in vehicle_otps[token].pop_after(identifier, first_req_us):
+        mark_otp_removed_to_data(token, p, reason="stale_browser", browser_id=b)
+
+def expire_browser_session(token, identifier, browser_id):
+    # Treat the browser as stale right away (e.g. its stream disconnected)
+    if (identifier, browser_id) in client_sessions[token]:
+        expire_stale_browser(token, identifier, browser_id)
+
+def expire_browser_session_now(token, identifier, browser_id):
+    with state_backend.token_state(token, POLL_STATE, (identifier,)):
+        expire_browser_session(token, identifier, browser_id)
 
 def cleanup_group_assignment(token, identifier):
     if identifier not in group_assignments[token]:
         return
     ass = group_assignments[token][identifier]
-    if len(ass['received']) == len(ass['browsers']) or time.time() - ass['assigned_at'] > 10:
+    if len(ass['received']) == len(ass['browsers']) or clock.time() - ass['assigned_at'] > GROUP_ASSIGNMENT_TIMEOUT:
         # Remove OTP if still in pending
-        for o in list(mobile_otps[token]):
-            if o.get("sim_number", "").upper() == identifier.upper() and o["otp"] == ass["otp"]:
-                mobile_otps[token].remove(o)
-                entry = o.copy()
-                break
+        o = mobile_otps[token].find(identifier, ass["otp"])
+        if o is not None:
+            mobile_otps[token].remove(o)
+            entry = o
         else:
-            entry = {
-                "otp": ass["otp"],
-                "sim_number": identifier,
-                "timestamp": ass["original_timestamp"]
-            }
-        entry["browser_id"] = ",".join(ass['browsers'])
+            entry = OtpRecord(ass["otp"], sim_number=identifier, timestamp=ass["original_timestamp"])
+        entry.browser_id = ",".join(ass['browsers'])
         otp_data[token].append(entry)
         # Remove browsers from queue and sessions
         queues = browser_queues[token]
         if identifier in queues:
             for b in list(ass['browsers']):
-                if b in queues[identifier]:
-                    queues[identifier].remove(b)
+                queues[identifier].remove(b)
                 client_sessions[token].pop((identifier, b), None)
+                state_changed(token, "client_sessions", identifier, b)
+            if not queues[identifier]:
+                del queues[identifier]
         group_assignments[token].pop(identifier, None)
+        # The next group may have an OTP that arrived while this one held the SIM
+        wake_otp_waiters(token, identifier)
 
 # =========================
-# API Endpoints (clients)
+# Background reaper
 # =========================
-@app.route('/api/receive-otp', methods=['POST'])
-def receive_otp():
+# Stale browsers, timed-out group assignments and OTPs nobody can claim any more are expired
+# here when they come due, instead of being swept on every poll. Heap entries are only hints:
+# each one is re-checked against the current state and rescheduled if it moved.
+GROUP_ASSIGNMENT_TIMEOUT = float(10)
+reaper_heap = []  # (due, seq, kind, token, identifier, detail)
+reaper_cond = threading.Condition()
+reaper_seq = itertools.count()
+reaper_thread = None
+
+def schedule_expiry(due, kind, token, identifier, detail=None):
+    global reaper_thread
+    with reaper_cond:
+        heapq.heappush(reaper_heap, (due, next(reaper_seq), kind, token, identifier, detail))
+        if reaper_heap[0][0] == due:
+            reaper_cond.notify()
+        if reaper_thread is None and clock.background_reaper:
+            reaper_thread = threading.Thread(target=reaper_loop, name="otp-reaper", daemon=True)
+            reaper_thread.start()
+
+def reap(kind, token, identifier, detail):
+    now_ts = clock.time()
+    if kind == "session":
+        # detail is (browser_id, first_request): a later session of the same browser has its own entry
+        browser_id, first_request = detail
+        sess = client_sessions[token].get((identifier, browser_id))
+        if not sess or sess.first_request != first_request:
+            return
+        if now_ts - sess.last_request > BROWSER_STALE_SECONDS:
+            expire_stale_browser(token, identifier, browser_id)
+        else:
+            schedule_expiry(sess.last_request + BROWSER_STALE_SECONDS + 0.01, kind, token, identifier, detail)
+    elif kind == "assignment":
+        ass = group_assignments[token].get(identifier)
+        # detail is assigned_at, so a newer assignment for the same SIM is left alone
+        if ass and ass["assigned_at"] == detail:
+            cleanup_group_assignment(token, identifier)
+    elif kind == "pending":
+        name, otp, ts = detail
+        store = TOKEN_STATE[name][token]
+        entry = next((e for e in store.for_identifier(identifier) if e.otp == otp and e.timestamp == ts), None)
+        if entry is None:
+            return
+        # Only browsers that started waiting before the OTP arrived can ever receive it;
+        # the queue is in arrival order so the head is the oldest one
+        queue = browser_queues[token].get(identifier)
+        if queue and queue.first_request(queue.head()) < entry.timestamp:
+            schedule_expiry(now_ts + BROWSER_STALE_SECONDS, kind, token, identifier, detail)
+        else:
+            store.remove(entry)
+            mark_otp_removed_to_data(token, entry, reason="unclaimed")
+
+def run_expiry(entry):
+    due, _, kind, token, identifier, detail = entry
     try:
-        data = request.get_json(force=True)
-        otp = (data.get('otp') or "").strip()
-        token = (data.get('token') or "").strip()
-        sim_number = (data.get('sim_number') or "").strip().upper()
-        vehicle = (data.get('vehicle') or "").strip().upper()
-
-        if not otp or not token:
-            return jsonify({"status": "error", "message": "OTP and token required"}), 400
-        if not valid_token(token):
-            return jsonify({"status": "error", "message": "Invalid token"}), 403
-
-        # Enforce mobile cap only for mobiles (not vehicles)
-        if not vehicle:
+        with state_backend.token_state(token, POLL_STATE, (identifier,)):
+            reap(kind, token, identifier, detail)
+    except Exception:
+        app.logger.exception("reaper failed for %s %s/%s", kind, token, identifier)
+
+def next_expiry_due():
+    with reaper_cond:
+        return reaper_heap[0][0] if reaper_heap else None
+
+def run_due_expiries():
+    """Reap everything due by clock.time() in the calling thread (VirtualClock.advance)."""
+    while True:
+        with reaper_cond:
+            if not reaper_heap or reaper_heap[0][0] > clock.time():
+                return
+            entry = heapq.heappop(reaper_heap)
+        run_expiry(entry)
+
+def reaper_loop():
+    while True:
+        with reaper_cond:
+            # Under a VirtualClock expiries are run by advance(): sit idle until the clock changes back
+            while not clock.background_reaper or not reaper_heap or reaper_heap[0][0] > clock.time():
+                reaper_cond.wait(reaper_heap[0][0] - clock.time() if reaper_heap and clock.background_reaper else None)
+            entry = heapq.heappop(reaper_heap)
+        run_expiry(entry)
+
+def reschedule_entry(token, name, identifier, sub, value, previous=None):
+    """Schedule expiry hints for an entry this process did not build itself (recovered at startup or
+    loaded from another worker). `previous` is the entry it replaces, whose hints are still queued."""
+    if name == "client_sessions":
+        if previous is None or previous.first_request != value.first_request:
+            schedule_expiry(value.last_request + BROWSER_STALE_SECONDS + 0.01, "session", token, identifier,
+                            (sub, value.first_request))
+    elif name == "group_assignments":
+        if previous is None or previous["assigned_at"] != value["assigned_at"]:
+            schedule_expiry(value["assigned_at"] + GROUP_ASSIGNMENT_TIMEOUT + 0.01, "assignment", token, identifier,
+                            value["assigned_at"])
+    elif name in ("mobile_otps", "vehicle_otps"):
+        known = {(e.otp, e.timestamp) for e in previous or ()}
+        for entry in value:
+            if (entry.otp, entry.timestamp) not in known:
+                schedule_expiry(entry.timestamp / 1_000_000 + BROWSER_STALE_SECONDS, "pending", token, identifier,
+                                (name, entry.otp, entry.timestamp))
+
+def reschedule_expiries(token):
+    for name in ("client_sessions", "group_assignments", "mobile_otps", "vehicle_otps"):
+        for (identifier, sub), value in list(ENTRY_STATE[name].items(token)):
+            reschedule_entry(token, name, identifier, sub, value)
+
+if STATE_BACKEND == "journal":
+    with all_tokens_state(POLL_STATE):
+        for t in OWNED_TOKENS:
+            reschedule_expiries(t)
+
+# =========================
+# Client API responses
+# =========================
+# Client endpoints answer through json_response() instead of jsonify: constant replies are
+# serialized once, others go through orjson when it is installed, and the CORS headers are set
+# here so flask-cors' after_request hook sees them and skips its own matching. Output is
+# byte-for-byte what jsonify + CORS(app) produced (compact, sorted keys, trailing newline).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    JSON_ENCODER = "orjson"
+
+    def json_body(payload):
+        return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+else:
+    JSON_ENCODER = "json"
+
+    def json_body(payload):
+        return (json.dumps(payload, separators=(",", ":"), sort_keys=True) + "\n").encode()
+
+# Shared reply dicts: returned as is by the handlers, never mutated
+WAITING = {"status": "waiting"}
+OTP_STORED = {"status": "success", "message": "OTP stored"}
+LOGIN_DETECTED = {"status": "success", "message": "Login detected"}
+RATE_LIMITED = {"status": "error", "message": "rate_limited"}
+PRESERIALIZED = {id(p): json_body(p) for p in (WAITING, OTP_STORED, LOGIN_DETECTED, RATE_LIMITED)}
+
+def reply_body(payload):
+    body = PRESERIALIZED.get(id(payload))
+    return json_body(payload) if body is None else body
+
+def json_response(payload, code=200):
+    # Same headers CORS(app) sets with its default options (and asgi.cors_headers)
+    origin = request.headers.get("Origin")
+    if origin:
+        headers = [("Access-Control-Allow-Origin", origin), ("Vary", "Origin")]
+    else:
+        headers = [("Access-Control-Allow-Origin", "*")]
+    return Response(reply_body(payload), code, headers, content_type="application/json")
+
+class ClientSessionInterface(SecureCookieSessionInterface):
+    """Cookie sessions as before, but a request without the cookie (every gateway and browser
+    call) gets an empty session without building the signing serializer first."""
+    def open_session(self, app, request):
+        if app.secret_key and self.get_cookie_name(app) not in request.cookies:
+            return self.session_class()
+        return super().open_session(app, request)
+
+app.session_interface = ClientSessionInterface()
+
+# =========================
+# Rate limits
+# =========================
+# Token buckets in front of receive-otp(-batch), get-latest-otp(s) and login-detect, so a gateway stuck
+# retrying or a browser polling in a tight loop cannot starve the other tokens on the worker.
+# A limit is (requests per second, burst); None is unlimited. Defaults come from OTP_RATE_* as
+# "rate/burst" ("0" to disable) and admins change them per token in the caps view. The limits are
+# token state (saved like the caps and reloaded by every poll, receive and login block); buckets are
+# per process, like the /metrics counters, and shards.py sends a token's change to its shard.
+# The limit names and their labels (RATE_LIMIT_LABELS) live in common.py with the caps panel.
+RATE_BUCKET_IDLE_SECONDS = 60.0  # buckets untouched this long are dropped (a new one starts full)
+
+class RateLimiter:
+    """Token buckets of one token, keyed (limit, browser_id or None), least recently used first."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> [tokens, last refill]
+
+    def take(self, key, rate, burst, now):
+        """Take one request; returns 0 if admitted, else seconds until the bucket holds one."""
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                delay = 0
+            else:
+                delay = (1 - bucket[0]) / rate
+            # Evict from the idle end; at most a few buckets per call
+            for _ in range(2):
+                oldest = next(iter(self.buckets.values()))
+                if now - oldest[1] < RATE_BUCKET_IDLE_SECONDS:
+                    break
+                self.buckets.popitem(last=False)
+            return delay
+
+rate_limiters = {t: RateLimiter() for t in PREDEFINED_TOKENS}
+
+def admission_delay(token, limit, browser_id=None):
+    """0 when the request may go ahead, else seconds to wait. Unknown tokens pass (their handler rejects them)."""
+    limits = token_rate_limits.get(token)
+    if limits is None:
+        return 0
+    # Limits saved before a limit existed fall back to its default
+    limit_value = limits.get(limit, DEFAULT_RATE_LIMITS[limit])
+    if limit_value is None:
+        return 0
+    rate, burst = limit_value
+    delay = rate_limiters[token].take((limit, browser_id), rate, burst, clock.time())
+    if delay:
+        count_rate_limited(token, limit)
+    return delay
+
+def poll_admission_delay(token, browser_id):
+    # The browser's own bucket first, so a runaway browser does not drain the token's bucket
+    return admission_delay(token, "poll_browser", browser_id) or admission_delay(token, "poll")
+
+def retry_after(delay):
+    return str(max(1, math.ceil(delay)))
+
+def rate_limited_response(delay):
+    response = json_response(RATE_LIMITED, 429)
+    response.headers["Retry-After"] = retry_after(delay)
+    return response
+
+# =========================
+# Poll interval hints
+# =========================
+# "waiting" replies to a browser with a session carry poll_after_ms, the delay the server suggests
+# before the next poll. It stays short while an OTP is likely (the browser is next in line and
+# either just started waiting or its identifier gets OTPs often), grows for browsers that are
+# further back, blocked behind another group's assignment, or have waited a long time with
+# nothing arriving, and stretches when the process is busy. It never exceeds HINT_MAX_SECONDS,
+# so a browser that follows it still heartbeats well within BROWSER_STALE_SECONDS. Hints come
+# from a fixed ladder so every hinted reply is preserialized.
+HINT_MIN_SECONDS = 0.25
+HINT_MAX_SECONDS = BROWSER_STALE_SECONDS * 0.4  # leaves room for a slow round trip and client jitter
+HINT_FRESH_SECONDS = 30.0  # an OTP usually follows a browser's first poll within this
+HINT_BLOCKED_SECONDS = 1.0  # another group holds the identifier's OTP until it is fetched or times out
+HINT_MAX_AHEAD = 8  # queue positions counted when a browser is behind the next group
+HINT_LOAD_RPS = float(os.environ.get("OTP_HINT_LOAD_RPS", 1000))  # requests/s per process before hints stretch
+HINT_LADDER_MS = (250, 500, 750, 1000, 1500, 2000, 3000, 4000)
+WAITING_HINTS = {ms: {"status": "waiting", "poll_after_ms": ms} for ms in HINT_LADDER_MS}
+PRESERIALIZED.update((id(p), json_body(p)) for p in WAITING_HINTS.values())
+
+ARRIVALS_PER_TOKEN = 10000  # identifiers whose OTP arrivals are remembered, least recent dropped first
+otp_arrivals = {t: OrderedDict() for t in PREDEFINED_TOKENS}  # identifier -> [last arrival, mean interval]
+otp_arrivals_lock = threading.Lock()
+
+def record_arrival(token, identifier):
+    now = clock.time()
+    with otp_arrivals_lock:
+        arrivals = otp_arrivals[token]
+        seen = arrivals.get(identifier)
+        if seen is None:
+            arrivals[identifier] = [now, None]
+            if len(arrivals) > ARRIVALS_PER_TOKEN:
+                arrivals.popitem(last=False)
+        else:
+            arrivals.move_to_end(identifier)
+            interval = now - seen[0]
+            seen[1] = interval if seen[1] is None else 0.7 * seen[1] + 0.3 * interval
+            seen[0] = now
+
+def otp_expected_soon(token, identifier, now):
+    # Busy identifier: OTPs every few seconds and the next one is about due
+    seen = otp_arrivals[token].get(identifier)
+    return seen is not None and seen[1] is not None and seen[1] < HINT_FRESH_SECONDS and now - seen[0] < 2 * seen[1]
+
+def poll_hint_seconds(token, identifier, browser_id, session_entry, vehicle):
+    now = clock.time()
+    queue = browser_queues[token].get(identifier)
+    ahead = queue.position(browser_id, HINT_MAX_AHEAD) if queue else 0
+    assignment = None if vehicle else group_assignments[token].get(identifier)
+    likely = otp_expected_soon(token, identifier, now)
+    if assignment is not None and browser_id not in assignment["browsers"]:
+        hint = HINT_BLOCKED_SECONDS
+    elif ahead == 0 or (not vehicle and browser_id in queue.leading_group(GROUP_WINDOW_SECONDS)):
+        waited = now - session_entry.first_request / 1_000_000
+        if likely or waited < HINT_FRESH_SECONDS:
+            hint = HINT_MIN_SECONDS
+        else:
+            hint = HINT_MIN_SECONDS + (waited - HINT_FRESH_SECONDS) / HINT_FRESH_SECONDS
+    else:
+        # Each browser ahead needs an OTP of its own first
+        hint = HINT_MIN_SECONDS * (1 + ahead) * (1 if likely else 2)
+    load = recent_request_rate(now) / HINT_LOAD_RPS
+    if load > 1:
+        hint *= min(load, 4)
+    return min(hint, HINT_MAX_SECONDS)
+
+def waiting_reply(token, identifier, browser_id, session_entry, vehicle=""):
+    hint_ms = poll_hint_seconds(token, identifier, browser_id, session_entry, vehicle) * 1000
+    i = bisect_right(HINT_LADDER_MS, hint_ms)
+    return WAITING_HINTS[HINT_LADDER_MS[max(i - 1, 0)]]
+
+# =========================
+# API Endpoints (clients)
+# =========================
+def otp_identifier(sim_number, vehicle):
+    # Queue key an incoming OTP is filed under (see store_otp)
+    return vehicle or sim_number or "UNKNOWNSIM"
+
+def store_otp(token, otp, sim_number, vehicle):
+    """Apply cap, limit_exceeded, group ignore_count and vehicle logic for one incoming OTP."""
+    # Enforce mobile cap only for mobiles (not vehicles)
+    if not vehicle:
+        # The cap counts every SIM of the token, so it has its own lock rather than the SIM's stripe
+        with token_locks[token].caps:
             if sim_number not in token_processed_mobiles[token]:
                 cap = token_mobile_caps[token]
                 if cap is not None and len(token_processed_mobiles[token]) >= cap:
                     # Store directly to otp_data with reason limit_exceeded
-                    entry = {
-                        "otp": otp,
-                        "token": token,
-                        "sim_number": sim_number,
-                        "timestamp": datetime.now(IST),
-                        "removed_reason": "limit_exceeded"
-                    }
+                    entry = OtpRecord(otp, sim_number=sim_number, removed_reason="limit_exceeded")
                     otp_data[token].append(entry)
+                    block_sim(token, entry)
+                    count_removed(token, "limit_exceeded")
                     # App always sees success
-                    return jsonify({"status": "success", "message": "OTP stored"}), 200
+                    return
                 token_processed_mobiles[token].add(sim_number)
+                state_changed(token, "token_processed_mobiles", sim_number)
 
-        entry = {"otp": otp, "token": token, "timestamp": datetime.now(IST)}
-        if vehicle:
-            entry["vehicle"] = vehicle
-            vehicle_otps[token].append(entry)
+    if vehicle:
+        entry = OtpRecord(otp, vehicle=vehicle)
+        record_arrival(token, vehicle)
+        vehicle_otps[token].add(entry)
+        schedule_expiry(clock.time() + BROWSER_STALE_SECONDS, "pending", token, vehicle, ("vehicle_otps", otp, entry.timestamp))
+        wake_otp_waiters(token, vehicle)
+    else:
+        entry = OtpRecord(otp, sim_number=sim_number or "UNKNOWNSIM")
+        record_arrival(token, entry.sim_number)
+        mobile_otps[token].add(entry)
+        # Check if group assignment active, ignore if count >0
+        identifier = entry.sim_number
+        schedule_expiry(clock.time() + BROWSER_STALE_SECONDS, "pending", token, identifier, ("mobile_otps", otp, entry.timestamp))
+        if identifier in group_assignments[token]:
+            ass = group_assignments[token][identifier]
+            if ass.get('ignore_count', 0) > 0:
+                mobile_otps[token].remove(entry)
+                mark_otp_removed_to_data(token, entry, reason="ignored")
+                ass['ignore_count'] -= 1
+            else:
+                wake_otp_waiters(token, identifier)
         else:
-            entry["sim_number"] = sim_number or "UNKNOWNSIM"
-            mobile_otps[token].append(entry)
-            # Check if group assignment active, ignore if count >0
-            identifier = entry["sim_number"]
-            if identifier in group_assignments[token]:
-                ass = group_assignments[token][identifier]
-                if ass.get('ignore_count', 0) > 0:
-                    mobile_otps[token].remove(entry)
-                    mark_otp_removed_to_data(token, entry, reason="ignored")
-                    ass['ignore_count'] -= 1
-                # else keep it
-
-        return jsonify({"status": "success", "message": "OTP stored"}), 200
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 400
+            wake_otp_waiters(token, identifier)
+
+def check_otp_record(data):
+    """Normalize one posted OTP; returns ((otp, token, sim_number, vehicle), None, 200) or (None, message, http_status)."""
+    fields = posted_fields(data, ("otp", "token", "sim_number", "vehicle"))
+    if fields is None:
+        return None, "otp, token, sim_number and vehicle must be strings", 400
+    otp, token, sim_number, vehicle = fields
+    sim_number, vehicle = sim_number.upper(), vehicle.upper()
+
+    if not otp or not token:
+        return None, "OTP and token required", 400
+    if not valid_token(token):
+        return None, "Invalid token", 403
+    return (otp, token, sim_number, vehicle), None, 200
 
-@app.route('/api/get-latest-otp', methods=['GET'])
-def get_latest_otp():
-    token = (request.args.get('token') or "").strip()
-    sim_number = (request.args.get('sim_number') or "").strip().upper()
-    vehicle = (request.args.get('vehicle') or "").strip().upper()
-    browser_id = (request.args.get('browser_id') or "").strip()
+def receive_one_otp(data):
+    """Validate and store one posted OTP; returns (payload, http_status). Shared with asgi.py."""
+    fields, error, code = check_otp_record(data)
+    if error:
+        return {"status": "error", "message": error}, code
+    otp, token, sim_number, vehicle = fields
 
-    if not token or (not sim_number and not vehicle) or not browser_id:
-        return jsonify({"status": "error", "message": "token + sim_number/vehicle + browser_id required"}), 400
-    if not valid_token(token):
-        return jsonify({"status": "error", "message": "Invalid token"}), 403
+    with state_backend.token_state(token, RECEIVE_STATE, (otp_identifier(sim_number, vehicle),)):
+        store_otp(token, otp, sim_number, vehicle)
+    return OTP_STORED, 200
 
+@app.route('/api/receive-otp', methods=['POST'])
+def receive_otp():
+    try:
+        data = request.get_json(force=True)
+        delay = admission_delay(posted_token(data), "receive")
+        if delay:
+            return rate_limited_response(delay)
+        payload, code = receive_one_otp(data)
+        return json_response(payload, code)
+    except Exception as e:
+        return json_response({"status": "error", "message": str(e)}, 400)
+
+@app.route('/api/receive-otp-batch', methods=['POST'])
+def receive_otp_batch():
+    """Many OTPs in one request; results come back per record, in the order they were posted."""
+    try:
+        records = parse_otp_batch(request.get_data(), request.content_type or "")
+    except ValueError as e:
+        return json_response({"status": "error", "message": f"Invalid batch: {e}"}, 400)
+    if len(records) > MAX_BATCH_RECORDS:
+        return json_response({"status": "error", "message": f"At most {MAX_BATCH_RECORDS} records per batch"}, 413)
+
+    results = [None] * len(records)
+    by_token = {}
+    limited = 0
+    for i, data in enumerate(records):
+        if not isinstance(data, dict):
+            results[i] = {"status": "error", "message": "Record must be a JSON object", "code": 400}
+            continue
+        fields, error, code = check_otp_record(data)
+        if error:
+            results[i] = {"status": "error", "message": error, "code": code}
+            continue
+        # Every record takes from its token's batch bucket, sized so a full batch fits
+        delay = admission_delay(fields[1], "receive_batch")
+        if delay:
+            results[i] = {"status": "error", "message": "rate_limited", "code": 429}
+            limited = max(limited, delay)
+        else:
+            by_token.setdefault(fields[1], []).append((i, fields))
+
+    # Each token's state is entered once for all of its records, which are applied in posted order
+    for token, items in by_token.items():
+        identifiers = {otp_identifier(sim_number, vehicle) for _, (_, _, sim_number, vehicle) in items}
+        with state_backend.token_state(token, RECEIVE_STATE, identifiers):
+            for i, (otp, _, sim_number, vehicle) in items:
+                try:
+                    store_otp(token, otp, sim_number, vehicle)
+                    results[i] = {"status": "success", "message": "OTP stored"}
+                except Exception as e:
+                    results[i] = {"status": "error", "message": str(e), "code": 400}
+    stored = sum(1 for r in results if r["status"] == "success")
+    response = json_response({"status": "success", "stored": stored, "results": results}, 200)
+    if limited:
+        response.headers["Retry-After"] = retry_after(limited)
+    return response
+
+def poll_latest_otp(token, sim_number, vehicle, browser_id):
+    """Run one poll for browser_id; returns (payload, http_status)."""
     identifier = sim_number if sim_number else vehicle
     add_browser_to_queue(token, identifier, browser_id)
     cs_key = (identifier, browser_id)
     if cs_key in client_sessions[token]:
-        client_sessions[token][cs_key]["last_request"] = time.time()
+        client_sessions[token][cs_key].last_request = clock.time()
 
-    cleanup_stale_browsers_and_handle_pending(token, identifier)
+    # Stale browsers are expired by the reaper, so this poll only does its own bookkeeping
     session_entry = client_sessions[token].get(cs_key)
     if not session_entry:
-        return jsonify({"status": "waiting"}), 200
-    session_time = session_entry["first_request"]
+        return WAITING, 200
+    session_time = session_entry.first_request
     next_browser = get_next_browser(token, identifier)
 
     if vehicle:
-        new_otps = [o for o in vehicle_otps[token] if o["vehicle"] == vehicle and o["timestamp"] > session_time]
+        new_otps = vehicle_otps[token].after(vehicle, session_time)
         if new_otps and next_browser == browser_id:
             latest = new_otps[0]
-            try:
-                vehicle_otps[token].remove(latest)
-            except ValueError:
-                pass
-            latest["browser_id"] = browser_id
+            record_delivery(token, latest.timestamp, session_time)
+            vehicle_otps[token].remove(latest)
+            latest.browser_id = browser_id
             otp_data[token].append(latest)
             pop_browser_from_queue(token, identifier)
             client_sessions[token].pop(cs_key, None)
-            return jsonify({
+            state_changed(token, "client_sessions", identifier, browser_id)
+            # The next browser in the queue may have an OTP waiting for it
+            wake_otp_waiters(token, identifier)
+            return {
                 "status": "success",
-                "otp": latest["otp"],
-                "vehicle": latest["vehicle"],
+                "otp": latest.otp,
+                "vehicle": latest.vehicle,
                 "browser_id": browser_id,
-                "timestamp": latest["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
-            }), 200
-        return jsonify({"status": "waiting"}), 200
+                "timestamp": format_ts(latest.timestamp)
+            }, 200
+        return waiting_reply(token, identifier, browser_id, session_entry, vehicle), 200
     else:
         # If sim was blocked by limit
-        exceeded = [o for o in otp_data[token] if o.get("sim_number") == sim_number and o.get("removed_reason") == "limit_exceeded"]
-        if exceeded:
-            return jsonify({"status": "error", "message": "limit_exceeded"}), 403
+        if blocked_sims[token].get(sim_number):
+            return {"status": "error", "message": "limit_exceeded"}, 403
 
         # New logic for mobiles with group sharing
         queues = browser_queues[token]
-        queue = queues.get(identifier, [])
+        queue = queues.get(identifier)
         if not queue:
-            return jsonify({"status": "waiting"}), 200
-
-        # Determine leading group
-        first_time = client_sessions[token][(identifier, queue[0])]["first_request"]
-        group = []
-        for b in queue:
-            this_time = client_sessions[token][(identifier, b)]["first_request"]
-            if (this_time - first_time).total_seconds() > 2:
-                break
-            group.append(b)
+            return WAITING, 200
 
         assignment = group_assignments[token].get(identifier, None)
         if assignment:
             if browser_id in assignment["browsers"]:
+                if browser_id not in assignment["received"]:
+                    record_delivery(token, assignment["original_timestamp"], session_time)
                 assignment["received"].add(browser_id)
                 cleanup_group_assignment(token, identifier)
-                return jsonify({
+                return {
                     "status": "success",
                     "otp": assignment["otp"],
                     "sim_number": sim_number,
                     "browser_id": browser_id,
-                    "timestamp": assignment["original_timestamp"].strftime("%Y-%m-%d %H:%M:%S")
-                }), 200
+                    "timestamp": format_ts(assignment["original_timestamp"])
+                }, 200
             else:
-                return jsonify({"status": "waiting"}), 200
+                return waiting_reply(token, identifier, browser_id, session_entry), 200
         else:
-            first_sess_time = client_sessions[token][(identifier, queue[0])]["first_request"]
-            new_otps = [o for o in mobile_otps[token] if o["sim_number"] == sim_number and o["timestamp"] > first_sess_time]
+            first_sess_time = queue.first_request(queue.head())
+            new_otps = mobile_otps[token].after(sim_number, first_sess_time)
             if new_otps:
                 otp_entry = new_otps[0]
                 ignored_count = 0
                 for extra in new_otps[1:]:
-                    try:
-                        mobile_otps[token].remove(extra)
-                    except ValueError:
-                        pass
+                    mobile_otps[token].remove(extra)
                     mark_otp_removed_to_data(token, extra, reason="ignored")
                     ignored_count += 1
-                # Assign to group (do not remove otp_entry yet)
+                # Assign to the leading group (do not remove otp_entry yet)
+                group = queue.leading_group(GROUP_WINDOW_SECONDS)
                 group_set = set(group)
                 group_assignments[token][identifier] = {
-                    "otp": otp_entry["otp"],
+                    "otp": otp_entry.otp,
                     "browsers": group_set,
                     "received": set(),
-                    "assigned_at": time.time(),
-                    "original_timestamp": otp_entry["timestamp"],
+                    "assigned_at": clock.time(),
+                    "original_timestamp": otp_entry.timestamp,
                     "ignore_count": max(0, len(group) - 1 - ignored_count)
                 }
+                schedule_expiry(group_assignments[token][identifier]["assigned_at"] + GROUP_ASSIGNMENT_TIMEOUT + 0.01,
+                                "assignment", token, identifier, group_assignments[token][identifier]["assigned_at"])
+                # Let the other group members that are holding a request pick it up
+                wake_otp_waiters(token, identifier)
                 # If this browser in group, deliver
                 if browser_id in group_set:
+                    record_delivery(token, otp_entry.timestamp, session_time)
                     group_assignments[token][identifier]["received"].add(browser_id)
                     cleanup_group_assignment(token, identifier)
-                    return jsonify({
+                    return {
                         "status": "success",
-                        "otp": otp_entry["otp"],
+                        "otp": otp_entry.otp,
                         "sim_number": sim_number,
                         "browser_id": browser_id,
-                        "timestamp": otp_entry["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
-                    }), 200
-        return jsonify({"status": "waiting"}), 200
+                        "timestamp": format_ts(otp_entry.timestamp)
+                    }, 200
+        return waiting_reply(token, identifier, browser_id, session_entry), 200
 
-@app.route('/api/login-detect', methods=['POST'])
-def login_detect():
+def poll_once(token, sim_number, vehicle, browser_id):
+    identifier = sim_number if sim_number else vehicle
+    with state_backend.token_state(token, POLL_STATE, (identifier,)):
+        return poll_latest_otp(token, sim_number, vehicle, browser_id)
+
+def parse_wait(args):
+    wait = float(args.get('wait') or 0)
+    return min(wait, MAX_POLL_WAIT_SECONDS) if wait > 0 else 0.0
+
+def parse_poll_args(args, with_wait=True):
+    """(token, sim_number, vehicle, browser_id, wait) of a get-latest-otp / otp-stream request,
+    or an (error payload, http_status) as the second item. Shared with asgi.py."""
+    token = (args.get('token') or "").strip()
+    sim_number = (args.get('sim_number') or "").strip().upper()
+    vehicle = (args.get('vehicle') or "").strip().upper()
+    browser_id = (args.get('browser_id') or "").strip()
+
+    if not token or (not sim_number and not vehicle) or not browser_id:
+        return None, ({"status": "error", "message": "token + sim_number/vehicle + browser_id required"}, 400)
+    if not valid_token(token):
+        return None, ({"status": "error", "message": "Invalid token"}, 403)
     try:
-        data = request.get_json(force=True)
-        token = (data.get('token') or "").strip()
-        mobile_number = (data.get('mobile_number') or "").strip().upper()
-        source = (data.get('source') or "").strip().upper()
-
-        if not mobile_number or not token:
-            return jsonify({"status": "error", "message": "mobile_number and token required"}), 400
-        if not valid_token(token):
-            return jsonify({"status": "error", "message": "Invalid token"}), 403
-
-        entry = {"timestamp": datetime.now(IST), "source": source}
-        login_sessions[token].setdefault(mobile_number, []).append(entry)
-        return jsonify({"status": "success", "message": "Login detected"}), 200
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 400
+        wait = parse_wait(args) if with_wait else 0.0
+    except ValueError:
+        return None, ({"status": "error", "message": "wait must be a number of seconds"}, 400)
+    return (token, sim_number, vehicle, browser_id, wait), None
 
-@app.route('/api/login-found', methods=['GET'])
-def login_found():
-    token = (request.args.get('token') or "").strip()
-    mobile_number = (request.args.get('mobile_number') or "").strip().upper()
+@app.route('/api/get-latest-otp', methods=['GET'])
+def get_latest_otp():
+    params, error = parse_poll_args(request.args)
+    if error:
+        return json_response(error[0], error[1])
+    token, sim_number, vehicle, browser_id, wait = params
+    delay = poll_admission_delay(token, browser_id)
+    if delay:
+        return rate_limited_response(delay)
+
+    identifier = sim_number if sim_number else vehicle
+    if not wait:
+        payload, code = poll_once(token, sim_number, vehicle, browser_id)
+        return poll_response(payload, code)
+
+    # Long poll: hold the request until an OTP for this identifier shows up or the wait expires.
+    # Re-polling every half stale period keeps the held request counted as a heartbeat.
+    deadline = time.monotonic() + wait
+    interval = state_backend.poll_interval or BROWSER_STALE_SECONDS / 2
+    while True:
+        waiter = add_otp_waiter(token, identifier)
+        try:
+            payload, code = poll_once(token, sim_number, vehicle, browser_id)
+            remaining = deadline - time.monotonic()
+            if payload["status"] != "waiting" or remaining <= 0:
+                return poll_response(payload, code)
+            waiter.wait(min(remaining, interval))
+        finally:
+            remove_otp_waiter(token, identifier, waiter)
+
+MAX_POLL_IDENTIFIERS = 50
+
+def identifier_list(args, name):
+    # ?vehicles=A,B and ?vehicles=A&vehicles=B are both accepted; duplicates dropped, order kept
+    values = []
+    for value in args.getlist(name):
+        values += [v.strip().upper() for v in value.split(",") if v.strip()]
+    return list(dict.fromkeys(values))
+
+def poll_many(token, sim_numbers, vehicles, browser_id):
+    """Run poll_latest_otp for every identifier of one browser; returns one result per identifier."""
+    results = []
+    for sim_number in sim_numbers:
+        payload, _ = poll_latest_otp(token, sim_number, "", browser_id)
+        results.append({"sim_number": sim_number, **payload})
+    for vehicle in vehicles:
+        payload, _ = poll_latest_otp(token, "", vehicle, browser_id)
+        results.append({"vehicle": vehicle, **payload})
+    if any(r["status"] == "success" for r in results):
+        return {"status": "success", "results": results}
+    hints = [r["poll_after_ms"] for r in results if "poll_after_ms" in r]
+    payload = {"status": "waiting", "results": results}
+    if hints:
+        payload["poll_after_ms"] = min(hints)
+    return payload
+
+def poll_many_once(token, sim_numbers, vehicles, browser_id):
+    with state_backend.token_state(token, POLL_STATE, sim_numbers + vehicles):
+        return poll_many(token, sim_numbers, vehicles, browser_id)
+
+def parse_multi_poll_args(args):
+    """(token, browser_id, sim_numbers, vehicles, wait) of a get-latest-otps request, or an
+    (error payload, http_status) as the second item. Shared with asgi.py."""
+    token = (args.get('token') or "").strip()
+    browser_id = (args.get('browser_id') or "").strip()
+    sim_numbers = identifier_list(args, 'sim_numbers')
+    vehicles = identifier_list(args, 'vehicles')
+
+    if not token or (not sim_numbers and not vehicles) or not browser_id:
+        return None, ({"status": "error", "message": "token + sim_numbers/vehicles + browser_id required"}, 400)
+    if len(sim_numbers) + len(vehicles) > MAX_POLL_IDENTIFIERS:
+        return None, ({"status": "error", "message": f"At most {MAX_POLL_IDENTIFIERS} identifiers per poll"}, 400)
+    if not valid_token(token):
+        return None, ({"status": "error", "message": "Invalid token"}, 403)
+    try:
+        wait = parse_wait(args)
+    except ValueError:
+        return None, ({"status": "error", "message": "wait must be a number of seconds"}, 400)
+    return (token, browser_id, sim_numbers, vehicles, wait), None
+
+@app.route('/api/get-latest-otps', methods=['GET'])
+def get_latest_otps():
+    """
+    get-latest-otp for several SIMs/vehicles of one browser_id in one request:
+    ?token=..&browser_id=..&sim_numbers=S1,S2&vehicles=V1[&wait=seconds]. Every identifier is
+    polled (and heartbeated) each time; a held request returns as soon as any of them has an OTP.
+    """
+    params, error = parse_multi_poll_args(request.args)
+    if error:
+        return json_response(error[0], error[1])
+    token, browser_id, sim_numbers, vehicles, wait = params
+    delay = poll_admission_delay(token, browser_id)
+    if delay:
+        return rate_limited_response(delay)
+
+    deadline = time.monotonic() + wait
+    interval = state_backend.poll_interval or BROWSER_STALE_SECONDS / 2
+    identifiers = sim_numbers + vehicles
+    waiter = threading.Event()
+    for identifier in identifiers:
+        add_otp_waiter(token, identifier, waiter)
+    try:
+        while True:
+            waiter.clear()
+            payload = poll_many_once(token, sim_numbers, vehicles, browser_id)
+            remaining = deadline - time.monotonic()
+            if payload["status"] != "waiting" or remaining <= 0:
+                return poll_response(payload)
+            waiter.wait(min(remaining, interval))
+    finally:
+        for identifier in identifiers:
+            remove_otp_waiter(token, identifier, waiter)
+
+@app.route('/api/otp-stream', methods=['GET'])
+def otp_stream():
+    """
+    Server-Sent Events variant of get-latest-otp. Sends one 'otp' (or 'error') event when
+    the queue logic hands this browser an OTP, then closes. Keepalive comments double as heartbeats.
+    """
+    params, error = parse_poll_args(request.args, with_wait=False)
+    if error:
+        return json_response(error[0], error[1])
+    token, sim_number, vehicle, browser_id, _ = params
+    # A stream is charged as one poll when it opens; its re-checks while open are not
+    delay = poll_admission_delay(token, browser_id)
+    if delay:
+        return rate_limited_response(delay)
+    identifier = sim_number if sim_number else vehicle
+    g.poll_outcome = "stream"
+
+    def events():
+        finished = False
+        interval = state_backend.poll_interval or SSE_KEEPALIVE_SECONDS
+        last_sent = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                waiter = add_otp_waiter(token, identifier)
+                try:
+                    payload, code = poll_once(token, sim_number, vehicle, browser_id)
+                    if payload["status"] != "waiting":
+                        finished = True
+                        event = "otp" if payload["status"] == "success" else "error"
+                        yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+                        return
+                    if not waiter.wait(interval) and time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                        last_sent = time.monotonic()
+                        yield ": keepalive\n\n"
+                finally:
+                    remove_otp_waiter(token, identifier, waiter)
+        finally:
+            # Client went away before getting an OTP: same handling as a stale browser
+            if not finished:
+                expire_browser_session_now(token, identifier, browser_id)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def record_login(data):
+    """Store one login detection; returns (payload, http_status). Shared with asgi.py."""
+    fields = posted_fields(data, ("token", "mobile_number", "source"))
+    if fields is None:
+        return {"status": "error", "message": "token, mobile_number and source must be strings"}, 400
+    token, mobile_number, source = fields
+    mobile_number, source = mobile_number.upper(), source.upper()
+
+    if not mobile_number or not token:
+        return {"status": "error", "message": "mobile_number and token required"}, 400
+    if not valid_token(token):
+        return {"status": "error", "message": "Invalid token"}, 403
+
+    entry = LoginRecord(mobile_number, source)
+    with state_backend.token_state(token, LOGIN_STATE):
+        login_sessions[token].append(entry)
+    return LOGIN_DETECTED, 200
+
+def find_logins(args):
+    """login-found lookup; returns (payload, http_status). Shared with asgi.py."""
+    token = (args.get('token') or "").strip()
+    mobile_number = (args.get('mobile_number') or "").strip().upper()
     if not token or not mobile_number:
-        return jsonify({"status": "error", "message": "token + mobile_number required"}), 400
+        return {"status": "error", "message": "token + mobile_number required"}, 400
     if not valid_token(token):
-        return jsonify({"status": "error", "message": "Invalid token"}), 403
+        return {"status": "error", "message": "Invalid token"}, 403
 
-    if mobile_number in login_sessions[token]:
+    with state_backend.token_state(token, LOGIN_STATE):
+        entries = login_sessions[token].by_keys([mobile_number])[mobile_number]
+    if entries:
         detections = [
-            {"timestamp": e["timestamp"].strftime("%Y-%m-%d %H:%M:%S"), "source": e.get("source","")}
-            for e in login_sessions[token][mobile_number]
+            {"timestamp": format_ts(e.timestamp), "source": e.source or ""}
+            for e in entries
         ]
-        return jsonify({"status": "found", "mobile_number": mobile_number, "detections": detections}), 200
+        return {"status": "found", "mobile_number": mobile_number, "detections": detections}, 200
     else:
-        return jsonify({"status": "not_found", "mobile_number": mobile_number}), 200
+        return {"status": "not_found", "mobile_number": mobile_number}, 200
+
+@app.route('/api/login-detect', methods=['POST'])
+def login_detect():
+    try:
+        data = request.get_json(force=True)
+        delay = admission_delay(posted_token(data), "login")
+        if delay:
+            return rate_limited_response(delay)
+        payload, code = record_login(data)
+        return json_response(payload, code)
+    except Exception as e:
+        return json_response({"status": "error", "message": str(e)}, 400)
+
+@app.route('/api/login-found', methods=['GET'])
+def login_found():
+    payload, code = find_logins(request.args)
+    return json_response(payload, code)
 
 @app.route('/api/check-login-status', methods=['GET'])
 def check_login_status():
@@ -386,25 +2446,281 @@ def check_login_status():
     """
 
 # =========================
-# Admin Login + Dashboard (start)
+# Metrics
 # =========================
-admin_login_page = """
-<html><head><title>Admin Login</title></head>
-<body style="font-family:Segoe UI, Arial, sans-serif;display:flex;justify-content:center;align-items:center;height:100vh;background:#f4f6f9;">
-<div style="background:white;padding:30px;border-radius:10px;box-shadow:0px 8px 30px rgba(0,0,0,0.06);width:380px;">
-<h1 style="text-align:center;color:#2980B9;margin:0;font-size:28px;">ADMIN</h1>
-<p style="text-align:center;color:#2980B9;margin:6px 0 18px;">Log In To Dashboard</p>
-{% if error %}<p style="color:red;text-align:center">{{error}}</p>{% endif %}
-<form method="POST">
-<label style="font-size:13px;color:#333;">Username</label>
-<input type="text" name="username" placeholder="Enter username" required style="width:100%;padding:10px;margin:6px 0 12px;border-radius:6px;border:1px solid #ddd;">
-<label style="font-size:13px;color:#333;">Password</label>
-<input type="password" name="password" placeholder="Enter password" required style="width:100%;padding:10px;margin:6px 0 12px;border-radius:6px;border:1px solid #ddd;">
-<button style="width:100%;padding:12px;background:#2980B9;color:white;border:none;border-radius:6px;font-weight:600;">Login</button>
-</form>
-</div></body></html>
-"""
+# Prometheus text format at /metrics. Recording a request is one bisect and a few dict updates
+# under one lock; the per-token gauges are read from the state only when /metrics is scraped.
+# Counters are per process (each gunicorn worker / shard reports its own).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+REMOVED_REASONS = ("stale_browser", "ignored", "limit_exceeded")
+request_counts = {}  # (route, code, outcome) -> count
+request_latency = {}  # route -> per-bucket counts (last slot +Inf), then the sum
+removed_counts = {(t, r): 0 for t in OWNED_TOKENS for r in REMOVED_REASONS}
+rate_limited_counts = {(t, l): 0 for t in OWNED_TOKENS for l in RATE_LIMIT_LABELS}
+request_rate = [0, 0, 0]  # current second, requests in it, requests in the second before
+metrics_lock = threading.Lock()
+
+def recent_request_rate(now):
+    # Requests finished during the last full second (what the poll hints call server load)
+    second, current, previous = request_rate
+    now = int(now)
+    if now == second:
+        return previous
+    return current if now == second + 1 else 0
+
+def observe_request(route, code, outcome, seconds):
+    """outcome is the payload status of a poll ("waiting", "success", ...), "stream" for SSE, else ""."""
+    slot = bisect_left(LATENCY_BUCKETS, seconds)
+    second = int(clock.time())
+    with metrics_lock:
+        if request_rate[0] != second:
+            request_rate[:] = [second, 0, request_rate[1] if request_rate[0] == second - 1 else 0]
+        request_rate[1] += 1
+        key = (route, code, outcome)
+        request_counts[key] = request_counts.get(key, 0) + 1
+        hist = request_latency.get(route)
+        if hist is None:
+            hist = request_latency[route] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        hist[slot] += 1
+        hist[-1] += seconds
+
+def count_removed(token, reason):
+    with metrics_lock:
+        removed_counts[(token, reason)] = removed_counts.get((token, reason), 0) + 1
+
+def count_rate_limited(token, limit):
+    with metrics_lock:
+        rate_limited_counts[(token, limit)] = rate_limited_counts.get((token, limit), 0) + 1
+
+def poll_response(payload, code=200):
+    g.poll_outcome = payload["status"]
+    return json_response(payload, code)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # g and request are context proxies costing about a microsecond per access: touch each once
+    ctx = g._get_current_object()
+    started = getattr(ctx, "request_started", None)
+    if started is not None:
+        rule = request.url_rule
+        observe_request(rule.rule if rule else "unmatched", response.status_code,
+                        getattr(ctx, "poll_outcome", ""), time.perf_counter() - started)
+    return response
+
+def metric_labels(**labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+def token_gauges(token):
+    with state_backend.token_state(token, POLL_STATE + LOGIN_STATE):
+        queues = browser_queues[token]
+        return {
+            "otp_relay_pending_otps": [({"kind": "mobile"}, len(mobile_otps[token])),
+                                       ({"kind": "vehicle"}, len(vehicle_otps[token]))],
+            "otp_relay_browser_queues": [({}, len(queues))],
+            "otp_relay_browser_queue_depth": [({}, sum(len(q) for q in queues.values()))],
+            "otp_relay_group_assignments": [({}, len(group_assignments[token]))],
+            "otp_relay_otp_data_records": [({}, len(otp_data[token]))],
+            "otp_relay_login_session_records": [({}, len(login_sessions[token]))],
+        }
+
+GAUGE_HELP = {
+    "otp_relay_pending_otps": "OTPs waiting for a browser (mobile_otps / vehicle_otps)",
+    "otp_relay_browser_queues": "Identifiers with a browser queue",
+    "otp_relay_browser_queue_depth": "Browsers queued over all identifiers",
+    "otp_relay_group_assignments": "Active mobile group assignments",
+    "otp_relay_otp_data_records": "otp_data history records held in memory",
+    "otp_relay_login_session_records": "login_sessions history records held in memory",
+}
+
+def metrics_lines():
+    with metrics_lock:
+        counts = sorted(request_counts.items())
+        latency = sorted((route, list(hist)) for route, hist in request_latency.items())
+        removed = sorted(removed_counts.items())
+        limited = sorted(rate_limited_counts.items())
+
+    yield "# HELP otp_relay_requests_total HTTP requests by route, status code and poll outcome"
+    yield "# TYPE otp_relay_requests_total counter"
+    for (route, code, outcome), n in counts:
+        yield f"otp_relay_requests_total{metric_labels(route=route, code=code, outcome=outcome)} {n}"
+
+    yield "# HELP otp_relay_request_duration_seconds Time to the response headers"
+    yield "# TYPE otp_relay_request_duration_seconds histogram"
+    for route, hist in latency:
+        total = 0
+        for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), hist):
+            total += n
+            yield f"otp_relay_request_duration_seconds_bucket{metric_labels(route=route, le=bound)} {total}"
+        yield f"otp_relay_request_duration_seconds_sum{metric_labels(route=route)} {hist[-1]}"
+        yield f"otp_relay_request_duration_seconds_count{metric_labels(route=route)} {total}"
+
+    yield "# HELP otp_relay_otps_removed_total OTPs moved to otp_data without delivery, by removed_reason"
+    yield "# TYPE otp_relay_otps_removed_total counter"
+    for (token, reason), n in removed:
+        yield f"otp_relay_otps_removed_total{metric_labels(token=token, reason=reason)} {n}"
+
+    yield "# HELP otp_relay_rate_limited_total Requests answered 429 by the per-token / per-browser rate limits"
+    yield "# TYPE otp_relay_rate_limited_total counter"
+    for (token, limit), n in limited:
+        yield f"otp_relay_rate_limited_total{metric_labels(token=token, limit=limit)} {n}"
+
+    gauges = {token: token_gauges(token) for token in OWNED_TOKENS}
+    for name, help_text in GAUGE_HELP.items():
+        yield f"# HELP {name} {help_text}"
+        yield f"# TYPE {name} gauge"
+        for token in OWNED_TOKENS:
+            for labels, value in gauges[token][name]:
+                yield f"{name}{metric_labels(token=token, **labels)} {value}"
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Labels carry the tokens, so scraping needs an admin session or OTP_METRICS_KEY as a bearer token
+    key = os.environ.get("OTP_METRICS_KEY")
+    if not session.get("is_admin") and not (key and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {key}")):
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    return Response("\n".join(metrics_lines()) + "\n", mimetype="text/plain; version=0.0.4")
+
+# =========================
+# Delivery latency
+# =========================
+# Every first hand-over of an OTP to a browser (each member of a group counts) records
+# receive->deliver latency and the browser's queue wait (first poll -> delivery). Values go into
+# per-minute sketches kept for DELIVERY_HISTORY_MINUTES; a window merges the minutes it covers.
+# Per process, like the /metrics counters.
+class LatencySketch:
+    """Quantile sketch over log-spaced buckets: fixed memory, about 2% relative error."""
+    GAMMA = 1.04
+    MIN_SECONDS = 0.0005
+    BUCKETS = 450  # top bucket starts around 6 hours
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self):
+        self.counts = {}  # bucket -> count, at most BUCKETS keys
+        self.total = 0
+
+    def add(self, seconds):
+        if seconds <= self.MIN_SECONDS:
+            bucket = 0
+        else:
+            bucket = min(self.BUCKETS - 1, int(math.log(seconds / self.MIN_SECONDS) / self.LOG_GAMMA) + 1)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def merge(self, other):
+        for bucket, n in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.total += other.total
+
+    def quantile(self, q):
+        if not self.total:
+            return None
+        rank = q * (self.total - 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen > rank:
+                break
+        # Geometric middle of the bucket
+        return self.MIN_SECONDS if bucket == 0 else self.MIN_SECONDS * self.GAMMA ** (bucket - 0.5)
+
+DELIVERY_HISTORY_MINUTES = 60
+DELIVERY_WINDOWS = (("1 min", 1), ("5 min", 5), ("15 min", 15), ("1 hour", 60))
+DELIVERY_QUANTILES = (0.5, 0.95, 0.99)
+
+class DeliveryStats:
+    """Per-minute (latency, queue wait) sketches of one token."""
+
+    def __init__(self):
+        self.minutes = {}  # epoch minute -> (latency sketch, wait sketch)
+        self.lock = threading.Lock()
+
+    def record(self, latency, wait, now):
+        minute = int(now // 60)
+        with self.lock:
+            slot = self.minutes.get(minute)
+            if slot is None:
+                slot = self.minutes[minute] = (LatencySketch(), LatencySketch())
+                for old in [m for m in self.minutes if m <= minute - DELIVERY_HISTORY_MINUTES]:
+                    del self.minutes[old]
+            slot[0].add(latency)
+            slot[1].add(wait)
+
+    def window(self, minutes, now):
+        """Merged (latency, wait) sketches of the last `minutes` minutes, the current one included."""
+        latency, wait = LatencySketch(), LatencySketch()
+        first = int(now // 60) - minutes + 1
+        with self.lock:
+            for minute, (l, w) in self.minutes.items():
+                if minute >= first:
+                    latency.merge(l)
+                    wait.merge(w)
+        return latency, wait
+
+delivery_stats = {t: DeliveryStats() for t in PREDEFINED_TOKENS}
+
+def record_delivery(token, received_at, first_request):
+    # received_at / first_request in epoch us
+    now = clock.time()
+    now_us = now * 1_000_000
+    delivery_stats[token].record((now_us - received_at) / 1_000_000, (now_us - first_request) / 1_000_000, now)
+
+def delivery_windows(token):
+    now = clock.time()
+    rows = []
+    for label, minutes in DELIVERY_WINDOWS:
+        latency, wait = delivery_stats[token].window(minutes, now)
+        rows.append({
+            "window": label,
+            "deliveries": latency.total,
+            "latency": {f"p{round(q * 100)}": latency.quantile(q) for q in DELIVERY_QUANTILES},
+            "queue_wait": {f"p{round(q * 100)}": wait.quantile(q) for q in DELIVERY_QUANTILES},
+        })
+    return rows
+
+def format_seconds(value):
+    if value is None:
+        return "-"
+    return f"{value * 1000:.0f} ms" if value < 1 else f"{value:.2f} s"
+
+def render_latency_partial(token, rows):
+    cells = ""
+    for r in rows:
+        cells += f"<tr><td>{r['window']}</td><td style='text-align:center'>{r['deliveries']}</td>"
+        cells += "".join(f"<td>{format_seconds(v)}</td>" for v in r["latency"].values())
+        cells += "".join(f"<td>{format_seconds(v)}</td>" for v in r["queue_wait"].values())
+        cells += "</tr>"
+    return f"""
+    <div class="card">
+        <h3>Delivery Latency - {token}</h3>
+        <table>
+            <tr><th rowspan="2">Window</th><th rowspan="2">Deliveries</th><th colspan="3">Receive &rarr; deliver</th><th colspan="3">Queue wait</th></tr>
+            <tr><th>p50</th><th>p95</th><th>p99</th><th>p50</th><th>p95</th><th>p99</th></tr>
+            {cells}
+        </table>
+        <p class='muted' style="margin-top:10px;">Receive &rarr; deliver runs from receive-otp to the browser getting the OTP; queue wait from the browser's first poll. Each member of a group delivery counts once.</p>
+    </div>
+    """
 
+@app.route('/admin/latency/<token>', methods=['GET'])
+def admin_latency(token):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    if token not in PREDEFINED_TOKENS:
+        return "Invalid token", 404
+    rows = delivery_windows(token)
+    if request.args.get("format") == "json":
+        return jsonify({"token": token, "windows": rows})
+    if request.args.get("embed") == "1":
+        return render_latency_partial(token, rows)
+    return "Not allowed", 403
+
+# =========================
+# Admin Login + Dashboard (start)
+# =========================
 @app.route('/admin-login', methods=['GET','POST'])
 def admin_login():
     global ADMIN_PASSWORD
@@ -412,12 +2728,14 @@ def admin_login():
         user = (request.form.get("username") or "").strip().upper()
         pwd = (request.form.get("password") or "").strip()
         if user != "ADMIN":
-            return render_template_string(admin_login_page, error="Wrong username")
-        if pwd != ADMIN_PASSWORD:
-            return render_template_string(admin_login_page, error="Wrong password")
+            return render_template("admin_login.html", error="Wrong username")
+        with state_backend.global_state():
+            admin_password = ADMIN_PASSWORD
+        if pwd != admin_password:
+            return render_template("admin_login.html", error="Wrong password")
         session["is_admin"] = True
         return redirect(url_for("admin"))
-    return render_template_string(admin_login_page, error=None)
+    return render_template("admin_login.html", error=None)
 
 @app.route('/admin-logout')
 def admin_logout():
@@ -425,52 +2743,85 @@ def admin_logout():
     return redirect(url_for("admin_login"))
 
 # Helper to render token partials (used by both admin embed and token dashboard)
-def render_token_section_partial(token, section):
-    # OTP section with delete forms (works when embedded)
+def page_cursor(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def render_more_row(url, colspan):
+    # Table row that replaces itself with the next page of rows
+    return f"""<tr><td colspan="{colspan}" style="padding:8px;"><button type="button" style="padding:8px 10px;background:#7f8c8d;color:white;border:none;border-radius:6px;" onclick="var r=this.closest('tr');r.innerHTML='<td colspan={colspan}>Loading...</td>';fetch('{url}').then(x=>x.text()).then(h=>{{r.insertAdjacentHTML('afterend',h);r.remove();}});">Load older records</button></td></tr>"""
+
+def json_page_chunks(key, records, cursor, extra=None):
+    # {"<key>": [...], "next_before": cursor, ...extra} written one record at a time
+    yield '{"' + key + '": ['
+    for i, r in enumerate(records):
+        yield ("," if i else "") + history_record_json(r)
+    yield '], "next_before": ' + json.dumps(cursor)
+    for k, v in (extra or {}).items():
+        yield f', "{k}": ' + json.dumps(v)
+    yield "}"
+
+def otp_record_row(e, checkbox_name=None):
+    ts = format_ts(e.timestamp)
+    select = f"<input type='checkbox' name='{checkbox_name}' value='{e.seq}'>" if checkbox_name else ""
+    return f"<tr><td>{select}</td><td>{e.sim_number or ''}</td><td>{e.vehicle or ''}</td><td>{e.otp or ''}</td><td>{e.browser_id or ''}</td><td>{ts}</td><td>{e.removed_reason or ''}</td></tr>"
+
+def login_record_row(e, checkbox_name=None):
+    select = f"<input type='checkbox' name='{checkbox_name}' value='{e.seq}'>" if checkbox_name else ""
+    return f"<tr><td>{select}</td><td>{e.mobile_number or ''}</td><td>{format_ts(e.timestamp)}</td><td>{e.source or ''}</td></tr>"
+
+def history_section_chunks(token, section, before=None, rows_only=False, as_json=False):
+    """Read one page of the otp/login section now (inside the caller's state block) and return
+    an iterator that renders it, so the response can be streamed after the block is left."""
+    log = otp_data[token] if section == "otp" else login_sessions[token]
+    page, cursor = log.page(before)
+    # Spilled records are read-only: only rows still in memory get a delete checkbox
+    first_in_memory = log.records[0].seq if len(log) else log.next_seq
+    if as_json:
+        return json_page_chunks("records", page, cursor)
     if section == "otp":
-        rows = ""
-        for i, e in enumerate(otp_data[token]):
-            ts = e.get("timestamp", e.get("removed_at", datetime.now(IST))).strftime("%Y-%m-%d %H:%M:%S")
-            rows += f"<tr><td><input type='checkbox' name='otp_rows' value='{i}'></td><td>{e.get('sim_number','')}</td><td>{e.get('vehicle','')}</td><td>{e.get('otp','')}</td><td>{e.get('browser_id','')}</td><td>{ts}</td><td>{e.get('removed_reason','')}</td></tr>"
-        partial = f"""
+        return history_html_chunks(token, page, cursor, first_in_memory, rows_only, otp_record_row, "otp_rows",
+                                   "OTP Data", ("Mobile", "Vehicle", "OTP", "Browser", "Date", "Reason"), "No OTPs found",
+                                   "delete_selected_otps", "delete_all_otps")
+    return history_html_chunks(token, page, cursor, first_in_memory, rows_only, login_record_row, "login_rows",
+                               "Login Detections", ("Mobile", "Date", "Source"), "No login detections",
+                               "delete_selected_logins", "delete_all_logins")
+
+def history_html_chunks(token, page, cursor, first_in_memory, rows_only, render_row, checkbox_name,
+                        title, columns, empty, delete_selected, delete_all):
+    section = "otp" if checkbox_name == "otp_rows" else "login"
+    colspan = len(columns) + 1
+    if not rows_only:
+        yield f"""
         <div class="card">
-            <h3>OTP Data - {token}</h3>
-            <form method="POST" action="/status/{token}?embed=1&section=otp">
+            <h3>{title} - {token}</h3>
+            <form method="POST" action="/status/{token}?embed=1&section={section}">
             <table style="width:100%;border-collapse:collapse;">
-                <tr style="background:#2980B9;color:white;"><th>Select</th><th>Mobile</th><th>Vehicle</th><th>OTP</th><th>Browser</th><th>Date</th><th>Reason</th></tr>
-                {rows if rows else '<tr><td colspan="7" style="padding:12px">No OTPs found</td></tr>'}
-            </table>
-            <div style="margin-top:10px;">
-                <button type="submit" name="delete_selected_otps" style="padding:8px 10px;background:#e67e22;color:white;border:none;border-radius:6px;">Delete Selected</button>
-                <button type="submit" name="delete_all_otps" style="padding:8px 10px;background:#c0392b;color:white;border:none;border-radius:6px;margin-left:8px;">Delete All</button>
-            </div>
-            </form>
-        </div>
+                <tr style="background:#2980B9;color:white;"><th>Select</th>{''.join(f'<th>{c}</th>' for c in columns)}</tr>
         """
-        return partial
-
-    # Login section with delete forms
-    if section == "login":
-        rows = ""
-        for m, entries in login_sessions[token].items():
-            for i, e in enumerate(entries):
-                rows += f"<tr><td><input type='checkbox' name='login_rows' value='{m}:{i}'></td><td>{m}</td><td>{e['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}</td><td>{e.get('source','')}</td></tr>"
-        partial = f"""
-        <div class="card">
-            <h3>Login Detections - {token}</h3>
-            <form method="POST" action="/status/{token}?embed=1&section=login">
-            <table style="width:100%;border-collapse:collapse;">
-                <tr style="background:#2980B9;color:white;"><th>Select</th><th>Mobile</th><th>Date</th><th>Source</th></tr>
-                {rows if rows else '<tr><td colspan="4" style="padding:12px">No login detections</td></tr>'}
+        if not page:
+            yield f'<tr><td colspan="{colspan}" style="padding:12px">{empty}</td></tr>'
+    for e in page:
+        yield render_row(e, checkbox_name if e.seq >= first_in_memory else None)
+    if cursor is not None:
+        yield render_more_row(f"/status/{token}?embed=1&section={section}&rows=1&before={cursor}", colspan)
+    if not rows_only:
+        yield f"""
             </table>
             <div style="margin-top:10px;">
-                <button type="submit" name="delete_selected_logins" style="padding:8px 10px;background:#e67e22;color:white;border:none;border-radius:6px;">Delete Selected</button>
-                <button type="submit" name="delete_all_logins" style="padding:8px 10px;background:#c0392b;color:white;border:none;border-radius:6px;margin-left:8px;">Delete All</button>
+                <button type="submit" name="{delete_selected}" style="padding:8px 10px;background:#e67e22;color:white;border:none;border-radius:6px;">Delete Selected</button>
+                <button type="submit" name="{delete_all}" style="padding:8px 10px;background:#c0392b;color:white;border:none;border-radius:6px;margin-left:8px;">Delete All</button>
             </div>
             </form>
         </div>
         """
-        return partial
+
+def render_token_section_partial(token, section):
+    # OTP and login sections (newest first, one page) with delete forms (works when embedded)
+    if section in ("otp", "login"):
+        return "".join(history_section_chunks(token, section))
 
     # Change password partial (for embed and token)
     if section == "change_password":
@@ -491,6 +2842,7 @@ def render_token_section_partial(token, section):
 
 # Admin endpoint to change token password
 @app.route('/admin/change-token-password/<token>', methods=['POST'])
+@with_token_state(("token_passwords",))
 def admin_change_token_password(token):
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
@@ -505,6 +2857,7 @@ def admin_change_token_password(token):
 
 # Admin endpoint to show login details (token username + password) - embed partial
 @app.route('/admin/token-login-details/<token>', methods=['GET'])
+@with_token_state(("token_passwords",))
 def admin_token_login_details(token):
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
@@ -538,30 +2891,31 @@ def admin_master_reset():
         reset_browser_queues = 'browser_queues' in request.form
         reset_all = 'reset_all' in request.form
 
-        if reset_all:
-            for token in PREDEFINED_TOKENS:
-                otp_data[token].clear()
-                login_sessions[token].clear()
-                token_processed_mobiles[token].clear()
-                mobile_otps[token].clear()
-                vehicle_otps[token].clear()
-                browser_queues[token].clear()
-                client_sessions[token].clear()
-        else:
-            for token in PREDEFINED_TOKENS:
-                if reset_otp_data:
+        with all_tokens_state():
+            if reset_all:
+                for token in OWNED_TOKENS:
                     otp_data[token].clear()
-                if reset_login_sessions:
+                    clear_entries(token, "blocked_sims")
                     login_sessions[token].clear()
-                if reset_processed_mobiles:
-                    token_processed_mobiles[token].clear()
-                if reset_mobile_otps:
-                    mobile_otps[token].clear()
-                if reset_vehicle_otps:
-                    vehicle_otps[token].clear()
-                if reset_browser_queues:
-                    browser_queues[token].clear()
-                    client_sessions[token].clear()  # Clear client_sessions if browser_queues is reset
+                    clear_entries(token, "token_processed_mobiles")
+                    clear_entries(token, "mobile_otps")
+                    clear_entries(token, "vehicle_otps")
+                    clear_entries(token, "client_sessions")  # and browser_queues
+            else:
+                for token in OWNED_TOKENS:
+                    if reset_otp_data:
+                        otp_data[token].clear()
+                        clear_entries(token, "blocked_sims")
+                    if reset_login_sessions:
+                        login_sessions[token].clear()
+                    if reset_processed_mobiles:
+                        clear_entries(token, "token_processed_mobiles")
+                    if reset_mobile_otps:
+                        clear_entries(token, "mobile_otps")
+                    if reset_vehicle_otps:
+                        clear_entries(token, "vehicle_otps")
+                    if reset_browser_queues:
+                        clear_entries(token, "client_sessions")  # Clears browser_queues with the sessions
         return redirect(url_for("admin"))
 
     if request.args.get("embed") == "1":
@@ -593,131 +2947,11 @@ def admin_master_reset():
 def admin():
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
-
-    tokens_js_list = "[" + ",".join([f"'{t}'" for t in PREDEFINED_TOKENS]) + "]"
-
-    html = f"""
-    <html>
-    <head>
-        <title>Admin Dashboard</title>
-        <style>
-            body {{ font-family: 'Segoe UI', Arial, sans-serif; margin:0; background:#f4f6f9; }}
-            .app {{ display:flex; min-height:100vh; }}
-            .sidebar {{ width:260px; background:#2C3E50; color:white; padding:22px; box-sizing:border-box; display:flex; flex-direction:column; }}
-            .sidebar h2 {{ margin:0 0 14px; font-size:20px; text-align:center; color:#fff; }}
-            .sidebar a.menu-link {{ display:block; padding:10px; margin-bottom:8px; color:#fff; text-decoration:none; background:rgba(255,255,255,0.03); border-radius:6px; }}
-            .main {{ flex-grow:1; padding:24px; }}
-            .card {{ background:white; padding:16px; border-radius:8px; box-shadow:0px 4px 18px rgba(0,0,0,0.06); margin-bottom:20px; }}
-            table {{ width:100%; border-collapse:collapse; }}
-            table th {{ background:#2980B9; color:white; padding:10px; text-align:left; }}
-            table td {{ padding:10px; border-bottom:1px solid #eee; }}
-            .tokens-grid {{ display:flex; gap:12px; flex-wrap:wrap; }}
-            .token-tile {{ padding:12px;background:#ecf0f1;border-radius:6px;width:160px;text-align:center;cursor:pointer;font-weight:700;color:#2C3E50; }}
-            .muted {{ color:#666; font-size:13px; }}
-            .inline-btn {{ padding:6px 8px;background:#2980B9;color:#fff;border-radius:6px;border:none;cursor:pointer;margin-left:6px; }}
-        </style>
-        <script>
-            function loadTokens() {{
-                var tokens = {tokens_js_list};
-                var html = "<div class='card'><h3>Tokens</h3><div class='tokens-grid'>";
-                tokens.forEach(function(t) {{
-                    html += "<div class='token-tile' onclick=\\"loadTokenFull('" + t + "')\\">" + t + "</div>";
-                }});
-                html += "</div></div>";
-                document.getElementById('content_panel').innerHTML = html;
-            }}
-            function loadTokenFull(token) {{
-                document.getElementById('content_panel').innerHTML = "<div class='card'><p>Loading token dashboard...</p></div>";
-                fetch('/status/' + token + '?embed=admin_full', {{ credentials: 'same-origin' }})
-                    .then(function(r){{ return r.text(); }})
-                    .then(function(html){{ document.getElementById('content_panel').innerHTML = html; }})
-                    .catch(function(e){{ document.getElementById('content_panel').innerHTML = "<div class='card' style='color:red'>Failed to load</div>"; }});
-            }}
-            function loadLimit() {{
-                var tokens = {tokens_js_list};
-                var html = "<div class='card'><h3>Limit Exceeded - Select Token</h3><div class='tokens-grid'>";
-                tokens.forEach(function(t) {{
-                    html += "<div class='token-tile' onclick=\\"loadLimitToken('" + t + "')\\">" + t + "</div>";
-                }});
-                html += "</div></div>";
-                document.getElementById('content_panel').innerHTML = html;
-            }}
-            function loadLimitToken(token) {{
-                document.getElementById('content_panel').innerHTML = "<div class='card'><p>Loading limit-exceeded...</p></div>";
-                fetch('/admin/limit/' + token + '?embed=1', {{ credentials: 'same-origin' }})
-                    .then(function(r){{ return r.text(); }})
-                    .then(function(html){{ document.getElementById('content_panel').innerHTML = html; }})
-                    .catch(function(e){{ document.getElementById('content_panel').innerHTML = "<div class='card' style='color:red'>Failed to load</div>"; }});
-            }}
-            function loadCaps() {{
-                document.getElementById('content_panel').innerHTML = "<div class='card'><p>Loading caps...</p></div>";
-                fetch('/admin/caps?embed=1', {{ credentials: 'same-origin' }})
-                    .then(function(r){{ return r.text(); }})
-                    .then(function(html){{ document.getElementById('content_panel').innerHTML = html; }})
-                    .catch(function(e){{ document.getElementById('content_panel').innerHTML = "<div class='card' style='color:red'>Failed to load</div>"; }});
-            }}
-            function loadAdminChangePassword() {{
-                document.getElementById('content_panel').innerHTML = "<div class='card'><p>Loading...</p></div>";
-                fetch('/admin/change-password?embed=1', {{ credentials: 'same-origin' }})
-                    .then(function(r){{ return r.text(); }})
-                    .then(function(html){{ document.getElementById('content_panel').innerHTML = html; }})
-                    .catch(function(e){{ document.getElementById('content_panel').innerHTML = "<div class='card' style='color:red'>Failed to load</div>"; }});
-            }}
-            function loadMasterReset() {{
-                document.getElementById('content_panel').innerHTML = "<div class='card'><p>Loading...</p></div>";
-                fetch('/admin/master-reset?embed=1', {{ credentials: 'same-origin' }})
-                    .then(function(r){{ return r.text(); }})
-                    .then(function(html){{ document.getElementById('content_panel').innerHTML = html; }})
-                    .catch(function(e){{ document.getElementById('content_panel').innerHTML = "<div class='card' style='color:red'>Failed to load</div>"; }});
-            }}
-            // server time updater (client-side)
-            function updateServerTime() {{
-                var now = new Date();
-                document.getElementById('server_time').innerText = now.toLocaleString();
-            }}
-            setInterval(updateServerTime, 1000);
-            window.onload = function() {{
-                document.getElementById('content_panel').innerHTML = "<div class='card'><h3>Welcome, Admin</h3><p class='muted'>Click TOKENS or other actions on the left to fetch fresh data into this panel.</p></div>";
-                updateServerTime();
-            }};
-            // inject processed mobiles below the caps table
-            function showProcessedMobiles(token) {{
-                var target = document.getElementById('processed_mobiles_container');
-                if (!target) return;
-                target.innerHTML = '<div class="card"><p>Loading...</p></div>';
-                fetch('/admin/processed/' + token + '?embed=1', {{ credentials: 'same-origin' }})
-                    .then(function(r) {{ return r.text(); }})
-                    .then(function(html) {{ target.innerHTML = html; }})
-                    .catch(function(e) {{ target.innerHTML = '<div class="card" style="color:red">Failed to load</div>'; }});
-            }}
-        </script>
-    </head>
-    <body>
-        <div class="app">
-            <div class="sidebar">
-                <h2>ADMIN</h2>
-                <a href="#" class="menu-link" onclick="loadTokens()">TOKENS</a>
-                <a href="#" class="menu-link" onclick="loadLimit()">LIMIT EXCEEDED</a>
-                <a href="#" class="menu-link" onclick="loadCaps()">TOKEN CAPS</a>
-                <a href="#" class="menu-link" onclick="loadAdminChangePassword()">CHANGE ADMIN PASSWORD</a>
-                <a href="#" class="menu-link" onclick="loadMasterReset()">MASTER RESET</a>
-                <a href="/admin-logout" class="menu-link" style="background:#E74C3C;">LOGOUT</a>
-                <div style="margin-top:auto;color:#bdc3c7;font-size:12px;padding-top:12px;">Server time: <span id="server_time"></span></div>
-            </div>
-            <div class="main">
-                <div id="content_panel" class="card">
-                    <h3>Welcome, Admin</h3>
-                    <p class="muted">Use the left menu to view tokens, caps, limit-exceeded items, or reset data. All panels fetch fresh data when clicked.</p>
-                </div>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    return html
+    return render_template("admin.html", tokens=PREDEFINED_TOKENS)
 
 # Admin: limit view and delete (embed=1 partial)
 @app.route('/admin/limit/<token>', methods=['GET','POST'])
+@with_token_state(("otp_data", "blocked_sims"))
 def admin_limit(token):
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
@@ -725,30 +2959,53 @@ def admin_limit(token):
         return "Invalid token", 404
 
     if request.method == 'POST':
+        index = blocked_sims[token]
         if "delete_selected" in request.form:
-            to_delete = [int(x) for x in request.form.getlist("otp_rows")]
-            otp_data[token] = [e for i, e in enumerate(otp_data[token]) if not (i in to_delete and e.get("removed_reason") == "limit_exceeded")]
+            seqs = set(page_cursor(x) for x in request.form.getlist("otp_rows"))
+            seqs &= {s for blocked in index.values() for s in blocked}
+            otp_data[token].delete_seqs(seqs)
+            unblock_seqs(token, seqs)
         elif "delete_all" in request.form:
-            otp_data[token] = [e for e in otp_data[token] if e.get("removed_reason") != "limit_exceeded"]
+            otp_data[token].retain(lambda e: e.removed_reason != "limit_exceeded")
+            clear_entries(token, "blocked_sims")
         if request.args.get("embed") == "1":
             pass
         else:
             return redirect(url_for("admin_limit", token=token))
 
-    rows = ""
-    for i, e in enumerate(otp_data[token]):
-        if e.get("removed_reason") == "limit_exceeded":
-            ts = e.get("timestamp", e.get("removed_at", datetime.now(IST))).strftime("%Y-%m-%d %H:%M:%S")
-            rows += f"<tr><td><input type='checkbox' name='otp_rows' value='{i}'></td><td>{e.get('sim_number','')}</td><td>{e.get('vehicle','')}</td><td>{e.get('otp','')}</td><td>{e.get('browser_id','')}</td><td>{ts}</td></tr>"
+    # Rendered from the blocked-SIM index, newest first, one page at a time, without scanning otp_data
+    before = page_cursor(request.args.get("before"))
+    seqs = heapq.nlargest(HISTORY_PAGE_SIZE + 1, (s for blocked in blocked_sims[token].values() for s in blocked
+                                                  if before is None or s < before))
+    cursor = seqs[HISTORY_PAGE_SIZE - 1] if len(seqs) > HISTORY_PAGE_SIZE else None
+    blocked = otp_data[token].get_seqs(seqs[:HISTORY_PAGE_SIZE])
+    if request.args.get("format") == "json":
+        counts = {m: len(blocked) for m, blocked in blocked_sims[token].items()}
+        return Response(json_page_chunks("records", blocked, cursor, {"blocked": counts}), mimetype="application/json")
 
     if request.args.get("embed") == "1":
-        partial = f"""
+        return Response(limit_html_chunks(token, blocked, cursor, request.args.get("rows") == "1"), mimetype="text/html")
+
+    return f"<html><body><pre>Limit Exceeded for {token}</pre></body></html>"
+
+def limit_html_chunks(token, blocked, cursor, rows_only):
+    if not rows_only:
+        yield f"""
         <div class="card">
             <h3>Limit Exceeded - {token}</h3>
             <form method="POST" action="/admin/limit/{token}?embed=1">
                 <table style="width:100%;border-collapse:collapse;">
                     <tr style="background:#E74C3C;color:white;"><th>Select</th><th>Mobile</th><th>Vehicle</th><th>OTP</th><th>Browser</th><th>Date</th></tr>
-                    {rows if rows else '<tr><td colspan="6" style="padding:12px">No limit-exceeded OTPs</td></tr>'}
+        """
+        if not blocked:
+            yield '<tr><td colspan="6" style="padding:12px">No limit-exceeded OTPs</td></tr>'
+    for e in blocked:
+        ts = format_ts(e.timestamp)
+        yield f"<tr><td><input type='checkbox' name='otp_rows' value='{e.seq}'></td><td>{e.sim_number or ''}</td><td>{e.vehicle or ''}</td><td>{e.otp or ''}</td><td>{e.browser_id or ''}</td><td>{ts}</td></tr>"
+    if cursor is not None:
+        yield render_more_row(f"/admin/limit/{token}?embed=1&rows=1&before={cursor}", 6)
+    if not rows_only:
+        yield """
                 </table>
                 <div style="margin-top:10px;">
                     <button type="submit" name="delete_selected" style="padding:8px 10px;background:#e67e22;color:white;border:none;border-radius:6px;">Delete Selected</button>
@@ -757,36 +3014,24 @@ def admin_limit(token):
             </form>
         </div>
         """
-        return partial
-
-    return f"<html><body><pre>Limit Exceeded for {token}</pre></body></html>"
 
 # Admin: caps view (embed + processed mobile inject)
+def caps_rows(tokens):
+    with metrics_lock:
+        limited = {t: sum(rate_limited_counts.get((t, l), 0) for l in RATE_LIMIT_LABELS) for t in tokens}
+    with all_tokens_state(("token_processed_mobiles", "token_mobile_caps", "token_rate_limits")):
+        return [{"token": t, "processed": len(token_processed_mobiles[t]), "cap": token_mobile_caps[t],
+                 "rate_limits": {**DEFAULT_RATE_LIMITS, **token_rate_limits[t]}, "rate_limited": limited[t]} for t in tokens]
+
 @app.route('/admin/caps', methods=['GET'])
 def admin_caps():
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
+    # format=json is what shards.py merges across token shards
+    if request.args.get("format") == "json":
+        return jsonify({"caps": caps_rows(OWNED_TOKENS)})
     if request.args.get("embed") == "1":
-        rows = ""
-        idx = 0
-        for t in PREDEFINED_TOKENS:
-            rows += f"<tr id='cap_row_{idx}'><td>{t}</td><td style='text-align:center'>{len(token_processed_mobiles[t])}</td><td style='text-align:center'>{token_mobile_caps[t] if token_mobile_caps[t] is not None else 'Unlimited'}</td>"
-            rows += f"<td><form method='POST' action='/admin/update-cap' style='display:inline-block'><input type='hidden' name='token' value='{t}'><input type='number' name='cap' placeholder='Enter cap' style='padding:6px;width:120px;margin-right:6px;'><button type='submit' class='primary' style='padding:6px 10px;background:#2980B9;color:white;border:none;border-radius:4px;'>Set</button></form>"
-            rows += f"<button onclick=\"showProcessedMobiles('{t}')\" style='padding:6px 8px;background:#2ecc71;color:#fff;border-radius:6px;border:none;cursor:pointer;margin-left:8px;'>Processed Mobiles</button></td></tr>"
-            idx += 1
-
-        partial = f"""
-        <div class="card">
-            <h3>Token Mobile Caps</h3>
-            <table style="width:100%;border-collapse:collapse;">
-                <tr style="background:#2980B9;color:white;"><th>Token</th><th>Processed Mobiles</th><th>Cap</th><th>Action</th></tr>
-                {rows}
-            </table>
-            <div id='processed_mobiles_container' style='margin-top:20px;'></div>
-            <p class='muted' style="margin-top:10px;">Click <strong>Processed Mobiles</strong> to load processed mobile data below the table.</p>
-        </div>
-        """
-        return partial
+        return render_caps_partial(caps_rows(OWNED_TOKENS))
     return redirect(url_for("admin"))
 
 @app.route('/admin/update-cap', methods=['POST'])
@@ -796,37 +3041,86 @@ def admin_update_cap():
     t = request.form.get("token")
     cap = request.form.get("cap")
     if t in PREDEFINED_TOKENS:
-        token_mobile_caps[t] = int(cap) if cap else None
+        with state_backend.token_state(t, ("token_mobile_caps",)):
+            token_mobile_caps[t] = int(cap) if cap else None
         return redirect(url_for("admin_caps", embed=1))
     return "Invalid token", 400
 
+@app.route('/admin/update-rate-limits', methods=['POST'])
+def admin_update_rate_limits():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    t = request.form.get("token")
+    if t not in PREDEFINED_TOKENS:
+        return "Invalid token", 400
+    limits = {}
+    for l in RATE_LIMIT_LABELS:
+        rate = request.form.get(f"{l}_rate", "").strip()
+        burst = request.form.get(f"{l}_burst", "").strip()
+        if not rate:
+            limits[l] = None
+            continue
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else max(1.0, rate)
+        except ValueError:
+            return "Invalid rate limit", 400
+        if not (rate > 0 and burst >= 1):
+            return "Invalid rate limit", 400
+        limits[l] = (rate, burst)
+    with state_backend.token_state(t, ("token_rate_limits",)):
+        token_rate_limits[t] = limits
+    return redirect(url_for("admin_caps", embed=1))
+
 @app.route('/admin/processed/<token>', methods=['GET'])
+@with_token_state(("token_processed_mobiles", "otp_data"))
 def admin_processed(token):
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
     if token not in PREDEFINED_TOKENS:
         return "Invalid token", 404
+    # One page of mobiles in sorted order; ?after=<mobile> continues after the last one shown
+    after = request.args.get("after")
+    mobiles = heapq.nsmallest(HISTORY_PAGE_SIZE + 1, (m for m in token_processed_mobiles[token] if after is None or m > after))
+    cursor = mobiles[HISTORY_PAGE_SIZE - 1] if len(mobiles) > HISTORY_PAGE_SIZE else None
+    related = otp_data[token].by_keys(mobiles[:HISTORY_PAGE_SIZE])
+    page = [(m, related[m]) for m in mobiles[:HISTORY_PAGE_SIZE]]
+    if request.args.get("format") == "json":
+        return Response(processed_json_chunks(page, cursor), mimetype="application/json")
     if request.args.get("embed") == "1":
-        rows = ""
-        for m in sorted(token_processed_mobiles[token]):
-            related = [e for e in otp_data[token] if e.get("sim_number")==m]
-            if related:
-                for e in related:
-                    ts = e.get("timestamp", e.get("removed_at", datetime.now(IST))).strftime("%Y-%m-%d %H:%M:%S")
-                    rows += f"<tr><td>{m}</td><td>{e.get('otp','')}</td><td>{e.get('removed_reason','')}</td><td>{ts}</td></tr>"
-            else:
-                rows += f"<tr><td>{m}</td><td></td><td></td><td></td></tr>"
-        partial = f"""
+        return Response(processed_html_chunks(token, page, cursor, request.args.get("rows") == "1"), mimetype="text/html")
+    return "Not allowed", 403
+
+def processed_json_chunks(page, cursor):
+    yield '{"mobiles": ['
+    for i, (m, related) in enumerate(page):
+        yield ("," if i else "") + '{"mobile": ' + json.dumps(m) + ', "records": [' + ",".join(history_record_json(e) for e in related) + "]}"
+    yield '], "next_after": ' + json.dumps(cursor) + "}"
+
+def processed_html_chunks(token, page, cursor, rows_only):
+    if not rows_only:
+        yield f"""
         <div style="padding:12px 0;">
             <h4>Processed mobiles - {token}</h4>
             <table style="width:100%;border-collapse:collapse;">
                 <tr style="background:#2980B9;color:white;"><th>Mobile</th><th>OTP</th><th>Reason</th><th>Date</th></tr>
-                {rows if rows else '<tr><td colspan="4" style="padding:12px">No processed mobiles</td></tr>'}
+        """
+        if not page:
+            yield '<tr><td colspan="4" style="padding:12px">No processed mobiles</td></tr>'
+    for m, related in page:
+        if related:
+            for e in related:
+                ts = format_ts(e.timestamp)
+                yield f"<tr><td>{m}</td><td>{e.otp or ''}</td><td>{e.removed_reason or ''}</td><td>{ts}</td></tr>"
+        else:
+            yield f"<tr><td>{m}</td><td></td><td></td><td></td></tr>"
+    if cursor is not None:
+        yield render_more_row(f"/admin/processed/{token}?embed=1&rows=1&after={quote(cursor)}", 4)
+    if not rows_only:
+        yield """
             </table>
         </div>
         """
-        return partial
-    return "Not allowed", 403
 
 # Admin change password panel (embed)
 @app.route('/admin/change-password', methods=['GET','POST'])
@@ -838,11 +3132,12 @@ def admin_change_password():
         cur = request.form.get("current_password")
         new = request.form.get("new_password")
         conf = request.form.get("confirm_password")
-        if cur != ADMIN_PASSWORD:
-            return "Current password incorrect", 400
-        if new != conf:
-            return "Passwords do not match", 400
-        ADMIN_PASSWORD = new
+        with state_backend.global_state():
+            if cur != ADMIN_PASSWORD:
+                return "Current password incorrect", 400
+            if new != conf:
+                return "Passwords do not match", 400
+            ADMIN_PASSWORD = new
         return "Admin password changed."
     if request.args.get("embed") == "1":
         return """
@@ -861,35 +3156,20 @@ def admin_change_password():
 # =========================
 # Token login/dashboard
 # =========================
-login_page_html = """
-<html><head><title>Login</title></head>
-<body style="font-family:Segoe UI;display:flex;justify-content:center;align-items:center;height:100vh;background:#f4f6f9;">
-<div style="background:white;padding:30px;border-radius:10px;box-shadow:0px 8px 30px rgba(0,0,0,0.06);width:380px;">
-<h1 style="text-align:center;color:#2980B9;margin:0;font-size:28px;">KM OTP</h1>
-<p style="text-align:center;color:#2980B9;margin:6px 0 18px;">Log In To Your Account</p>
-{% if error %}<p style="color:red;text-align:center">{{error}}</p>{% endif %}
-<form method="POST">
-<label style="font-weight:700;color:#333;">Token</label>
-<input type="text" name="token" placeholder="Enter your token" required style="width:100%;padding:10px;margin:6px 0 12px;border-radius:6px;border:1px solid #ddd;">
-<label style="font-weight:700;color:#333;">Password</label>
-<input type="password" name="password" placeholder="Enter password" required style="width:100%;padding:10px;margin:6px 0 12px;border-radius:6px;border:1px solid #ddd;">
-<button style="width:100%;padding:12px;background:#2980B9;color:white;border:none;border-radius:6px;font-weight:700;">Login</button>
-</form>
-</div></body></html>
-"""
-
 @app.route('/login', methods=['GET','POST'])
 def login():
     if request.method == 'POST':
         token = (request.form.get("token") or "").strip()
         pwd = (request.form.get("password") or "").strip()
         if token not in PREDEFINED_TOKENS:
-            return render_template_string(login_page_html, error="Wrong token")
-        if pwd != token_passwords[token]:
-            return render_template_string(login_page_html, error="Wrong password")
+            return render_template("login.html", error="Wrong token")
+        with state_backend.token_state(token, ("token_passwords",)):
+            token_password = token_passwords[token]
+        if pwd != token_password:
+            return render_template("login.html", error="Wrong password")
         session["token"] = token
         return redirect(url_for("status", token=token))
-    return render_template_string(login_page_html, error=None)
+    return render_template("login.html", error=None)
 
 @app.route('/logout')
 def logout():
@@ -897,6 +3177,7 @@ def logout():
     return redirect(url_for("login"))
 
 @app.route('/change-password/<token>', methods=['POST'])
+@with_token_state(("token_passwords",))
 def change_password(token):
     # Only token owner may change their password via token dashboard (not admin)
     if "token" not in session or session["token"] != token:
@@ -915,6 +3196,7 @@ def change_password(token):
 # Token dashboard / partials / admin_full (for admin full token dashboard)
 # =========================
 @app.route('/status/<token>', methods=['GET','POST'])
+@with_token_state()
 def status(token):
     # allow admin direct access OR token-login access
     if not (("token" in session and session["token"] == token) or session.get("is_admin")):
@@ -924,24 +3206,19 @@ def status(token):
     if request.method == 'POST':
         # OTP deletes
         if "delete_selected_otps" in request.form:
-            to_delete = [int(x) for x in request.form.getlist("otp_rows")]
-            otp_data[token] = [e for i, e in enumerate(otp_data[token]) if i not in to_delete]
+            seqs = {int(x) for x in request.form.getlist("otp_rows")}
+            otp_data[token].delete_seqs(seqs)
+            unblock_seqs(token, seqs)
             if request.args.get('embed') == '1':
                 return render_token_section_partial(token, 'otp')
         elif "delete_all_otps" in request.form:
             otp_data[token].clear()
+            clear_entries(token, "blocked_sims")
             if request.args.get('embed') == '1':
                 return render_token_section_partial(token, 'otp')
         # Login deletes
         elif "delete_selected_logins" in request.form:
-            to_delete = request.form.getlist("login_rows")
-            for x in to_delete:
-                m, idx = x.split(":")
-                idx = int(idx)
-                if m in login_sessions[token] and 0 <= idx < len(login_sessions[token][m]):
-                    login_sessions[token][m].pop(idx)
-                    if not login_sessions[token][m]:
-                        login_sessions[token].pop(m)
+            login_sessions[token].delete_seqs(int(x) for x in request.form.getlist("login_rows"))
             if request.args.get('embed') == '1':
                 return render_token_section_partial(token, 'login')
         elif "delete_all_logins" in request.form:
@@ -953,144 +3230,31 @@ def status(token):
         if request.args.get('embed') != '1':
             if request.args.get('embed') == 'admin_full':
                 # Admin full dashboard
-                token_full_html = f"""
-                <div style="display:flex;gap:18px;align-items:flex-start;">
-                    <div style="width:220px;background:#2C3E50;color:#fff;padding:12px;border-radius:8px;">
-                        <h3 style="margin:6px 0 12px;text-align:center;">{token}</h3>
-                        <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#3498DB;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading...</p></div>';fetch('/status/{token}?embed=1&section=otp').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">OTP DATA</button>
-                        <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#3498DB;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading...</p></div>';fetch('/status/{token}?embed=1&section=login').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">LOGIN DETECTIONS</button>
-                        <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#27AE60;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading...</p></div>';fetch('/status/{token}?embed=1&section=change_password').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">CHANGE PASSWORD</button>
-                        <!-- admin-only: show login details -->
-                        <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#9b59b6;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading login details...</p></div>';fetch('/admin/token-login-details/{token}?embed=1').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">LOGIN DETAILS</button>
-                    </div>
-                    <div style="flex:1;" id="token_right_panel">
-                        <!-- initial load OTP partial -->
-                        {render_token_section_partial(token,'otp')}
-                    </div>
-                </div>
-                """
-                return token_full_html
-            else:
-                # Token user dashboard
-                html = f"""
-                <html>
-                <head>
-                    <title>{token} Dashboard</title>
-                    <style>
-                        body {{ font-family: 'Segoe UI', sans-serif; background:#f9f9f9; margin:0; }}
-                        h2 {{ margin:20px 0; text-align:center; color:#2C3E50; }}
-                        .container {{ display:flex; min-height:100vh; }}
-                        .sidebar {{ width:220px; background:#2C3E50; padding:20px; color:white; }}
-                        .sidebar button {{ margin-bottom:15px; width:100%; padding:10px; border:none; background:#3498DB; color:white; cursor:pointer; border-radius:6px; font-weight:700; }}
-                        .content {{ flex-grow:1; padding:30px; }}
-                        .card {{ background:white; padding:16px; border-radius:8px; box-shadow:0px 4px 14px rgba(0,0,0,0.06); }}
-                        table {{ border-collapse: collapse; width:100%; background:white; }}
-                        th, td {{ border:1px solid #ddd; padding:8px; }}
-                        th {{ background:#2980B9; color:white; }}
-                    </style>
-                    <script>
-                        function loadSection(section) {{
-                            var url = window.location.pathname + '?embed=1&section=' + section;
-                            document.getElementById('right_panel').innerHTML = '<div class="card"><p>Loading...</p></div>';
-                            fetch(url, {{ credentials: 'same-origin' }})
-                                .then(function(r){{ return r.text(); }})
-                                .then(function(html){{ document.getElementById('right_panel').innerHTML = html; }})
-                                .catch(function(e){{ document.getElementById('right_panel').innerHTML = '<div class="card" style="color:red">Failed to load</div>'; }});
-                        }}
-                        window.onload = function() {{ loadSection('otp'); }}
-                    </script>
-                </head>
-                <body>
-                    <h2>KM OTP Dashboard ({token})</h2>
-                    <div class="container">
-                        <div class="sidebar">
-                            <button onclick="loadSection('otp')">OTP DATA</button>
-                            <button onclick="loadSection('login')">LOGIN DETECTIONS</button>
-                            <button onclick="loadSection('change_password')">CHANGE PASSWORD</button>
-                            <a href="/logout" style="color:white;text-decoration:none;"><button>LOGOUT</button></a>
-                        </div>
-                        <div class="content">
-                            <div id="right_panel" class="card">
-                                <!-- dynamic content will load here -->
-                            </div>
-                        </div>
-                    </div>
-                </body>
-                </html>
-                """
-                return html
+                return render_template("token_admin_full.html", token=token, otp_section=render_token_section_partial(token, 'otp'))
+            # Token user dashboard
+            return render_template("token_dashboard.html", token=token)
 
     # If embed=1 return partial for requested section
     if request.args.get('embed') == '1':
         section = request.args.get('section', 'otp')
+        if section in ("otp", "login"):
+            # ?before=<seq> pages back, ?rows=1 returns just the rows for "Load older records"
+            as_json = request.args.get('format') == 'json'
+            chunks = history_section_chunks(token, section, page_cursor(request.args.get('before')),
+                                            request.args.get('rows') == '1', as_json)
+            return Response(chunks, mimetype="application/json" if as_json else "text/html")
         return render_token_section_partial(token, section)
 
     # If embed=admin_full -> return full token dashboard (with token sidebar) for admin
     if request.args.get('embed') == 'admin_full':
-        token_full_html = f"""
-        <div style="display:flex;gap:18px;align-items:flex-start;">
-            <div style="width:220px;background:#2C3E50;color:#fff;padding:12px;border-radius:8px;">
-                <h3 style="margin:6px 0 12px;text-align:center;">{token}</h3>
-                <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#3498DB;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading...</p></div>';fetch('/status/{token}?embed=1&section=otp').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">OTP DATA</button>
-                <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#3498DB;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading...</p></div>';fetch('/status/{token}?embed=1&section=login').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">LOGIN DETECTIONS</button>
-                <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#27AE60;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading...</p></div>';fetch('/status/{token}?embed=1&section=change_password').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">CHANGE PASSWORD</button>
-                <button style="width:100%;padding:10px;margin-bottom:8px;border:none;border-radius:6px;background:#9b59b6;color:white;cursor:pointer;" onclick="document.getElementById('token_right_panel').innerHTML='<div class=\\'card\\'><p>Loading login details...</p></div>';fetch('/admin/token-login-details/{token}?embed=1').then(r=>r.text()).then(h=>document.getElementById('token_right_panel').innerHTML=h);">LOGIN DETAILS</button>
-            </div>
-            <div style="flex:1;" id="token_right_panel">
-                {render_token_section_partial(token,'otp')}
-            </div>
-        </div>
-        """
-        return token_full_html
+        return render_template("token_admin_full.html", token=token, otp_section=render_token_section_partial(token, 'otp'))
 
     # Full token dashboard page (for token user)
-    html = f"""
-    <html>
-    <head>
-        <title>{token} Dashboard</title>
-        <style>
-            body {{ font-family: 'Segoe UI', sans-serif; background:#f9f9f9; margin:0; }}
-            h2 {{ margin:20px 0; text-align:center; color:#2C3E50; }}
-            .container {{ display:flex; min-height:100vh; }}
-            .sidebar {{ width:220px; background:#2C3E50; padding:20px; color:white; }}
-            .sidebar button {{ margin-bottom:15px; width:100%; padding:10px; border:none; background:#3498DB; color:white; cursor:pointer; border-radius:6px; font-weight:700; }}
-            .content {{ flex-grow:1; padding:30px; }}
-            .card {{ background:white; padding:16px; border-radius:8px; box-shadow:0px 4px 14px rgba(0,0,0,0.06); }}
-            table {{ border-collapse: collapse; width:100%; background:white; }}
-            th, td {{ border:1px solid #ddd; padding:8px; }}
-            th {{ background:#2980B9; color:white; }}
-        </style>
-        <script>
-            function loadSection(section) {{
-                var url = window.location.pathname + '?embed=1&section=' + section;
-                document.getElementById('right_panel').innerHTML = '<div class="card"><p>Loading...</p></div>';
-                fetch(url, {{ credentials: 'same-origin' }})
-                    .then(function(r){{ return r.text(); }})
-                    .then(function(html){{ document.getElementById('right_panel').innerHTML = html; }})
-                    .catch(function(e){{ document.getElementById('right_panel').innerHTML = '<div class="card" style="color:red">Failed to load</div>'; }});
-            }}
-            window.onload = function() {{ loadSection('otp'); }}
-        </script>
-    </head>
-    <body>
-        <h2>KM OTP Dashboard ({token})</h2>
-        <div class="container">
-            <div class="sidebar">
-                <button onclick="loadSection('otp')">OTP DATA</button>
-                <button onclick="loadSection('login')">LOGIN DETECTIONS</button>
-                <button onclick="loadSection('change_password')">CHANGE PASSWORD</button>
-                <a href="/logout" style="color:white;text-decoration:none;"><button>LOGOUT</button></a>
-            </div>
-            <div class="content">
-                <div id="right_panel" class="card">
-                    <!-- dynamic content will load here -->
-                </div>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    return html
+    return render_template("token_dashboard.html", token=token)
+
+# Compile every page template now rather than on the first request
+for template_name in app.jinja_env.list_templates(extensions=["html"]):
+    app.jinja_env.get_template(template_name)
 
 # =========================
 # Run App
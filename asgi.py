@@ -0,0 +1,334 @@
+"""
+Async (ASGI) front for the client API.
+
+receive-otp, get-latest-otp(s), otp-stream, login-detect and login-found are served natively
+on one event loop; held polls and streams wait on asyncio futures instead of a thread each.
+Everything else (admin UI, dashboards, static files, batch ingestion, CORS preflights) is
+handed to the Flask app in a worker thread, so both share the same in-process state:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+Run a single worker: per-token state lives in this process (or use OTP_STATE_BACKEND=sqlite).
+"""
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict
+import asyncio, io, json, sys, time
+
+import app as core
+
+NATIVE_ROUTES = {}
+
+def route(path, method):
+    def register(handler):
+        NATIVE_ROUTES[(method, path)] = handler
+        return handler
+    return register
+
+class AsyncWaiter:
+    """Loop-side stand-in for threading.Event in otp_waiters: set() may be called from any thread."""
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+    def clear(self):
+        if self.future.done():
+            self.future = self.loop.create_future()
+
+    async def wait(self, timeout):
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+async def run_state(fn, *args):
+    # In-process state is plain memory work and runs on the loop; a shared store means
+    # file I/O and lock waits, so those calls go to a thread
+    if core.state_backend.poll_interval is None:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+# =========================
+# ASGI plumbing
+# =========================
+def request_header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+def cors_headers(scope):
+    # Same headers flask-cors adds to the Flask routes
+    origin = request_header(scope, b"origin")
+    if origin:
+        return [(b"access-control-allow-origin", origin.encode("latin-1")), (b"vary", b"Origin")]
+    return [(b"access-control-allow-origin", b"*")]
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+POLL_ROUTES = ("/api/get-latest-otp", "/api/get-latest-otps")
+
+def observe(scope, code, outcome=""):
+    # Same request metrics the Flask hooks record for the routes it serves
+    core.observe_request(scope["path"], code, outcome, time.perf_counter() - scope["otp_started"])
+
+async def send_json(scope, send, payload, code, extra_headers=()):
+    observe(scope, code, payload.get("status", "") if scope["path"] in POLL_ROUTES else "")
+    body = core.reply_body(payload)
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *extra_headers]
+    await send({"type": "http.response.start", "status": code, "headers": headers + cors_headers(scope)})
+    await send({"type": "http.response.body", "body": body})
+
+async def send_rate_limited(scope, send, delay):
+    await send_json(scope, send, core.RATE_LIMITED, 429, [(b"retry-after", core.retry_after(delay).encode())])
+
+async def watch_disconnect(receive, disconnected, waiter):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    disconnected.set()
+    waiter.set()
+
+def wsgi_environ(scope, body):
+    path = scope.get("raw_path")
+    path = path.split(b"?", 1)[0].decode("latin-1") if path else scope["path"].encode().decode("latin-1")
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": path,
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for key, value in scope["headers"]:
+        name = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            name = "HTTP_" + name
+            environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+async def flask_bridge(scope, receive, send):
+    """Run the request through the Flask app in a worker thread, streaming its body back."""
+    environ = wsgi_environ(scope, await read_body(receive))
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def put(*item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def run():
+        def start_response(status, headers, exc_info=None):
+            put("start", int(status.split(" ", 1)[0]),
+                [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers])
+        try:
+            result = core.app(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        put("body", chunk)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        finally:
+            put("end")
+
+    worker = loop.run_in_executor(None, run)
+    started = False
+    while True:
+        item = await queue.get()
+        if item[0] == "start":
+            await send({"type": "http.response.start", "status": item[1], "headers": item[2]})
+            started = True
+        elif item[0] == "body":
+            await send({"type": "http.response.body", "body": item[1], "more_body": True})
+        else:
+            break
+    await worker
+    if not started:
+        await send({"type": "http.response.start", "status": 500, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    handler = NATIVE_ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        return await flask_bridge(scope, receive, send)
+    scope["otp_started"] = time.perf_counter()
+    args = MultiDict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+    await handler(scope, receive, send, args)
+
+# =========================
+# Client API
+# =========================
+@route('/api/receive-otp', 'POST')
+async def receive_otp(scope, receive, send, args):
+    try:
+        data = json.loads(await read_body(receive))
+        delay = core.admission_delay(core.posted_token(data), "receive")
+        if delay:
+            return await send_rate_limited(scope, send, delay)
+        payload, code = await run_state(core.receive_one_otp, data)
+    except Exception as e:
+        payload, code = {"status": "error", "message": str(e)}, 400
+    await send_json(scope, send, payload, code)
+
+@route('/api/get-latest-otp', 'GET')
+async def get_latest_otp(scope, receive, send, args):
+    params, error = core.parse_poll_args(args)
+    if error:
+        return await send_json(scope, send, *error)
+    token, sim_number, vehicle, browser_id, wait = params
+    delay = core.poll_admission_delay(token, browser_id)
+    if delay:
+        return await send_rate_limited(scope, send, delay)
+    identifier = sim_number if sim_number else vehicle
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    interval = core.state_backend.poll_interval or core.BROWSER_STALE_SECONDS / 2
+    waiter = AsyncWaiter(loop)
+    core.add_otp_waiter(token, identifier, waiter)
+    try:
+        while True:
+            waiter.clear()
+            payload, code = await run_state(core.poll_once, token, sim_number, vehicle, browser_id)
+            remaining = deadline - loop.time()
+            if payload["status"] != "waiting" or remaining <= 0:
+                break
+            await waiter.wait(min(remaining, interval))
+    finally:
+        core.remove_otp_waiter(token, identifier, waiter)
+    await send_json(scope, send, payload, code)
+
+@route('/api/get-latest-otps', 'GET')
+async def get_latest_otps(scope, receive, send, args):
+    params, error = core.parse_multi_poll_args(args)
+    if error:
+        return await send_json(scope, send, *error)
+    token, browser_id, sim_numbers, vehicles, wait = params
+    delay = core.poll_admission_delay(token, browser_id)
+    if delay:
+        return await send_rate_limited(scope, send, delay)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    interval = core.state_backend.poll_interval or core.BROWSER_STALE_SECONDS / 2
+    identifiers = sim_numbers + vehicles
+    waiter = AsyncWaiter(loop)
+    for identifier in identifiers:
+        core.add_otp_waiter(token, identifier, waiter)
+    try:
+        while True:
+            waiter.clear()
+            payload = await run_state(core.poll_many_once, token, sim_numbers, vehicles, browser_id)
+            remaining = deadline - loop.time()
+            if payload["status"] != "waiting" or remaining <= 0:
+                break
+            await waiter.wait(min(remaining, interval))
+    finally:
+        for identifier in identifiers:
+            core.remove_otp_waiter(token, identifier, waiter)
+    await send_json(scope, send, payload, 200)
+
+@route('/api/otp-stream', 'GET')
+async def otp_stream(scope, receive, send, args):
+    params, error = core.parse_poll_args(args, with_wait=False)
+    if error:
+        return await send_json(scope, send, *error)
+    token, sim_number, vehicle, browser_id, _ = params
+    # A stream is charged as one poll when it opens; its re-checks while open are not
+    delay = core.poll_admission_delay(token, browser_id)
+    if delay:
+        return await send_rate_limited(scope, send, delay)
+    identifier = sim_number if sim_number else vehicle
+
+    headers = [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"),
+               (b"x-accel-buffering", b"no")]
+    observe(scope, 200, "stream")
+    await send({"type": "http.response.start", "status": 200, "headers": headers + cors_headers(scope)})
+
+    async def event(text, more=True):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": more})
+
+    loop = asyncio.get_running_loop()
+    interval = core.state_backend.poll_interval or core.SSE_KEEPALIVE_SECONDS
+    last_sent = time.monotonic()
+    finished = False
+    waiter = AsyncWaiter(loop)
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(watch_disconnect(receive, disconnected, waiter))
+    core.add_otp_waiter(token, identifier, waiter)
+    try:
+        await event("retry: 3000\n\n")
+        while not disconnected.is_set():
+            waiter.clear()
+            payload, code = await run_state(core.poll_once, token, sim_number, vehicle, browser_id)
+            if payload["status"] != "waiting":
+                finished = True
+                name = "otp" if payload["status"] == "success" else "error"
+                await event(f"event: {name}\ndata: {json.dumps(payload)}\n\n", more=False)
+                return
+            if not await waiter.wait(interval) and time.monotonic() - last_sent >= core.SSE_KEEPALIVE_SECONDS:
+                last_sent = time.monotonic()
+                await event(": keepalive\n\n")
+    finally:
+        watcher.cancel()
+        core.remove_otp_waiter(token, identifier, waiter)
+        # Client went away before getting an OTP: same handling as a stale browser
+        if not finished:
+            await run_state(core.expire_browser_session_now, token, identifier, browser_id)
+
+@route('/api/login-detect', 'POST')
+async def login_detect(scope, receive, send, args):
+    try:
+        data = json.loads(await read_body(receive))
+        delay = core.admission_delay(core.posted_token(data), "login")
+        if delay:
+            return await send_rate_limited(scope, send, delay)
+        payload, code = await run_state(core.record_login, data)
+    except Exception as e:
+        payload, code = {"status": "error", "message": str(e)}, 400
+    await send_json(scope, send, payload, code)
+
+@route('/api/login-found', 'GET')
+async def login_found(scope, receive, send, args):
+    payload, code = await run_state(core.find_logins, args)
+    await send_json(scope, send, payload, code)
@@ -0,0 +1,664 @@
+"""
+Load generator / benchmark for the OTP relay.
+
+Simulates gateway phones posting OTPs to /api/receive-otp, a group of browsers per SIM polling
+/api/get-latest-otp with jitter, and admin dashboard readers. Prints one JSON report
+(throughput, latency percentiles, delivery correctness, memory) so runs can be compared
+between commits:
+
+    python bench.py                                  # in-process, Flask test client
+    python bench.py --serve waitress                 # spawns a real server and drives it over HTTP
+    python bench.py --url http://127.0.0.1:8000 --pid 1234
+    python bench.py --out new.json --compare old.json
+    python bench.py --virtual --rounds 500 --abandon 0.2   # simulated time, deterministic per --seed
+
+Each round, every SIM gets --browsers fresh browsers that join within --join-spread seconds
+(inside the 2 s group window) and then one OTP from its gateway. A correct run delivers every OTP
+to every browser of its group exactly once: nothing lost, nothing stale or foreign. --abandon
+makes a share of the browsers vanish after their first poll (stale-browser churn); they are
+not expected to get anything, and the SIM's next round starts once they have gone stale.
+
+Browsers wait as long as the poll_after_ms hint of a "waiting" reply suggests (--ignore-hints:
+always a random --poll-min..--poll-max). --idle-browsers adds browsers per gateway that wait on
+SIMs which never get an OTP; their polls are reported under "/api/get-latest-otp (idle)", so the
+two modes can be compared on poll volume as well as delivery latency.
+
+--virtual runs the same scenario as discrete events in one thread on app.VirtualClock: waits
+cost nothing, so hours of simulated polling finish in seconds, and a seed replays exactly.
+
+--record-memory N skips the load run and reports the heap cost of N pending/history OTPs,
+client sessions and login detections, as the dicts earlier builds kept and as app's slotted
+records, scaled to bytes per million.
+
+--response-overhead N also skips the load run: it calls the WSGI app directly N times per client
+route (no HTTP, no test client) and reports microseconds per request, to compare response paths.
+"""
+import argparse, heapq, http.client, itertools, json, os, random, resource, socket, subprocess, sys, threading, time, tracemalloc
+from urllib.parse import urlsplit
+
+# app.BROWSER_STALE_SECONDS: an abandoned browser heads its SIM's queue until then, so the next
+# round on that SIM waits it out (otherwise the new browsers would rightly miss their OTP)
+STALE_SECONDS = 10.0
+
+# =========================
+# Targets
+# =========================
+class TestClientTarget:
+    """Drives app.py in this process through Flask's test client (one client per thread)."""
+    name = "testclient"
+
+    def __init__(self):
+        import app
+        self.app = app.app
+        self._local = threading.local()
+
+    def client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def request(self, method, path, body=None, form=None):
+        if form is not None:
+            r = self.client().open(path, method=method, data=form)
+        else:
+            r = self.client().open(path, method=method, json=body)
+        return r.status_code, r.get_data()
+
+    def rss_bytes(self):
+        return process_rss(os.getpid())
+
+class HttpTarget:
+    """Drives a running server over HTTP (keep-alive connection per thread, cookies per thread)."""
+    name = "http"
+
+    def __init__(self, url, pid=None):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.pid = pid
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, form=None):
+        local = self._local
+        headers = {}
+        if getattr(local, "cookie", None):
+            headers["Cookie"] = local.cookie
+        if form is not None:
+            from urllib.parse import urlencode
+            data = urlencode(form).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        else:
+            data = None
+        for attempt in (0, 1):
+            if getattr(local, "conn", None) is None:
+                local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                local.conn.request(method, path, body=data, headers=headers)
+                resp = local.conn.getresponse()
+                payload = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                local.conn.close()
+                local.conn = None
+                if attempt:
+                    raise
+        cookie = resp.getheader("Set-Cookie")
+        if cookie:
+            local.cookie = cookie.split(";", 1)[0]
+        return resp.status, payload
+
+    def rss_bytes(self):
+        return process_rss(self.pid) if self.pid else None
+
+def process_rss(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        if pid == os.getpid():
+            # No procfs (macOS): peak RSS is the best we have
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+        return None
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def spawn_server(kind, port):
+    here = os.path.dirname(os.path.abspath(__file__))
+    if kind == "waitress":
+        cmd = [sys.executable, "-m", "waitress", f"--port={port}", "--threads=16", "app:app"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=here, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"{kind} server did not start on port {port}")
+
+# =========================
+# Recording
+# =========================
+class Recorder:
+    def __init__(self, target):
+        self.target = target
+        self.lock = threading.Lock()
+        self.latency = {}  # route -> [seconds]
+        self.errors = {}  # route -> count of transport errors / 5xx
+        self.deliveries = []  # (round key, browser_id, otp, delivered at)
+        self.posted = {}  # round key -> (otp, posted_at, browser_ids)
+        self.seen_otps = {}  # otp -> round key, to spot stale deliveries
+
+    def call(self, route, method, path, body=None, form=None):
+        started = time.perf_counter()
+        try:
+            status, payload = self.target.request(method, path, body, form)
+        except Exception:
+            status, payload = None, b""
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latency.setdefault(route, []).append(elapsed)
+            if status is None or status >= 500:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status, payload
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+    return {"count": len(values), "p50_ms": pick(0.5) * 1000, "p95_ms": pick(0.95) * 1000,
+            "p99_ms": pick(0.99) * 1000, "max_ms": values[-1] * 1000}
+
+# =========================
+# Actors
+# =========================
+def poll(rec, token, sim, browser_id, route="/api/get-latest-otp"):
+    """One get-latest-otp; returns (OTP if this poll delivered one, suggested seconds to the next poll)."""
+    status, payload = rec.call(route, "GET",
+                               f"/api/get-latest-otp?token={token}&sim_number={sim}&browser_id={browser_id}")
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None, None
+    hint = data.get("poll_after_ms")
+    return (data.get("otp") if data.get("status") == "success" else None), (hint / 1000 if hint else None)
+
+def next_poll_delay(args, rng, hint):
+    if hint is None or args.ignore_hints:
+        return rng.uniform(args.poll_min, args.poll_max)
+    return hint * rng.uniform(0.9, 1.0)
+
+def browser(rec, args, token, sim, browser_id, round_key, rng, deadline, results, abandon):
+    time.sleep(rng.uniform(0, args.join_spread))
+    while time.time() < deadline:
+        otp, hint = poll(rec, token, sim, browser_id)
+        if otp is not None:
+            got_at = time.time()
+            with rec.lock:
+                results.append((round_key, browser_id, otp, got_at))
+            return
+        if abandon:
+            return
+        time.sleep(next_poll_delay(args, rng, hint))
+
+IDLE_ROUTE = "/api/get-latest-otp (idle)"
+
+def idle_browser(rec, args, token, sim, browser_id, rng, stop):
+    # Waits on a SIM that never gets an OTP for the whole run
+    while not stop.is_set():
+        _, hint = poll(rec, token, sim, browser_id, IDLE_ROUTE)
+        stop.wait(next_poll_delay(args, rng, hint))
+
+def idle_browsers(args, tokens):
+    return [(tokens[g % len(tokens)], f"IDLE{args.run_id}G{g}", f"idle-{g}-{n}")
+            for g in range(args.gateways) for n in range(args.idle_browsers)]
+
+def gateway(rec, args, index, token, stop_at):
+    rng = random.Random(args.seed * 1000 + index)
+    sims = [f"BENCH{args.run_id}G{index}S{n}" for n in range(args.sims_per_gateway)]
+    for round_no in range(args.rounds):
+        if time.time() > stop_at:
+            break
+        threads, results = [], []
+        deadline = time.time() + args.join_spread + args.post_delay + args.deliver_timeout
+        browsers = {}
+        for sim in sims:
+            browsers[sim] = []
+            for n in range(args.browsers):
+                browser_id = f"b{index}-{round_no}-{sim[-2:]}-{n}"
+                abandon = rng.random() < args.abandon
+                if not abandon:
+                    browsers[sim].append(browser_id)
+                t = threading.Thread(target=browser, args=(rec, args, token, sim, browser_id, (sim, round_no),
+                                                           random.Random(rng.random()), deadline, results, abandon))
+                t.start()
+                threads.append(t)
+        # Every browser has polled once before the SMS shows up
+        time.sleep(args.join_spread + args.post_delay)
+        for sim in sims:
+            otp = f"{index:02d}{round_no:04d}{rng.randrange(10 ** 6):06d}"
+            with rec.lock:
+                rec.posted[(sim, round_no)] = (otp, time.time(), browsers[sim])
+                rec.seen_otps[otp] = (sim, round_no)
+            rec.call("/api/receive-otp", "POST", "/api/receive-otp",
+                     body={"otp": otp, "token": token, "sim_number": sim})
+            time.sleep(rng.uniform(0, args.post_jitter))
+        for t in threads:
+            t.join()
+        with rec.lock:
+            rec.deliveries.extend(results)
+        if sum(map(len, browsers.values())) < len(sims) * args.browsers:
+            time.sleep(max(0, deadline - args.deliver_timeout + STALE_SECONDS + 0.5 - time.time()))
+
+def admin_pages(tokens):
+    pages = [("/admin/caps", "/admin/caps?embed=1"), ("/metrics", "/metrics")]
+    for token in tokens:
+        pages += [("/status/<token>?section=otp", f"/status/{token}?embed=1&section=otp"),
+                  ("/admin/latency/<token>", f"/admin/latency/{token}?embed=1")]
+    return pages
+
+def admin_login(rec, args):
+    rec.call("/admin-login", "POST", "/admin-login", form={"username": "admin", "password": args.admin_password})
+
+def admin_reader(rec, args, index, tokens, stop):
+    rng = random.Random(args.seed * 7919 + index)
+    admin_login(rec, args)
+    pages = admin_pages(tokens)
+    while not stop.is_set():
+        route, path = rng.choice(pages)
+        rec.call(route, "GET", path)
+        stop.wait(rng.uniform(0.5, 1.5) * args.admin_interval)
+
+# =========================
+# Virtual-time simulation
+# =========================
+def simulate(rec, args, tokens, samples):
+    """The gateway/browser/admin scenario as discrete events on a VirtualClock, in this thread.
+    Returns the simulated seconds."""
+    import app
+    clock = app.set_clock(app.VirtualClock(start=1_700_000_000.0))
+    started = clock.time()
+    events, seq = [], itertools.count()
+    rng = random.Random(args.seed)
+    open_rounds = [args.gateways]  # gateways still running rounds; admins and sampling stop with them
+
+    def at(when, action, *params):
+        heapq.heappush(events, (when, next(seq), action, params))
+
+    def browser_poll(now, token, sim, browser_id, round_key, deadline, abandon, gateway_round):
+        otp, hint = poll(rec, token, sim, browser_id)
+        if otp is not None:
+            rec.deliveries.append((round_key, browser_id, otp, now))
+        elif not abandon and now < deadline:
+            return at(now + next_poll_delay(args, rng, hint), browser_poll,
+                      token, sim, browser_id, round_key, deadline, abandon, gateway_round)
+        elif abandon:
+            gateway_round["next_at"] = max(gateway_round["next_at"], now + STALE_SECONDS + 0.5)
+        gateway_round["open"] -= 1
+        if not gateway_round["open"]:
+            at(max(now, gateway_round["next_at"]), gateway_start, gateway_round["index"], token, gateway_round["round"] + 1)
+
+    def gateway_post(now, token, sim, round_key, browser_ids):
+        otp = f"{round_key[1]:06d}{rng.randrange(10 ** 6):06d}"
+        rec.posted[round_key] = (otp, now, browser_ids)
+        rec.seen_otps[otp] = round_key
+        rec.call("/api/receive-otp", "POST", "/api/receive-otp", body={"otp": otp, "token": token, "sim_number": sim})
+
+    def gateway_start(now, index, token, round_no):
+        if round_no >= args.rounds or now - started > args.max_seconds:
+            open_rounds[0] -= 1
+            return
+        sims = [f"BENCHV{args.seed}G{index}S{n}" for n in range(args.sims_per_gateway)]
+        gateway_round = {"index": index, "round": round_no, "open": len(sims) * args.browsers, "next_at": now}
+        deadline = now + args.join_spread + args.post_delay + args.deliver_timeout
+        for sim in sims:
+            browser_ids = []
+            for n in range(args.browsers):
+                browser_id = f"b{index}-{round_no}-{sim[-2:]}-{n}"
+                abandon = rng.random() < args.abandon
+                if not abandon:
+                    browser_ids.append(browser_id)
+                at(now + rng.uniform(0, args.join_spread), browser_poll,
+                   token, sim, browser_id, (sim, round_no), deadline, abandon, gateway_round)
+            at(now + args.join_spread + args.post_delay + rng.uniform(0, args.post_jitter), gateway_post,
+               token, sim, (sim, round_no), browser_ids)
+
+    def idle_poll(now, token, sim, browser_id):
+        _, hint = poll(rec, token, sim, browser_id, IDLE_ROUTE)
+        if open_rounds[0]:
+            at(now + next_poll_delay(args, rng, hint), idle_poll, token, sim, browser_id)
+
+    def admin_read(now, pages):
+        route, path = rng.choice(pages)
+        rec.call(route, "GET", path)
+        if open_rounds[0]:
+            at(now + rng.uniform(0.5, 1.5) * args.admin_interval, admin_read, pages)
+
+    def sample(now):
+        rss = rec.target.rss_bytes()
+        if rss is not None:
+            samples.append((round(now - started, 1), rss))
+        if open_rounds[0]:
+            at(now + 60, sample)
+
+    for index in range(args.gateways):
+        at(started, gateway_start, index, tokens[index % len(tokens)], 0)
+    for token, sim, browser_id in idle_browsers(args, tokens):
+        at(started + rng.uniform(0, args.join_spread), idle_poll, token, sim, browser_id)
+    if args.admin_readers:
+        admin_login(rec, args)
+    for _ in range(args.admin_readers):
+        at(started + rng.uniform(0, args.admin_interval), admin_read, admin_pages(tokens))
+    at(started, sample)
+    # Once the gateways are done only admin reads and samples are left
+    while events and open_rounds[0]:
+        when, _, action, params = heapq.heappop(events)
+        clock.advance_to(when)
+        action(clock.time(), *params)
+    # Let stale sessions and unclaimed OTPs of the last rounds expire too
+    clock.advance(app.BROWSER_STALE_SECONDS + app.GROUP_ASSIGNMENT_TIMEOUT)
+    return clock.time() - started
+
+def sample_memory(rec, samples, stop):
+    started = time.time()
+    while not stop.wait(1.0):
+        rss = rec.target.rss_bytes()
+        if rss is not None:
+            samples.append((round(time.time() - started, 1), rss))
+
+# =========================
+# Report
+# =========================
+def check_deliveries(rec):
+    by_round = {}
+    stale = foreign = 0
+    for round_key, browser_id, otp, got_at in rec.deliveries:
+        by_round.setdefault(round_key, []).append((browser_id, otp, got_at))
+        origin = rec.seen_otps.get(otp)
+        if origin is None or origin[0] != round_key[0]:
+            foreign += 1  # someone else's OTP (or one never posted)
+        elif origin != round_key:
+            stale += 1  # this SIM's OTP from an earlier round
+    lost = duplicate = split_groups = 0
+    latencies = []
+    for round_key, (otp, posted_at, browser_ids) in rec.posted.items():
+        got = by_round.get(round_key, [])
+        per_browser = {}
+        for browser_id, value, got_at in got:
+            per_browser.setdefault(browser_id, []).append(value)
+            if value == otp:
+                latencies.append(got_at - posted_at)
+        lost += sum(1 for b in browser_ids if otp not in per_browser.get(b, []))
+        duplicate += sum(max(0, len(values) - 1) for values in per_browser.values())
+        if len({v for values in per_browser.values() for v in values}) > 1 or 0 < len(per_browser) < len(browser_ids):
+            split_groups += 1
+    expected = sum(len(b) for _, _, b in rec.posted.values())
+    return {
+        "otps_posted": len(rec.posted),
+        "deliveries_expected": expected,
+        "deliveries": len(rec.deliveries),
+        "lost": lost,
+        "duplicate": duplicate,
+        "stale": stale,
+        "foreign": foreign,
+        "split_groups": split_groups,
+        "ok": lost == duplicate == stale == foreign == split_groups == 0,
+        "receive_to_deliver": percentiles(latencies),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(old, new):
+    """Lines of relative change for the headline numbers of two reports."""
+    def flat(report):
+        out = {"throughput_rps": report["throughput_rps"]}
+        for route, stats in report["requests"].items():
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if key in stats:
+                    out[f"{route} {key}"] = stats[key]
+        out["delivery p95_ms"] = report["delivery"]["receive_to_deliver"].get("p95_ms")
+        out["rss_growth_mb"] = report["memory"].get("growth_mb")
+        return out
+    before, after = flat(old), flat(new)
+    for key in sorted(set(before) & set(after)):
+        a, b = before[key], after[key]
+        if a is None or b is None:
+            continue
+        change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+        yield f"{key:45s} {a:10.2f} -> {b:10.2f}  {change}"
+
+def measure_heap(build, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(n)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+def record_memory(n, sims=1000):
+    """Heap bytes per million records, dict layout vs slotted records. Identifiers are formatted
+    per record, as they arrive in requests; the slotted side interns them like app does."""
+    import app
+    from datetime import datetime
+    now = time.time()
+
+    def otp_dicts(n):
+        return [{"otp": str(100000 + i), "token": "km8686", "timestamp": datetime.fromtimestamp(now + i, app.IST),
+                 "sim_number": f"S{i % sims}", "seq": i + 1, "browser_id": f"b{i % 97}"} for i in range(n)]
+
+    def otp_records(n):
+        out = []
+        for i in range(n):
+            r = app.OtpRecord(str(100000 + i), sim_number=f"S{i % sims}", timestamp=int((now + i) * 1_000_000))
+            r.seq = i + 1
+            r.browser_id = app.intern_id(f"b{i % 97}")
+            out.append(r)
+        return out
+
+    def session_dicts(n):
+        return [{"first_request": datetime.fromtimestamp(now + i, app.IST), "last_request": now + i} for i in range(n)]
+
+    def session_records(n):
+        return [app.ClientSession(int((now + i) * 1_000_000), now + i) for i in range(n)]
+
+    def login_dicts(n):
+        return [{"mobile_number": f"S{i % sims}", "timestamp": datetime.fromtimestamp(now + i, app.IST),
+                 "source": "WEB", "seq": i + 1} for i in range(n)]
+
+    def login_records(n):
+        out = []
+        for i in range(n):
+            r = app.LoginRecord(f"S{i % sims}", "WEB", timestamp=int((now + i) * 1_000_000))
+            r.seq = i + 1
+            out.append(r)
+        return out
+
+    report = {"records": n}
+    for kind, old, new in (("otp", otp_dicts, otp_records), ("client_session", session_dicts, session_records),
+                           ("login", login_dicts, login_records)):
+        dict_bytes, slotted_bytes = measure_heap(old, n), measure_heap(new, n)
+        report[kind] = {
+            "dict_mb_per_million": round(dict_bytes / n * 1e6 / 2 ** 20, 1),
+            "slotted_mb_per_million": round(slotted_bytes / n * 1e6 / 2 ** 20, 1),
+            "reduction": f"{(1 - slotted_bytes / dict_bytes) * 100:.0f}%",
+        }
+    return report
+
+def response_overhead(n):
+    """Microseconds per request through app.app for the hottest client replies."""
+    import app
+    from werkzeug.test import EnvironBuilder
+    origin = {"Origin": "https://bench.example"}
+    cases = {
+        "get-latest-otp waiting": EnvironBuilder(path="/api/get-latest-otp", headers=origin,
+                                                 query_string="token=km8686&sim_number=BENCHW&browser_id=w"),
+        "receive-otp": EnvironBuilder(method="POST", path="/api/receive-otp", headers=origin,
+                                      json={"otp": "123456", "token": "km8686", "sim_number": "BENCHR"}),
+        "login-found not_found": EnvironBuilder(path="/api/login-found", headers=origin,
+                                                query_string="token=km8686&mobile_number=BENCHL"),
+    }
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    report = {"requests": n, "json_encoder": getattr(app, "JSON_ENCODER", "json"), "us_per_request": {}}
+    for name, builder in cases.items():
+        environs = [builder.get_environ() for _ in range(n)]
+        started = time.perf_counter()
+        for environ in environs:
+            result = app.app(environ, start_response)
+            b"".join(result)
+            if hasattr(result, "close"):
+                result.close()
+        report["us_per_request"][name] = round((time.perf_counter() - started) / n * 1e6, 1)
+    return report
+
+def run_threads(rec, args, tokens, samples):
+    """Real-time run: a thread per gateway and per browser. Returns (elapsed seconds, final RSS)."""
+    stop = threading.Event()
+    helpers = [threading.Thread(target=sample_memory, args=(rec, samples, stop), daemon=True)]
+    helpers += [threading.Thread(target=admin_reader, args=(rec, args, i, tokens, stop), daemon=True)
+                for i in range(args.admin_readers)]
+    helpers += [threading.Thread(target=idle_browser, args=(rec, args, token, sim, browser_id,
+                                                            random.Random(f"{args.seed}{browser_id}"), stop), daemon=True)
+                for token, sim, browser_id in idle_browsers(args, tokens)]
+    for t in helpers:
+        t.start()
+    started = time.time()
+    gateways = [threading.Thread(target=gateway, args=(rec, args, i, tokens[i % len(tokens)], started + args.max_seconds))
+                for i in range(args.gateways)]
+    for t in gateways:
+        t.start()
+    for t in gateways:
+        t.join()
+    elapsed = time.time() - started
+    stop.set()
+    for t in helpers:
+        t.join(5)
+    return elapsed, rec.target.rss_bytes()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OTP relay with simulated gateways, browsers and admins")
+    parser.add_argument("--url", help="drive a running server instead of the in-process test client")
+    parser.add_argument("--pid", type=int, help="server pid to sample RSS from (with --url)")
+    parser.add_argument("--serve", choices=("waitress", "asgi"), help="spawn app.py under waitress or asgi.py under uvicorn")
+    parser.add_argument("--token", action="append", help="token(s) to spread gateways over (default: km8686)")
+    parser.add_argument("--gateways", type=int, default=4, help="gateway phones (N)")
+    parser.add_argument("--sims-per-gateway", type=int, default=2)
+    parser.add_argument("--browsers", type=int, default=3, help="browsers per SIM (M)")
+    parser.add_argument("--rounds", type=int, default=5, help="OTPs per SIM")
+    parser.add_argument("--join-spread", type=float, default=1.5, help="browsers of a SIM join within this many seconds")
+    parser.add_argument("--post-delay", type=float, default=0.3, help="extra wait before the gateway sends the OTP")
+    parser.add_argument("--post-jitter", type=float, default=0.05)
+    parser.add_argument("--poll-min", type=float, default=0.2)
+    parser.add_argument("--poll-max", type=float, default=0.5)
+    parser.add_argument("--deliver-timeout", type=float, default=8.0)
+    parser.add_argument("--abandon", type=float, default=0.0, help="share of browsers that vanish after one poll")
+    parser.add_argument("--idle-browsers", type=int, default=0, help="browsers per gateway waiting on SIMs that never get an OTP")
+    parser.add_argument("--ignore-hints", action="store_true", help="poll at --poll-min..--poll-max regardless of poll_after_ms")
+    parser.add_argument("--virtual", action="store_true", help="simulated time on app.VirtualClock (test client only)")
+    parser.add_argument("--admin-readers", type=int, default=1)
+    parser.add_argument("--admin-interval", type=float, default=1.0)
+    parser.add_argument("--admin-password", default="12345678")
+    parser.add_argument("--max-seconds", type=float, default=600, help="stop starting new rounds after this")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--compare", help="earlier JSON report to diff the headline numbers against")
+    parser.add_argument("--record-memory", type=int, metavar="N", help="only measure the heap cost of N records of each kind")
+    parser.add_argument("--response-overhead", type=int, metavar="N", help="only time N direct WSGI calls per client route")
+    args = parser.parse_args()
+    if args.record_memory:
+        print(json.dumps(record_memory(args.record_memory), indent=2))
+        return
+    if args.response_overhead:
+        print(json.dumps(response_overhead(args.response_overhead), indent=2))
+        return
+    args.run_id = f"{int(time.time()) % 100000:05d}"
+    tokens = args.token or ["km8686"]
+
+    server = None
+    if args.virtual and (args.serve or args.url):
+        parser.error("--virtual drives the in-process app only")
+    if args.serve:
+        port = free_port()
+        server = spawn_server(args.serve, port)
+        target = HttpTarget(f"http://127.0.0.1:{port}", server.pid)
+    elif args.url:
+        target = HttpTarget(args.url, args.pid)
+    else:
+        target = TestClientTarget()
+    rec = Recorder(target)
+
+    simulated = None
+    try:
+        rss_start = target.rss_bytes()
+        samples = []
+        if args.virtual:
+            started = time.time()
+            simulated = simulate(rec, args, tokens, samples)
+            elapsed = time.time() - started
+            rss_end = target.rss_bytes()
+        else:
+            elapsed, rss_end = run_threads(rec, args, tokens, samples)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    total = sum(len(v) for v in rec.latency.values())
+    requests = {}
+    for route, values in sorted(rec.latency.items()):
+        stats = percentiles(values)
+        stats["rps"] = len(values) / elapsed
+        stats["errors"] = rec.errors.get(route, 0)
+        requests[route] = stats
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare", "run_id")}
+    config["target"] = target.name + (f":{args.serve}" if args.serve else "")
+    mb = lambda b: None if b is None else round(b / 2 ** 20, 2)
+    report = {
+        "commit": git_commit(),
+        "config": config,
+        "elapsed_s": round(elapsed, 3),
+        "simulated_s": None if simulated is None else round(simulated, 3),
+        "requests_total": total,
+        "throughput_rps": total / elapsed,
+        "requests": requests,
+        "delivery": check_deliveries(rec),
+        "memory": {
+            "rss_start_mb": mb(rss_start),
+            "rss_end_mb": mb(rss_end),
+            "growth_mb": mb(rss_end - rss_start) if rss_start is not None and rss_end is not None else None,
+            "samples_mb": [(t, mb(b)) for t, b in samples],
+        },
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in compare(old, report):
+            print(line, file=sys.stderr)
+    if not report["delivery"]["ok"]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
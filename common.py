@@ -0,0 +1,97 @@
+"""
+Pieces of the relay that the shards.py front dispatcher needs as well as app.py.
+
+Importing app sets up per-token state, the state backend (opening the SQLite store or
+recovering the journal) and the reaper, which must only happen in the processes that own
+tokens. This module has no such setup, so the dispatcher can route and merge with it.
+"""
+import json
+
+# =========================
+# Predefined Tokens
+# =========================
+PREDEFINED_TOKENS = ["km8686", "kmk8686", "km5630"]
+
+# =========================
+# Posted records
+# =========================
+def posted_fields(data, names):
+    """Stripped string values of a posted JSON object ("" when missing), or None if one is not a string."""
+    values = [data.get(name) or "" for name in names]
+    if not all(isinstance(v, str) for v in values):
+        return None
+    return [v.strip() for v in values]
+
+def posted_token(data):
+    # For the rate limiter, before the record is validated: a bad token passes and is rejected by the handler
+    fields = posted_fields(data, ("token",)) if isinstance(data, dict) else None
+    return fields[0] if fields else ""
+
+MAX_BATCH_RECORDS = 1000
+
+def parse_otp_batch(body, content_type=""):
+    """Records of a batch post: a JSON array, or NDJSON (one JSON object per line)."""
+    text = body.decode("utf-8")
+    if "ndjson" in content_type or "jsonl" in content_type or not text.lstrip().startswith("["):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return json.loads(text)
+
+# =========================
+# Caps / rate limits panel
+# =========================
+RATE_LIMIT_LABELS = {
+    "receive": "receive-otp / token",
+    "receive_batch": "batch records / token",
+    "poll": "polls / token",
+    "poll_browser": "polls / browser",
+    "login": "login-detect / token",
+}
+
+def render_rate_limit(limit):
+    return f"{limit[0]:g}/s, burst {limit[1]:g}" if limit else "Unlimited"
+
+def render_caps_partial(caps):
+    rows = ""
+    idx = 0
+    for c in caps:
+        t = c["token"]
+        rows += f"<tr id='cap_row_{idx}'><td>{t}</td><td style='text-align:center'>{c['processed']}</td><td style='text-align:center'>{c['cap'] if c['cap'] is not None else 'Unlimited'}</td>"
+        rows += f"<td><form method='POST' action='/admin/update-cap' style='display:inline-block'><input type='hidden' name='token' value='{t}'><input type='number' name='cap' placeholder='Enter cap' style='padding:6px;width:120px;margin-right:6px;'><button type='submit' class='primary' style='padding:6px 10px;background:#2980B9;color:white;border:none;border-radius:4px;'>Set</button></form>"
+        rows += f"<button onclick=\"showProcessedMobiles('{t}')\" style='padding:6px 8px;background:#2ecc71;color:#fff;border-radius:6px;border:none;cursor:pointer;margin-left:8px;'>Processed Mobiles</button></td></tr>"
+        idx += 1
+
+    limit_rows = ""
+    for c in caps:
+        t = c["token"]
+        limits = c["rate_limits"]
+        limit_rows += f"<tr><td>{t}</td>" + "".join(f"<td style='text-align:center'>{render_rate_limit(limits.get(l))}</td>" for l in RATE_LIMIT_LABELS)
+        limit_rows += f"<td style='text-align:center'>{c['rate_limited']}</td></tr>"
+        inputs = ""
+        for l, label in RATE_LIMIT_LABELS.items():
+            rate, burst = limits.get(l) or ("", "")
+            inputs += (f"<label style='margin-right:10px;'>{label} <input type='number' step='any' min='0' name='{l}_rate' value='{rate}' placeholder='rate/s' style='padding:6px;width:80px;'>"
+                       f"<input type='number' step='any' min='1' name='{l}_burst' value='{burst}' placeholder='burst' style='padding:6px;width:70px;margin-left:4px;'></label>")
+        limit_rows += (f"<tr><td colspan='{len(RATE_LIMIT_LABELS) + 2}' style='padding-bottom:10px;'><form method='POST' action='/admin/update-rate-limits'>"
+                       f"<input type='hidden' name='token' value='{t}'>{inputs}"
+                       f"<button type='submit' class='primary' style='padding:6px 10px;background:#2980B9;color:white;border:none;border-radius:4px;'>Set</button></form></td></tr>")
+
+    partial = f"""
+    <div class="card">
+        <h3>Token Mobile Caps</h3>
+        <table style="width:100%;border-collapse:collapse;">
+            <tr style="background:#2980B9;color:white;"><th>Token</th><th>Processed Mobiles</th><th>Cap</th><th>Action</th></tr>
+            {rows}
+        </table>
+        <div id='processed_mobiles_container' style='margin-top:20px;'></div>
+        <p class='muted' style="margin-top:10px;">Click <strong>Processed Mobiles</strong> to load processed mobile data below the table.</p>
+    </div>
+    <div class="card">
+        <h3>Client Rate Limits</h3>
+        <table style="width:100%;border-collapse:collapse;">
+            <tr style="background:#2980B9;color:white;"><th>Token</th>{''.join(f'<th>{label}</th>' for label in RATE_LIMIT_LABELS.values())}<th>Rejected (429)</th></tr>
+            {limit_rows}
+        </table>
+        <p class='muted' style="margin-top:10px;">Requests per second and burst size. Leave the rate empty for no limit.</p>
+    </div>
+    """
+    return partial
@@ -0,0 +1,256 @@
+"""
+Token-sharded multi-process mode.
+
+Starts N copies of app.py, each owning a subset of PREDEFINED_TOKENS, plus a small
+front dispatcher that routes every request to the process owning its token:
+
+    python shards.py --workers 4 --port 8000
+
+Per-token state never crosses processes, so no shared store is needed on the hot path.
+Admin views that span tokens (/admin/caps, /admin/master-reset, admin password change)
+are fanned out to every shard and merged here.
+"""
+from urllib.parse import parse_qs
+from common import MAX_BATCH_RECORDS, PREDEFINED_TOKENS, parse_otp_batch, posted_token, render_caps_partial
+import argparse, hashlib, http.client, json, multiprocessing, os, threading
+
+# The front process never imports app: that would set up the state backend (and recover
+# the unsharded journal or open the shared store) in a process that owns no tokens
+
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+              "te", "trailers", "transfer-encoding", "upgrade", "content-length"}
+
+# Paths whose last segment is the token
+TOKEN_PATH_PREFIXES = ("/status/", "/admin/limit/", "/admin/processed/", "/admin/token-login-details/",
+                       "/admin/change-token-password/", "/change-password/", "/admin/latency/")
+
+# POSTs that change state every shard keeps a copy of
+FAN_OUT_POSTS = ("/admin/master-reset", "/admin/change-password")
+
+# Batches can mix tokens: split by owning shard, results are put back in posted order
+BATCH_PATH = "/api/receive-otp-batch"
+
+def shard_for(token, tokens, workers):
+    # Tokens are ordered by hash and dealt out round-robin: stable for a given token list,
+    # and balanced even when there are only a few tokens
+    ordered = sorted(tokens, key=lambda t: hashlib.md5(t.encode()).digest())
+    return ordered.index(token) % workers
+
+def tokens_for_shard(tokens, index, workers):
+    return [t for t in tokens if shard_for(t, tokens, workers) == index]
+
+# =========================
+# Shard workers
+# =========================
+def run_shard(port, tokens, threads):
+    # OTP_SHARD_TOKENS has to be set before app is imported
+    os.environ["OTP_SHARD_TOKENS"] = ",".join(tokens)
+    from waitress import serve
+    from app import app
+    serve(app, host="127.0.0.1", port=port, threads=threads)
+
+# =========================
+# Front dispatcher
+# =========================
+class Dispatcher:
+    def __init__(self, ports):
+        self.ports = ports
+        self._local = threading.local()
+
+    def _connection(self, index, fresh=False):
+        conns = self._local.__dict__.setdefault("conns", {})
+        if fresh or index not in conns:
+            conns[index] = http.client.HTTPConnection("127.0.0.1", self.ports[index], timeout=120)
+        return conns[index]
+
+    def forward(self, index, method, path, headers, body):
+        # Keep-alive connections per thread; retry once if the shard closed an idle one
+        for attempt in (0, 1):
+            conn = self._connection(index, fresh=attempt == 1)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if attempt:
+                    raise
+
+    def route(self, method, path, query, body):
+        """Index of the shard that owns this request, or None to fan out."""
+        workers = len(self.ports)
+        token = None
+        if path.startswith(TOKEN_PATH_PREFIXES):
+            token = path.rstrip("/").rsplit("/", 1)[-1]
+        elif path.startswith("/api/"):
+            token = (query.get("token") or [""])[0]
+            if not token and body:
+                try:
+                    token = posted_token(json.loads(body))
+                except ValueError:
+                    token = ""
+        elif method == "POST" and path in ("/login", "/admin/update-cap", "/admin/update-rate-limits"):
+            form = parse_qs(body.decode("utf-8", "replace"))
+            token = (form.get("token") or [""])[0]
+        elif path in ("/admin/caps", "/metrics") or (method == "POST" and path in FAN_OUT_POSTS):
+            return None
+        token = (token or "").strip()
+        if token in PREDEFINED_TOKENS:
+            return shard_for(token, PREDEFINED_TOKENS, workers)
+        return 0
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        path = environ.get("PATH_INFO", "/")
+        qs = environ.get("QUERY_STRING", "")
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+        headers = {k[5:].replace("_", "-").title(): v for k, v in environ.items() if k.startswith("HTTP_")}
+        if environ.get("CONTENT_TYPE"):
+            headers["Content-Type"] = environ["CONTENT_TYPE"]
+        headers.pop("Connection", None)
+        full_path = path + ("?" + qs if qs else "")
+
+        if method == "POST" and path == BATCH_PATH:
+            return self.split_batch(full_path, headers, body, start_response)
+        index = self.route(method, path, parse_qs(qs), body)
+        if index is None:
+            return self.fan_out(method, path, qs, full_path, headers, body, start_response)
+        return self.relay(index, method, full_path, headers, body, start_response)
+
+    def relay(self, index, method, full_path, headers, body, start_response):
+        resp = self.forward(index, method, full_path, headers, body)
+        out_headers = [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP]
+        start_response(f"{resp.status} {resp.reason}", out_headers)
+        if resp.getheader("Content-Type", "").startswith("text/event-stream"):
+            return self._stream(resp)
+        return [resp.read()]
+
+    @staticmethod
+    def _stream(resp):
+        try:
+            while True:
+                chunk = resp.read1(8192)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            resp.close()
+
+    def split_batch(self, full_path, headers, body, start_response):
+        try:
+            records = parse_otp_batch(body, headers.get("Content-Type", ""))
+        except ValueError:
+            records = None
+        if records is None or len(records) > MAX_BATCH_RECORDS:
+            # Let a shard produce the error response
+            return self.relay(0, "POST", full_path, headers, body, start_response)
+        groups = {}
+        for i, r in enumerate(records):
+            token = posted_token(r)
+            index = shard_for(token, PREDEFINED_TOKENS, len(self.ports)) if token in PREDEFINED_TOKENS else 0
+            groups.setdefault(index, []).append(i)
+        results = [None] * len(records)
+        for index, positions in groups.items():
+            sub = json.dumps([records[i] for i in positions]).encode()
+            resp = self.forward(index, "POST", full_path, dict(headers, **{"Content-Type": "application/json"}), sub)
+            data = resp.read()
+            if resp.status != 200:
+                start_response(f"{resp.status} {resp.reason}",
+                               [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP])
+                return [data]
+            for i, result in zip(positions, json.loads(data)["results"]):
+                results[i] = result
+        stored = sum(1 for r in results if r["status"] == "success")
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return [json.dumps({"status": "success", "stored": stored, "results": results}).encode()]
+
+    def fan_out(self, method, path, qs, full_path, headers, body, start_response):
+        if path == "/admin/caps" and method == "GET":
+            return self._merge_caps(qs, headers, start_response)
+        if path == "/metrics" and method == "GET":
+            return self._merge_metrics(headers, start_response)
+        # Fan-out POST: apply on every shard, answer with the first shard's response
+        first = None
+        for index in range(len(self.ports)):
+            resp = self.forward(index, method, full_path, headers, body)
+            data = resp.read()
+            if first is None:
+                first = (resp, data)
+        resp, data = first
+        start_response(f"{resp.status} {resp.reason}",
+                       [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP])
+        return [data]
+
+    def _merge_metrics(self, headers, start_response):
+        # Every shard reports the same metric families: keep one HELP/TYPE header per family
+        # and tell the samples apart with a shard label
+        families = {}
+        for index in range(len(self.ports)):
+            resp = self.forward(index, "GET", "/metrics", headers, b"")
+            data = resp.read()
+            if resp.status != 200:
+                start_response(f"{resp.status} {resp.reason}",
+                               [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP])
+                return [data]
+            family = None
+            for line in data.decode().splitlines():
+                if line.startswith("# HELP "):
+                    family = families.setdefault(line.split(" ", 3)[2], [line])
+                elif line.startswith("#"):
+                    if len(family) == 1:
+                        family.append(line)
+                elif line:
+                    name, sep, rest = line.partition("{")
+                    if sep:
+                        family.append(f'{name}{{shard="{index}",{rest}')
+                    else:
+                        name, value = line.split(" ", 1)
+                        family.append(f'{name}{{shard="{index}"}} {value}')
+        start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4")])
+        return ["\n".join(line for family in families.values() for line in family).encode() + b"\n"]
+
+    def _merge_caps(self, qs, headers, start_response):
+        caps = []
+        for index in range(len(self.ports)):
+            resp = self.forward(index, "GET", "/admin/caps?format=json", headers, b"")
+            data = resp.read()
+            if resp.status != 200 or not resp.getheader("Content-Type", "").startswith("application/json"):
+                # Not logged in (redirect) or a shard error: pass it through unchanged
+                start_response(f"{resp.status} {resp.reason}",
+                               [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP])
+                return [data]
+            caps.extend(json.loads(data)["caps"])
+        caps.sort(key=lambda c: PREDEFINED_TOKENS.index(c["token"]))
+        if parse_qs(qs).get("format") == ["json"]:
+            start_response("200 OK", [("Content-Type", "application/json")])
+            return [json.dumps({"caps": caps}).encode()]
+        if parse_qs(qs).get("embed") == ["1"]:
+            start_response("200 OK", [("Content-Type", "text/html; charset=utf-8")])
+            return [render_caps_partial(caps).encode()]
+        start_response("302 Found", [("Location", "/admin")])
+        return [b""]
+
+# =========================
+# Run
+# =========================
+def main():
+    parser = argparse.ArgumentParser(description="Run the OTP relay as token-sharded worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--shard-port-base", type=int, default=9100)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    ports = [args.shard_port_base + i for i in range(args.workers)]
+    for i, port in enumerate(ports):
+        tokens = tokens_for_shard(PREDEFINED_TOKENS, i, args.workers)
+        ctx.Process(target=run_shard, args=(port, tokens, args.threads), daemon=True).start()
+        print(f"shard {i} on 127.0.0.1:{port} owns {tokens or 'no tokens'}")
+
+    from waitress import serve
+    serve(Dispatcher(ports), host=args.host, port=args.port, threads=args.threads * args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+function tokens() {
+    return JSON.parse(document.body.dataset.tokens);
+}
+function loadInto(id, url, loading) {
+    var target = document.getElementById(id);
+    if (!target) return;
+    target.innerHTML = "<div class='card'><p>" + (loading || "Loading...") + "</p></div>";
+    fetch(url, { credentials: 'same-origin' })
+        .then(function(r){ return r.text(); })
+        .then(function(html){ target.innerHTML = html; })
+        .catch(function(e){ target.innerHTML = "<div class='card' style='color:red'>Failed to load</div>"; });
+}
+function tokenTiles(title, onclick) {
+    var html = "<div class='card'><h3>" + title + "</h3><div class='tokens-grid'>";
+    tokens().forEach(function(t) {
+        html += "<div class='token-tile' onclick=\"" + onclick + "('" + t + "')\">" + t + "</div>";
+    });
+    html += "</div></div>";
+    document.getElementById('content_panel').innerHTML = html;
+}
+function loadTokens() {
+    tokenTiles("Tokens", "loadTokenFull");
+}
+function loadTokenFull(token) {
+    loadInto('content_panel', '/status/' + token + '?embed=admin_full', 'Loading token dashboard...');
+}
+// sections of the token dashboard opened from TOKENS
+function loadTokenSection(token, section) {
+    loadInto('token_right_panel', '/status/' + token + '?embed=1&section=' + section);
+}
+function loadTokenLoginDetails(token) {
+    loadInto('token_right_panel', '/admin/token-login-details/' + token + '?embed=1', 'Loading login details...');
+}
+function loadLimit() {
+    tokenTiles("Limit Exceeded - Select Token", "loadLimitToken");
+}
+function loadLimitToken(token) {
+    loadInto('content_panel', '/admin/limit/' + token + '?embed=1', 'Loading limit-exceeded...');
+}
+function loadLatency() {
+    tokenTiles("Delivery Latency - Select Token", "loadLatencyToken");
+}
+function loadLatencyToken(token) {
+    loadInto('content_panel', '/admin/latency/' + token + '?embed=1', 'Loading delivery latency...');
+}
+function loadCaps() {
+    loadInto('content_panel', '/admin/caps?embed=1', 'Loading caps...');
+}
+function loadAdminChangePassword() {
+    loadInto('content_panel', '/admin/change-password?embed=1');
+}
+function loadMasterReset() {
+    loadInto('content_panel', '/admin/master-reset?embed=1');
+}
+// server time updater (client-side)
+function updateServerTime() {
+    var now = new Date();
+    document.getElementById('server_time').innerText = now.toLocaleString();
+}
+setInterval(updateServerTime, 1000);
+window.onload = function() {
+    document.getElementById('content_panel').innerHTML = "<div class='card'><h3>Welcome, Admin</h3><p class='muted'>Click TOKENS or other actions on the left to fetch fresh data into this panel.</p></div>";
+    updateServerTime();
+};
+// inject processed mobiles below the caps table
+function showProcessedMobiles(token) {
+    var target = document.getElementById('processed_mobiles_container');
+    if (!target) return;
+    target.innerHTML = '<div class="card"><p>Loading...</p></div>';
+    fetch('/admin/processed/' + token + '?embed=1', { credentials: 'same-origin' })
+        .then(function(r) { return r.text(); })
+        .then(function(html) { target.innerHTML = html; })
+        .catch(function(e) { target.innerHTML = '<div class="card" style="color:red">Failed to load</div>'; });
+}
@@ -0,0 +1,9 @@
+function loadSection(section) {
+    var url = window.location.pathname + '?embed=1&section=' + section;
+    document.getElementById('right_panel').innerHTML = '<div class="card"><p>Loading...</p></div>';
+    fetch(url, { credentials: 'same-origin' })
+        .then(function(r){ return r.text(); })
+        .then(function(html){ document.getElementById('right_panel').innerHTML = html; })
+        .catch(function(e){ document.getElementById('right_panel').innerHTML = '<div class="card" style="color:red">Failed to load</div>'; });
+}
+window.onload = function() { loadSection('otp'); }
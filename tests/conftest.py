@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# app reads its configuration at import: keep history out of the tree and the rate limits off,
+# so tests drive the relay as hard as they like
+os.environ.setdefault("OTP_HISTORY_DIR", tempfile.mkdtemp(prefix="otp-history-"))
+os.environ.setdefault("OTP_STATE_BACKEND", "memory")
+for name in ("OTP_RATE_RECEIVE", "OTP_RATE_RECEIVE_BATCH", "OTP_RATE_POLL", "OTP_RATE_POLL_BROWSER", "OTP_RATE_LOGIN"):
+    os.environ.setdefault(name, "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
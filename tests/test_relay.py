@@ -0,0 +1,64 @@
+import threading
+import time
+
+import app
+
+TOKEN = "km8686"
+
+
+def poll(client, identifier, browser_id, wait=""):
+    return client.get(f"/api/get-latest-otp?token={TOKEN}&sim_number={identifier}&browser_id={browser_id}{wait}").get_json()
+
+
+def receive(client, identifier, otp):
+    client.post("/api/receive-otp", json={"otp": otp, "token": TOKEN, "sim_number": identifier})
+
+
+def test_held_poll_wakes_when_the_group_ahead_completes(monkeypatch):
+    monkeypatch.setattr(app, "GROUP_WINDOW_SECONDS", 0.1)
+    c = app.app.test_client()
+    poll(c, "WAKE1", "a1")
+    poll(c, "WAKE1", "a2")
+    time.sleep(0.3)
+    poll(c, "WAKE1", "b1")
+    receive(c, "WAKE1", "111")
+    assert poll(c, "WAKE1", "a1")["otp"] == "111"
+    receive(c, "WAKE1", "222")  # the duplicate the two-browser group expects, ignored
+    receive(c, "WAKE1", "333")  # held for b1 until a2 has fetched 111
+    held = {}
+
+    def hold():
+        held["reply"] = poll(app.app.test_client(), "WAKE1", "b1", "&wait=8")
+        held["at"] = time.time()
+
+    t = threading.Thread(target=hold)
+    t.start()
+    time.sleep(0.3)
+    fetched = time.time()
+    assert poll(c, "WAKE1", "a2")["otp"] == "111"
+    t.join()
+    assert held["reply"]["otp"] == "333"
+    assert held["at"] - fetched < 1
+
+
+def test_full_batch_fits_the_default_batch_limit(monkeypatch):
+    token = "km5630"
+    limits = {"receive": (100.0, 200.0), "receive_batch": (1000.0, 2000.0)}
+    monkeypatch.setitem(app.token_rate_limits, token, limits)
+    monkeypatch.setitem(app.rate_limiters, token, app.RateLimiter())
+    monkeypatch.setattr(app, "clock", app.VirtualClock())
+    c = app.app.test_client()
+
+    def batch(n, tag):
+        records = [{"otp": f"{tag}{i}", "token": token, "sim_number": f"BATCH{i}"} for i in range(n)]
+        return c.post("/api/receive-otp-batch", json=records)
+
+    r = batch(app.MAX_BATCH_RECORDS, "a")
+    assert r.status_code == 200 and r.get_json()["stored"] == app.MAX_BATCH_RECORDS
+    assert batch(app.MAX_BATCH_RECORDS, "b").get_json()["stored"] == app.MAX_BATCH_RECORDS
+    # the third full batch in the same instant is over the bucket
+    r = batch(app.MAX_BATCH_RECORDS, "c")
+    assert r.get_json()["stored"] == 0 and r.headers["Retry-After"] == "1"
+    assert {x["code"] for x in r.get_json()["results"]} == {429}
+    # single posts keep their own bucket
+    assert c.post("/api/receive-otp", json={"otp": "1", "token": token, "sim_number": "BATCH0"}).status_code == 200
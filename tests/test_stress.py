@@ -0,0 +1,81 @@
+import collections
+import itertools
+import sys
+import threading
+import time
+
+import app
+
+TOKEN = "km8686"
+VEHICLES = ["V%d" % i for i in range(10)]
+SIMS = ["S%d" % i for i in range(10)]
+OTPS_PER_IDENTIFIER = 40
+
+
+def test_concurrent_polls_and_receives_lose_and_duplicate_nothing(monkeypatch):
+    # Short expiries so the reaper retires everything left over in a few seconds
+    monkeypatch.setattr(app, "BROWSER_STALE_SECONDS", 3.0)
+    monkeypatch.setattr(app, "GROUP_ASSIGNMENT_TIMEOUT", 3.0)
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    stop = threading.Event()
+    got = collections.defaultdict(list)  # (identifier, browser) -> OTPs handed to it
+    lock = threading.Lock()
+
+    def browser(field, identifier, browser_id):
+        c = app.app.test_client()
+        while not stop.is_set():
+            r = c.get(f"/api/get-latest-otp?token={TOKEN}&{field}={identifier}&browser_id={browser_id}").get_json()
+            if r["status"] == "success":
+                with lock:
+                    got[(identifier, browser_id)].append(r["otp"])
+            time.sleep(0.002)
+
+    def sender(field, identifiers, tag):
+        c = app.app.test_client()
+        for n in range(OTPS_PER_IDENTIFIER):
+            for identifier in identifiers:
+                c.post("/api/receive-otp", json={"otp": f"{tag}{identifier}-{n}", "token": TOKEN, field: identifier})
+            time.sleep(0.01)
+
+    browsers = [threading.Thread(target=browser, args=("vehicle", v, f"b{j}")) for v in VEHICLES for j in range(2)]
+    browsers += [threading.Thread(target=browser, args=("sim_number", s, f"g{j}")) for s in SIMS for j in range(2)]
+    senders = [threading.Thread(target=sender, args=("vehicle", VEHICLES[i::2], "v")) for i in range(2)]
+    senders += [threading.Thread(target=sender, args=("sim_number", SIMS[i::2], "s")) for i in range(2)]
+    try:
+        for t in browsers:
+            t.start()
+        time.sleep(0.2)
+        for t in senders:
+            t.start()
+        for t in senders:
+            t.join()
+        time.sleep(1)
+    finally:
+        stop.set()
+        for t in browsers:
+            t.join()
+        sys.setswitchinterval(switch)
+    # let the reaper retire the sessions, assignments and anything still pending
+    deadline = time.time() + app.BROWSER_STALE_SECONDS + app.GROUP_ASSIGNMENT_TIMEOUT + 5
+    while time.time() < deadline and (len(app.mobile_otps[TOKEN]) or len(app.vehicle_otps[TOKEN])
+                                      or app.client_sessions[TOKEN]):
+        time.sleep(0.1)
+
+    sent = {f"v{v}-{n}" for v in VEHICLES for n in range(OTPS_PER_IDENTIFIER)}
+    sent |= {f"s{s}-{n}" for s in SIMS for n in range(OTPS_PER_IDENTIFIER)}
+    # A group member polling again before the rest of its group has fetched is handed the same
+    # OTP again: collapse those consecutive repeats, anything else is a double delivery
+    got = {k: [o for o, _ in itertools.groupby(v)] if k[0] in SIMS else v for k, v in got.items()}
+    dups = [(k, o) for k, otps in got.items() for o, c in collections.Counter(otps).items() if c > 1]
+    assert not dups
+    vehicle_deliveries = collections.Counter(o for (ident, _), otps in got.items() if ident in VEHICLES for o in otps)
+    assert all(c == 1 for c in vehicle_deliveries.values())
+    # every OTP ends up in otp_data exactly once (delivered, ignored, stale or unclaimed)
+    recorded = collections.Counter(e.otp for e in app.otp_data[TOKEN])
+    assert sent - set(recorded) == set()
+    assert [o for o, c in recorded.items() if c > 1] == []
+    assert len(app.mobile_otps[TOKEN]) == 0 and len(app.vehicle_otps[TOKEN]) == 0
+    delivered = sum(1 for e in app.otp_data[TOKEN] if e.otp[0] == "v" and not e.removed_reason)
+    assert delivered == len(vehicle_deliveries)
+    assert vehicle_deliveries and any(k[0] in SIMS and v for k, v in got.items())
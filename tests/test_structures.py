@@ -0,0 +1,238 @@
+import os
+from datetime import datetime, timezone
+import zoneinfo
+
+import pytest
+
+from app import BrowserQueue, HistoryLog, OtpRecord, PendingOtpStore, RateLimiter, TimestampFormatter
+import app
+
+
+def otp(value, sim=None, vehicle=None, ts=0):
+    return OtpRecord(value, sim_number=sim, vehicle=vehicle, timestamp=ts)
+
+
+# ---- PendingOtpStore ----
+def test_pending_store_keys_identifiers_case_and_space_insensitively():
+    store = PendingOtpStore("sim_number")
+    store.add(otp("1", sim=" ab12 ", ts=10))
+    store.add(otp("2", sim="AB12", ts=20))
+    assert [e.otp for e in store.for_identifier("ab12")] == ["1", "2"]
+    assert store.find("Ab12", "2").timestamp == 20
+    assert store.find("AB12", "3") is None
+    assert len(store) == 2
+
+
+def test_pending_store_after_and_pop_after_split_on_timestamp():
+    store = PendingOtpStore("vehicle")
+    for i, ts in enumerate((10, 20, 20, 30)):
+        store.add(otp(str(i), vehicle="V1", ts=ts))
+    assert [e.otp for e in store.after("V1", 20)] == ["3"]
+    assert [e.otp for e in store.after("V1", 5)] == ["0", "1", "2", "3"]
+    assert [e.otp for e in store.pop_after("V1", 10)] == ["1", "2", "3"]
+    assert [e.otp for e in store.for_identifier("V1")] == ["0"]
+    assert store.pop_after("V1", 0)[0].otp == "0"
+    assert dict(store.by_identifier()) == {}
+    assert store.pop_after("V1", 0) == []
+
+
+def test_pending_store_remove_is_by_identity_and_drops_empty_identifiers():
+    store = PendingOtpStore("sim_number")
+    a, b = otp("1", sim="S1", ts=1), otp("1", sim="S1", ts=1)
+    store.add(a)
+    store.add(b)
+    assert store.remove(b)
+    assert store.for_identifier("S1") == [a]
+    assert not store.remove(b)
+    assert store.remove(a)
+    assert not store.remove(a)
+    assert len(store) == 0 and list(store) == []
+
+
+def test_pending_store_replace_sets_one_identifier():
+    store = PendingOtpStore("sim_number")
+    store.add(otp("1", sim="S1", ts=1))
+    store.add(otp("2", sim="S2", ts=2))
+    store.replace("s1", [otp("3", sim="S1", ts=3)])
+    assert [e.otp for e in store.for_identifier("S1")] == ["3"]
+    store.replace("S2", [])
+    assert [k for k, _ in store.by_identifier()] == ["S1"]
+    store.clear()
+    assert len(store) == 0
+
+
+# ---- BrowserQueue ----
+SECOND = 1_000_000
+
+
+def test_browser_queue_keeps_arrival_order():
+    q = BrowserQueue()
+    assert q.head() is None
+    assert q.add("a", 0) and q.add("b", 1) and q.add("c", 2)
+    assert not q.add("a", 5)
+    assert list(q) == ["a", "b", "c"] and len(q) == 3 and "b" in q
+    assert q.position("c", 8) == 2
+    assert q.position("x", 2) == 2
+    q.pop_head()
+    assert q.head() == "b" and q.first_request("b") == 1
+    assert q.remove("c") and not q.remove("c")
+    assert list(q) == ["b"]
+
+
+def test_browser_queue_group_cache_follows_adds_and_removes():
+    q = BrowserQueue()
+    q.add("a", 0)
+    q.add("b", 1 * SECOND)
+    assert q.leading_group(2) == ["a", "b"]
+    # newcomers extend the cached group only while inside the window
+    q.add("c", 2 * SECOND)
+    q.add("d", 3 * SECOND)
+    assert q.leading_group(2) == ["a", "b", "c"]
+    # the returned list is a copy
+    q.leading_group(2).append("x")
+    assert q.leading_group(2) == ["a", "b", "c"]
+    q.remove("b")
+    assert q.leading_group(2) == ["a", "c"]
+    # a new head rebuilds the group from its own join time
+    q.remove("a")
+    assert q.leading_group(2) == ["c", "d"]
+    q.pop_head()
+    assert q.leading_group(2) == ["d"]
+    # a different window is not served from the cache
+    q.add("e", 10 * SECOND)
+    assert q.leading_group(2) == ["d"]
+    assert q.leading_group(8) == ["d", "e"]
+
+
+def test_browser_queue_insert_places_by_first_request():
+    q = BrowserQueue()
+    q.add("a", 0)
+    q.add("c", 2 * SECOND)
+    assert q.leading_group(5) == ["a", "c"]
+    assert q.insert("b", 1 * SECOND)
+    assert list(q) == ["a", "b", "c"]
+    assert q.leading_group(5) == ["a", "b", "c"]
+    assert not q.insert("b", 0)
+    assert q.insert("d", 3 * SECOND) and list(q)[-1] == "d"
+
+
+# ---- HistoryLog ----
+def make_log(tmp_path, max_records=10):
+    return HistoryLog(str(tmp_path / "otp_data"), OtpRecord, index_field="sim_number",
+                      max_records=max_records, max_age=0)
+
+
+def page_through(log, limit):
+    seqs, cursor = [], None
+    while True:
+        records, cursor = log.page(cursor, limit)
+        seqs.append([r.seq for r in records])
+        if cursor is None:
+            return seqs
+
+
+def test_history_page_continues_into_spilled_segments(tmp_path):
+    log = make_log(tmp_path)
+    for i in range(35):
+        log.append(otp(str(i), sim="S%d" % (i % 3), ts=i))
+    assert len(log.segments()) >= 2
+    assert len(log) <= 10
+    assert [r.seq for r in log][-1] == 35
+    for limit in (1, 4, 7, 10, 40):
+        pages = page_through(log, limit)
+        assert [s for p in pages for s in p] == list(range(35, 0, -1))
+        assert all(len(p) == limit for p in pages[:-1])
+    records, cursor = log.page(None, 100)
+    assert cursor is None and records[-1].otp == "0" and records[-1].sim_number == "S0"
+
+
+def test_history_page_from_a_spilled_cursor(tmp_path):
+    log = make_log(tmp_path)
+    for i in range(35):
+        log.append(otp(str(i), ts=i))
+    records, cursor = log.page(12, 5)
+    assert [r.seq for r in records] == [11, 10, 9, 8, 7] and cursor == 7
+    records, cursor = log.page(3, 5)
+    assert [r.seq for r in records] == [2, 1] and cursor is None
+
+
+def test_history_get_seqs_reads_memory_and_segments(tmp_path):
+    log = make_log(tmp_path)
+    for i in range(35):
+        log.append(otp(str(i), ts=i))
+    assert [r.otp for r in log.get_seqs([35, 2, 99, 20])] == ["34", "1", "19"]
+
+
+def test_history_seq_continues_after_reopen(tmp_path):
+    log = make_log(tmp_path)
+    for i in range(25):
+        log.append(otp(str(i), ts=i))
+    reopened = make_log(tmp_path)
+    assert reopened.next_seq == log.segments()[-1][1] + 1
+    log.clear()
+    assert log.segments() == [] and log.page() == ([], None)
+
+
+# ---- TimestampFormatter ----
+@pytest.mark.parametrize("tz", ["Asia/Kolkata", "UTC", "America/St_Johns", "Australia/Lord_Howe", "Asia/Kathmandu"])
+def test_timestamp_formatter_matches_strftime(tz):
+    zone = zoneinfo.ZoneInfo(tz)
+    fmt = TimestampFormatter(zone, max_blocks=3)
+    start = int(datetime(2024, 3, 9, tzinfo=timezone.utc).timestamp())
+    # a fortnight around the spring DST switches, every 7 minutes 13 seconds, plus repeats
+    for sec in list(range(start, start + 14 * 86400, 433)) + [start, start, start + 1]:
+        us = sec * 1_000_000 + 999_999
+        assert fmt(us) == datetime.fromtimestamp(sec, zone).strftime("%Y-%m-%d %H:%M:%S")
+    assert len(fmt._blocks) <= 3
+
+
+def test_format_ts_is_ist():
+    us = int(datetime(2025, 1, 1, 0, 0, 5, tzinfo=timezone.utc).timestamp() * 1_000_000)
+    assert app.format_ts(us) == "2025-01-01 05:30:05"
+
+
+# ---- RateLimiter ----
+def test_rate_limiter_burst_then_refill():
+    limiter = RateLimiter()
+    key = ("poll_browser", "b1")
+    assert [limiter.take(key, 10, 3, 100.0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.take(key, 10, 3, 100.0) == pytest.approx(0.1)
+    assert limiter.take(key, 10, 3, 100.05) == pytest.approx(0.05)
+    assert limiter.take(key, 10, 3, 100.11) == 0
+    # refill never exceeds the burst
+    assert [limiter.take(key, 10, 3, 200.0) for _ in range(4)][-1] > 0
+
+
+def test_rate_limiter_keys_are_independent():
+    limiter = RateLimiter()
+    assert limiter.take(("poll_browser", "a"), 1, 1, 0.0) == 0
+    assert limiter.take(("poll_browser", "a"), 1, 1, 0.0) > 0
+    assert limiter.take(("poll_browser", "b"), 1, 1, 0.0) == 0
+    assert limiter.take(("poll", None), 1, 1, 0.0) == 0
+
+
+def test_rate_limiter_drops_idle_buckets():
+    limiter = RateLimiter()
+    limiter.take(("poll_browser", "old"), 1, 1, 0.0)
+    limiter.take(("poll_browser", "new"), 1, 1, app.RATE_BUCKET_IDLE_SECONDS - 1)
+    limiter.take(("poll", None), 1, 1, app.RATE_BUCKET_IDLE_SECONDS + 1)
+    assert list(limiter.buckets) == [("poll_browser", "new"), ("poll", None)]
+    # a dropped bucket starts full again
+    assert limiter.take(("poll_browser", "old"), 1, 1, app.RATE_BUCKET_IDLE_SECONDS + 1) == 0
+
+
+def test_history_by_keys_finds_spilled_records(tmp_path):
+    log = make_log(tmp_path)
+    for i in range(35):
+        log.append(otp(str(i), sim="S%d" % (i % 3), ts=i))
+    found = log.by_keys(["S0", "S2", "S9"])
+    assert [r.otp for r in found["S0"]] == [str(i) for i in range(0, 35, 3)]
+    assert [r.seq for r in found["S2"]] == list(range(3, 36, 3))
+    assert found["S9"] == []
+    # segments spilled without an index file get one on first lookup
+    for _, _, path in log.segments():
+        os.remove(app.segment_index_path(path))
+    app.segment_indexes.clear()
+    spilled = [seq for seq in range(2, 36, 3) if seq < log.records[0].seq]
+    assert [r.seq for r in make_log(tmp_path).by_keys(["S1"])["S1"]] == spilled
+    assert all(os.path.exists(app.segment_index_path(path)) for _, _, path in log.segments())